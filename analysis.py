@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from annotation_store import AnnotationStore, INDEX_FILE as STORE_INDEX_FILE
+from instrumentation import traced
+
+# the feature cache lives in its own directory below the annotation root
+FEATURE_DIRECTORY = '.lcl_features'
+SOURCES_FILE = 'sources.json'
+STATISTICS = ['mean', 'max', 'integrated']
+
+
+def annotation_sources(root):
+    '''
+    returns the annotation stores (directories with an index.jsonl) and old annotation pickles below root, as (path
+    relative to root, kind) pairs. a pickle that was already converted to a store next to it is left out
+    '''
+    sources = []
+    for directory, subdirs, files in os.walk(root):
+        if STORE_INDEX_FILE in files:
+            sources.append((os.path.relpath(directory, root), 'store'))
+            # the crops of a store are not annotation files
+            subdirs[:] = []
+            continue
+        subdirs[:] = sorted(d for d in subdirs if d != FEATURE_DIRECTORY)
+        for f in sorted(files):
+            if f.endswith('.p') and not os.path.isdir(os.path.join(directory, f[:-2] + '.lcl')):
+                sources.append((os.path.relpath(os.path.join(directory, f), root), 'pickle'))
+    return sources
+
+
+def crop_features(crops, channels):
+    '''
+    returns the features of (y, x, channels) crops as columns: height, width, area and the mean, max and integrated
+    intensity of every channel. crops of the same shape are reduced together
+    '''
+    columns = {'height': np.zeros(len(crops), np.int32), 'width': np.zeros(len(crops), np.int32)}
+    for name in channels:
+        for statistic in STATISTICS:
+            columns[f'{name}_{statistic}'] = np.full(len(crops), np.nan)
+    shapes = {}
+    for i, crop in enumerate(crops):
+        shapes.setdefault(np.shape(crop), []).append(i)
+    for shape, rows in shapes.items():
+        columns['height'][rows] = shape[0]
+        columns['width'][rows] = shape[1]
+        if len(shape) < 3 or shape[0] * shape[1] == 0:
+            continue
+        stack = np.stack([crops[i] for i in rows]).reshape(len(rows), -1, shape[2])
+        integrated = stack.sum(axis=1, dtype=np.float64)
+        for c, name in enumerate(channels[:shape[2]]):
+            columns[f'{name}_mean'][rows] = integrated[:, c] / (shape[0] * shape[1])
+            columns[f'{name}_max'][rows] = stack[:, :, c].max(axis=1)
+            columns[f'{name}_integrated'][rows] = integrated[:, c]
+    columns['area'] = columns['height'] * columns['width']
+    return columns
+
+
+def _channel_names(channels, crop):
+    # old annotations may list channels by position, or not at all
+    if channels is None:
+        channels = range(np.shape(crop)[2] if np.ndim(crop) == 3 else 0)
+    return [str(c) for c in channels]
+
+
+def _records_features(records, crops):
+    '''
+    features of annotations given as (id, type, zoom, channels) records and their crops, the annotations with the
+    same channels are done as one batch
+    '''
+    groups = {}
+    for i, (_, _, _, channels) in enumerate(records):
+        groups.setdefault(tuple(_channel_names(channels, crops[i])), []).append(i)
+    parts = []
+    for channels, rows in groups.items():
+        columns = {'id': np.array([records[i][0] for i in rows], np.int64),
+                   'type': np.array([records[i][1] for i in rows], 'U16'),
+                   'zoom': np.array([-1 if records[i][2] is None else records[i][2] for i in rows], np.int32)}
+        columns.update(crop_features([crops[i] for i in rows], list(channels)))
+        parts.append(columns)
+    return merge_columns(parts)
+
+
+@traced()
+def store_features(path, ids):
+    '''
+    returns the feature columns of the given annotations of a store, their crops are memory mapped one at a time
+    '''
+    store = AnnotationStore(path)
+    records = store.records()
+    crops = [store.crop(i) for i in ids]
+    return _records_features([(i, records[i]['type'], records[i]['zoom'], records[i]['channels']) for i in ids],
+                             [crop if crop is not None else np.zeros((0, 0, 0)) for crop in crops])
+
+
+@traced()
+def pickle_features(path):
+    '''
+    returns the feature columns of an annotation pickle in the old save format, annotations are numbered by position
+    '''
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+    return _records_features([(i, d[0], d[4], d[1]) for i, d in enumerate(data)], [d[2] for d in data])
+
+
+def merge_columns(parts):
+    '''
+    concatenates feature column dicts, columns missing from some of them (other channels) are filled with NaN
+    '''
+    parts = [p for p in parts if len(p) and len(next(iter(p.values())))]
+    if not parts:
+        return {}
+    names = list(dict.fromkeys(name for part in parts for name in part))
+    columns = {}
+    for name in names:
+        pieces = []
+        for part in parts:
+            n = len(next(iter(part.values())))
+            pieces.append(part[name] if name in part else np.full(n, np.nan))
+        columns[name] = np.concatenate(pieces)
+    return columns
+
+
+def _select(columns, keep):
+    return {name: column[keep] for name, column in columns.items()}
+
+
+def _cache_file(cache, rel):
+    return os.path.join(cache, rel.replace(os.sep, '__').replace('/', '__') + '.npz')
+
+
+def feature_table(root, workers=None, batch_size=512, cache=True):
+    '''
+    returns the features (see crop_features) of every annotation below root as one columnar table, a dict of equally
+    long arrays with source, id, type and zoom as well (pandas.DataFrame(table) makes a data frame of it). the features
+    of each source are kept in a cache next to them, so only the annotations added since the last call are read: new
+    annotations of a store, and pickles that are new or changed. annotation batches are read by workers processes
+    '''
+    root = os.path.abspath(root)
+    cache_dir = os.path.join(root, FEATURE_DIRECTORY)
+    sources_path = os.path.join(cache_dir, SOURCES_FILE)
+    known = {}
+    if cache and os.path.exists(sources_path):
+        try:
+            with open(sources_path) as f:
+                known = json.load(f)
+        except (OSError, ValueError):
+            known = {}
+    if cache:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    tables, tasks, stamps, changed = {}, {}, {}, set()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for rel, kind in annotation_sources(root):
+            path = os.path.join(root, rel)
+            old = None
+            if rel in known and os.path.exists(_cache_file(cache_dir, rel)):
+                with np.load(_cache_file(cache_dir, rel)) as data:
+                    old = {name: data[name] for name in data.files}
+            if kind == 'store':
+                ids = sorted(AnnotationStore(path).records())
+                stamps[rel] = None
+                # a store whose annotations were all deleted is cached without any columns
+                if old and 'id' in old:
+                    # deleted annotations are dropped, only the new ones are read
+                    keep = np.isin(old['id'], ids)
+                    if not keep.all():
+                        old = _select(old, keep)
+                        changed.add(rel)
+                    ids = sorted(set(ids) - set(old['id'].tolist()))
+                tasks[rel] = [pool.submit(store_features, path, ids[i:i + batch_size])
+                              for i in range(0, len(ids), batch_size)]
+            else:
+                st = os.stat(path)
+                stamps[rel] = [st.st_size, st.st_mtime_ns]
+                if old is not None and known[rel] == stamps[rel]:
+                    tasks[rel] = []
+                else:
+                    old = None
+                    tasks[rel] = [pool.submit(pickle_features, path)]
+            tables[rel] = old
+        for rel, futures in tasks.items():
+            if futures or tables[rel] is None or rel in changed:
+                tables[rel] = merge_columns([tables[rel] or {}] + [future.result() for future in futures])
+                if cache:
+                    np.savez(_cache_file(cache_dir, rel), **tables[rel])
+
+    if cache:
+        for rel in set(known) - set(tables):
+            if os.path.exists(_cache_file(cache_dir, rel)):
+                os.remove(_cache_file(cache_dir, rel))
+        tmp = sources_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(stamps, f)
+        os.replace(tmp, sources_path)
+    parts = []
+    for rel, table in tables.items():
+        if table:
+            parts.append({'source': np.full(len(table['id']), rel, dtype=f'U{max(len(rel), 1)}'), **table})
+    return merge_columns(parts)
+
+
+def summarize(table):
+    '''
+    returns the number of annotations and the mean of every feature per annotation type
+    '''
+    summary = {}
+    for annotationType in np.unique(table['type']) if table else []:
+        rows = table['type'] == annotationType
+        summary[str(annotationType)] = {'count': int(rows.sum())}
+        for name, column in table.items():
+            if column.dtype.kind in 'iuf' and name not in ['id', 'zoom']:
+                values = column[rows][~np.isnan(column[rows])] if column.dtype.kind == 'f' else column[rows]
+                summary[str(annotationType)][name] = float(values.mean()) if len(values) else None
+    return summary
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Computes the size and per channel intensity features of every '
+                                                 'annotation crop below a directory and summarizes them.')
+    parser.add_argument('directory', help='Directory with annotation stores (.lcl) and old annotation pickles (.p).')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes.')
+    parser.add_argument('--csv', default=None, help='Also write the feature table to this CSV file.')
+    parser.add_argument('--no-cache', action='store_true', help='Read every annotation again, without the cache.')
+    args = parser.parse_args(args)
+    table = feature_table(args.directory, args.workers, cache=not args.no_cache)
+    print(json.dumps(summarize(table), indent=1))
+    if args.csv is not None and table:
+        names = list(table)
+        with open(args.csv, 'w') as f:
+            f.write(','.join(names) + '\n')
+            for row in zip(*(table[name] for name in names)):
+                f.write(','.join(str(v) for v in row) + '\n')
+
+
+if __name__ == '__main__':
+    main()
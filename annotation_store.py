@@ -0,0 +1,160 @@
+import json
+import os
+import pickle
+import numpy as np
+
+INDEX_FILE = 'index.jsonl'
+CROP_DIRECTORY = 'crops'
+# the pickles imported into a store, with their size and modification time and the ids they were given
+IMPORTS_FILE = 'imports.json'
+
+
+class AnnotationStore:
+    '''
+    a directory of saved annotations. the metadata of every annotation (label, channels, box, zoom, meta box...) is one
+    json line in a small index file, and its crops are separate .npy files next to it, so saving only appends what is
+    new and the boxes can be read back without touching any pixel data. deletions are appended to the index as well
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, CROP_DIRECTORY), exist_ok=True)
+        self._records = None
+        # the highest id in the index, deleted ones included, once records has read it
+        self._max_id = -1
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, INDEX_FILE)
+
+    def records(self):
+        '''
+        returns the metadata of every annotation in the store keyed by annotation id, without loading any crops
+        '''
+        if self._records is None:
+            self._records = {}
+            if os.path.exists(self.index_path):
+                with open(self.index_path) as f:
+                    for line in f:
+                        record = json.loads(line)
+                        self._max_id = max(self._max_id, record.get('id', record.get('deleted', -1)))
+                        if 'deleted' in record:
+                            self._records.pop(record['deleted'], None)
+                        else:
+                            self._records[record['id']] = record
+        return self._records
+
+    def metadata_table(self):
+        '''
+        returns the metadata of every annotation as a structured array, boxes of imported annotations without a known
+        position are -1
+        '''
+        records = list(self.records().values())
+        table = np.zeros(len(records), dtype=[('id', np.int64), ('type', 'U16'), ('x0', np.int32), ('y0', np.int32),
+                                              ('x1', np.int32), ('y1', np.int32), ('zoom', np.int32),
+                                              ('height', np.int32), ('width', np.int32), ('object_label', np.int64)])
+        for i, r in enumerate(records):
+            box = r['box'] if r['box'] is not None else [-1, -1, -1, -1]
+            table[i] = (r['id'], r['type'], *box, r['zoom'], *r['shape'][:2],
+                        -1 if r.get('object_label') is None else r['object_label'])
+        return table
+
+    def _append_records(self, records):
+        with open(self.index_path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def append(self, annotations):
+        '''
+        adds annotations, each a dict with type, channels, box, zoom, meta_box, meta_area, object_label (all
+        optional but type), crop and meta_crop, and returns their ids
+        '''
+        records = self.records()
+        next_id = self._max_id + 1
+        new = []
+        for i, annotation in enumerate(annotations):
+            record = {'id': next_id + i}
+            for k in ['type', 'channels', 'box', 'zoom', 'meta_box', 'meta_area', 'object_label', 'well']:
+                record[k] = annotation.get(k)
+            for k, name in [('crop', '{}.npy'), ('meta_crop', '{}_meta.npy')]:
+                if annotation.get(k) is None:
+                    record[k] = None
+                    continue
+                record[k] = os.path.join(CROP_DIRECTORY, name.format(record['id']))
+                np.save(os.path.join(self.path, record[k]), annotation[k])
+            crop = annotation.get('crop')
+            record['shape'] = list(crop.shape) if crop is not None else [0, 0, 0]
+            record['dtype'] = str(crop.dtype) if crop is not None else None
+            new.append(record)
+        # the crops are written before the index lines that point to them
+        self._append_records(new)
+        for record in new:
+            records[record['id']] = record
+        self._max_id += len(new)
+        return [record['id'] for record in new]
+
+    def delete(self, ids):
+        records = self.records()
+        self._append_records([{'deleted': i} for i in ids])
+        for i in ids:
+            records.pop(i, None)
+
+    def crop(self, i, meta=False, mmap_mode='r'):
+        '''
+        returns the (y, x, channels) crop, or meta annotation crop, of one annotation, memory mapped by default
+        '''
+        path = self.records()[i]['meta_crop' if meta else 'crop']
+        if path is None:
+            return None
+        return np.load(os.path.join(self.path, path), mmap_mode=mmap_mode)
+
+    def compact(self):
+        '''
+        rewrites the index without the deleted annotations and removes their crops
+        '''
+        records = self.records()
+        keep = set()
+        for record in records.values():
+            keep.update(p for p in [record['crop'], record['meta_crop']] if p is not None)
+        for f in os.listdir(os.path.join(self.path, CROP_DIRECTORY)):
+            if os.path.join(CROP_DIRECTORY, f) not in keep:
+                os.remove(os.path.join(self.path, CROP_DIRECTORY, f))
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            for record in records.values():
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp, self.index_path)
+
+
+def import_pickle(pickle_path, store_path=None):
+    '''
+    converts an annotation pickle from the old save format, a list of (type, channels, crop, meta crop, zoom) tuples,
+    into an annotation store (by default next to it, with the .lcl extension). the old format has no box positions, so
+    imported annotations have none. a pickle already imported into the store is not added again, and one that changed
+    since replaces the annotations it was imported as
+    '''
+    if store_path is None:
+        store_path = os.path.splitext(pickle_path)[0] + '.lcl'
+    store = AnnotationStore(store_path)
+    imports_path = os.path.join(store_path, IMPORTS_FILE)
+    imports = {}
+    if os.path.exists(imports_path):
+        with open(imports_path) as f:
+            imports = json.load(f)
+    source = os.path.abspath(pickle_path)
+    st = os.stat(pickle_path)
+    stamp = [st.st_size, st.st_mtime_ns]
+    if source in imports:
+        if imports[source]['stamp'] == stamp:
+            return store
+        store.delete([i for i in imports[source]['ids'] if i in store.records()])
+    with open(pickle_path, 'rb') as f:
+        data = pickle.load(f)
+    ids = store.append([{'type': d[0], 'channels': list(d[1]), 'crop': d[2], 'meta_crop': d[3], 'zoom': d[4]}
+                        for d in data])
+    imports[source] = {'stamp': stamp, 'ids': ids}
+    tmp = imports_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(imports, f)
+    os.replace(tmp, imports_path)
+    return store
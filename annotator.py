@@ -1,14 +1,473 @@
+import itertools
 import os
-import pickle
 import sys
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from PIL import Image
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QFileDialog, QMessageBox
-from utils import get_unique_names, get_all_paths_and_channels, get_obj_channels, validateDirectoryFormat
+from utils import get_unique_names, get_all_paths_and_channels, get_obj_channels, validateDirectoryFormat, \
+    extract_crops, to_display8, ImagePyramid, get_obj_channel_paths, threshold_engine, read_gray, filter_objects, \
+    table_centers, table_boxes, GridIndex, load_well_detections, load_well_nuclei, well_nucleus_table, nucleus_channel, \
+    find_well_directories, stretch_to_display8, channel_lut, CompositePyramid, coarse_objects
+from image_cache import channel_cache
+from manifest import well_manifest
+from annotation_store import AnnotationStore, import_pickle
+from instrumentation import span, traced, tracer, STATUS_ENV
 import sip
 
-Image.MAX_IMAGE_PIXELS = None
+
+def arrayToQImage(img):
+    '''
+    wraps an 8 bit grayscale or RGB numpy array in a QImage, the array has to outlive the QImage
+    '''
+    if img.ndim == 3:
+        fmt = QtGui.QImage.Format_RGB888
+    else:
+        fmt = QtGui.QImage.Format_Grayscale8
+    return QtGui.QImage(img.data, img.shape[1], img.shape[0], img.strides[0], fmt)
+
+
+def channelPixmap(path):
+    '''
+    returns the display pixmap for a channel image, decoded through the shared channel cache
+    '''
+    return channel_cache.get_derived(path, 'pixmap', lambda img: QtGui.QPixmap.fromImage(arrayToQImage(
+        to_display8(img))))
+
+
+def channelPyramid(path):
+    '''
+    returns the lazily downsampled display pyramid for a channel image, decoded through the shared channel cache
+    '''
+    return channel_cache.get_derived(path, 'pyramid', lambda img: ImagePyramid(to_display8(img)))
+
+
+def channelStretchedPyramid(path):
+    '''
+    returns the contrast stretched display pyramid of a channel image the composite view blends, decoded through the
+    shared channel cache
+    '''
+    return channel_cache.get_derived(path, 'stretched_pyramid', lambda img: ImagePyramid(stretch_to_display8(img)))
+
+
+# composite view colors of the usual stains, other channels take the next free one in turn
+compositeColors = {'DAPI': (0, 0, 255), 'dapi': (0, 0, 255), '488': (0, 255, 0), '647': (255, 0, 0),
+                   'Default': (128, 128, 128)}
+otherCompositeColors = [(255, 0, 255), (0, 255, 255), (255, 255, 0)]
+
+
+@traced()
+def prepareComposite(paths):
+    '''
+    decodes the channels and builds the display buffers the composite view blends. safe to run off the GUI thread
+    '''
+    for path in paths:
+        pyramid = channelStretchedPyramid(path)
+        pyramid.level(pyramid.n_levels - 1)
+    return paths
+
+
+@traced()
+def prepareChannel(path, tiled):
+    '''
+    decodes a channel and builds what the viewer needs to show it, everything but the final QPixmap which has to be
+    made on the GUI thread. safe to run off the GUI thread
+    '''
+    if tiled:
+        pyramid = channelPyramid(path)
+        pyramid.level(pyramid.n_levels - 1)
+    else:
+        channel_cache.get(path)
+    return path
+
+
+@traced()
+def findObjects(directory, channelThreshValues, workers):
+    '''
+    the auto find segmentation and its per nucleus table, stored detections from a batch run are used when they match
+    the thresholds
+    '''
+    if channelThreshValues is not None and set(channelThreshValues) != set(get_obj_channel_paths(directory)):
+        # thresholds carried over from a well with other channels, use the presets
+        channelThreshValues = None
+    paths = get_obj_channel_paths(directory)
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(paths)), 1)) as pool:
+        # the bases are built below the thresholds now, so dragging a slider down never builds one on demand
+        list(pool.map(lambda name: threshold_engine(paths[name]).prepare(
+            channelThreshValues[name] if channelThreshValues is not None else None), paths))
+    cached = load_well_detections(directory, channelThreshValues)
+    if cached is not None:
+        obj_channels, channelThreshValues = cached
+        nuclei = load_well_nuclei(directory, channelThreshValues)
+    else:
+        obj_channels, channelThreshValues = get_obj_channels(directory, channelThreshValues, workers=workers,
+                                                             as_table=True)
+        nuclei = None
+    if nuclei is None:
+        nuclei = well_nucleus_table(directory, channelThreshValues)
+    return obj_channels, channelThreshValues, nuclei
+
+
+@traced()
+def previewObjects(directory, channelThreshValues):
+    '''
+    the coarse auto find boxes of every channel (see coarse_objects) at the given thresholds, or the presets. a small
+    fraction of the work of findObjects, so they can be shown while it runs. safe to run off the GUI thread
+    '''
+    paths = get_obj_channel_paths(directory)
+    if channelThreshValues is not None and set(channelThreshValues) != set(paths):
+        channelThreshValues = None
+    previews = {}
+    for name, path in paths.items():
+        engine = threshold_engine(path)
+        thresh_val = channelThreshValues[name] if channelThreshValues is not None else engine.default_threshold()
+        # no box holding only super small objects can hold anything else
+        previews[name] = filter_objects(coarse_objects(engine.img, thresh_val), max_area=np.inf)
+    return previews
+
+
+@traced()
+def resegmentChannels(directory, names, channelThreshValues):
+    '''
+    the object tables of the named channels and the per nucleus table of a well at new thresholds, from the cached
+    threshold engines. safe to run off the GUI thread
+    '''
+    paths = get_obj_channel_paths(directory)
+    images = {name: read_gray(path) for name, path in paths.items()}
+    tables = {name: threshold_engine(paths[name]).table(channelThreshValues[name], images) for name in names}
+    return tables, well_nucleus_table(directory, channelThreshValues)
+
+
+@traced()
+def preloadWell(directory, channelThreshValues, tiled, workers):
+    '''
+    decodes every channel of a well, builds their display buffers and runs auto find on it, so that opening it next is
+    instant. safe to run off the GUI thread
+    '''
+    for path in get_all_paths_and_channels(directory).values():
+        prepareChannel(path, tiled)
+    return findObjects(directory, channelThreshValues, workers)
+
+
+def sameThresholds(found, wanted):
+    # whether objects found at the thresholds found will do when the thresholds wanted are asked for, None is any
+    if wanted is None:
+        return True
+    return found.keys() == wanted.keys() and all(float(found[k]) == float(wanted[k]) for k in wanted)
+
+
+def channelBitDepths(directory):
+    # thresholds are in native pixel values, they only mean the same on channels of the same bit depth
+    manifest = well_manifest(directory)['channels']
+    return {name: manifest[name]['bit_depth'] for name in get_obj_channel_paths(directory)}
+
+
+class Worker(QtCore.QObject):
+    '''
+    runs fn(*args) on a thread pool. finished carries the result back to the GUI thread (queued) unless the worker was
+    cancelled in the meantime, done is always emitted once it stops
+    '''
+    finished = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+    done = QtCore.pyqtSignal()
+
+    def __init__(self, fn, *args):
+        super(Worker, self).__init__()
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+        self.future = None
+
+    def start(self, pool):
+        self.future = pool.submit(self.run)
+
+    def cancel(self):
+        # True if it had not started yet, and so will never report back by itself
+        self.cancelled = True
+        return self.future.cancel()
+
+    def run(self):
+        try:
+            if not self.cancelled:
+                result = self.fn(*self.args)
+                if not self.cancelled:
+                    self.finished.emit(result)
+        except Exception:
+            self.failed.emit(traceback.format_exc())
+        finally:
+            self.done.emit()
+
+
+class TiledImageItem(QtWidgets.QGraphicsItem):
+    '''
+    draws an ImagePyramid (or CompositePyramid) in full resolution scene coordinates, only converting the tiles of the
+    level matching the current zoom that are actually exposed
+    '''
+
+    def __init__(self, tileSize=512, maxTiles=256):
+        super(TiledImageItem, self).__init__()
+        self.tileSize = tileSize
+        self.maxTiles = maxTiles
+        self.pyramid = None
+        self._tiles = OrderedDict()
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def setPyramid(self, pyramid):
+        self.prepareGeometryChange()
+        self.pyramid = pyramid
+        self._tiles.clear()
+        self.update()
+
+    def boundingRect(self):
+        if self.pyramid is None:
+            return QtCore.QRectF()
+        return QtCore.QRectF(0, 0, self.pyramid.shape[1], self.pyramid.shape[0])
+
+    def levelForScale(self, scale):
+        if scale >= 1:
+            return 0
+        return min(int(np.log2(1 / scale)), self.pyramid.n_levels - 1)
+
+    def tilePixmap(self, level, tx, ty):
+        key = (level, tx, ty)
+        pixmap = self._tiles.get(key)
+        if pixmap is None:
+            tile = np.ascontiguousarray(self.pyramid.region(level, ty * self.tileSize, (ty + 1) * self.tileSize,
+                                                            tx * self.tileSize, (tx + 1) * self.tileSize))
+            pixmap = QtGui.QPixmap.fromImage(arrayToQImage(tile))
+            self._tiles[key] = pixmap
+            if len(self._tiles) > self.maxTiles:
+                self._tiles.popitem(last=False)
+        else:
+            self._tiles.move_to_end(key)
+        return pixmap
+
+    def paint(self, painter, option, widget=None):
+        if self.pyramid is None:
+            return
+        transform = painter.worldTransform()
+        level = self.levelForScale(np.hypot(transform.m11(), transform.m12()))
+        height, width = self.pyramid.level_shape(level)
+        # size of one pixel of this level in scene coordinates
+        sx = self.pyramid.shape[1] / width
+        sy = self.pyramid.shape[0] / height
+        for tx, ty in self.tilesIn(option.exposedRect, level):
+            pixmap = self.tilePixmap(level, tx, ty)
+            target = QtCore.QRectF(tx * self.tileSize * sx, ty * self.tileSize * sy,
+                                   pixmap.width() * sx, pixmap.height() * sy)
+            painter.drawPixmap(target, pixmap, QtCore.QRectF(pixmap.rect()))
+
+    def tilesIn(self, rect, level):
+        height, width = self.pyramid.level_shape(level)
+        sx = self.pyramid.shape[1] / width
+        sy = self.pyramid.shape[0] / height
+        rect = rect.intersected(self.boundingRect())
+        tx0 = max(int(rect.left() / sx) // self.tileSize, 0)
+        ty0 = max(int(rect.top() / sy) // self.tileSize, 0)
+        tx1 = min(int(np.ceil(rect.right() / sx / self.tileSize)), int(np.ceil(width / self.tileSize)))
+        ty1 = min(int(np.ceil(rect.bottom() / sy / self.tileSize)), int(np.ceil(height / self.tileSize)))
+        return [(tx, ty) for ty in range(ty0, ty1) for tx in range(tx0, tx1)]
+
+    def prefetch(self, rect, scale):
+        '''
+        converts the tiles that painting rect at scale will need ahead of time
+        '''
+        if self.pyramid is None:
+            return
+        level = self.levelForScale(scale)
+        for tx, ty in self.tilesIn(rect, level):
+            self.tilePixmap(level, tx, ty)
+
+
+class ObjectBoxesItem(QtWidgets.QGraphicsItem):
+    '''
+    draws all of the detected object boxes of one channel as a single scene item, keeping the boxes as arrays and
+    only painting the ones intersecting the exposed area. it never takes mouse clicks
+    '''
+    Type = QtWidgets.QGraphicsItem.UserType + 1
+    # below this many screen pixels per box, a box is drawn as a single pixel
+    min_box_pixels = 2
+
+    def __init__(self, color):
+        super(ObjectBoxesItem, self).__init__()
+        self.pen = QtGui.QPen(color)
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.setAcceptedMouseButtons(QtCore.Qt.NoButton)
+        self.setTable(None)
+
+    def setTable(self, table):
+        self.prepareGeometryChange()
+        if table is None or len(table) == 0:
+            self.boxes = np.zeros((4, 0))
+            self._rect = QtCore.QRectF()
+            self.boxSize = 0
+        else:
+            self.boxes = np.stack([table['x0'], table['y0'], table['x1'], table['y1']]).astype(np.float64)
+            self._rect = QtCore.QRectF(self.boxes[0].min(), self.boxes[1].min(),
+                                       self.boxes[2].max() - self.boxes[0].min(),
+                                       self.boxes[3].max() - self.boxes[1].min()).adjusted(-1, -1, 1, 1)
+            self.boxSize = float(np.median(np.maximum(self.boxes[2] - self.boxes[0], self.boxes[3] - self.boxes[1])))
+        # the QRectF of a box is made the first time it is painted and kept for the next paints
+        self.xywh = np.stack([self.boxes[0], self.boxes[1], self.boxes[2] - self.boxes[0],
+                              self.boxes[3] - self.boxes[1]], axis=1)
+        self.rects = [None] * self.boxes.shape[1]
+        self.update()
+
+    def type(self):
+        return self.Type
+
+    def boundingRect(self):
+        return self._rect
+
+    def shape(self):
+        # empty so itemAt and collision tests go straight through to the image and the annotations
+        return QtGui.QPainterPath()
+
+    def paint(self, painter, option, widget=None):
+        exposed = option.exposedRect
+        x0, y0, x1, y1 = self.boxes
+        visible = np.flatnonzero((x1 >= exposed.left()) & (x0 <= exposed.right()) &
+                                 (y1 >= exposed.top()) & (y0 <= exposed.bottom()))
+        if len(visible) == 0:
+            return
+        scale = option.levelOfDetailFromTransform(painter.worldTransform())
+        if self.boxSize * scale < self.min_box_pixels:
+            self.paintCoarse(painter, exposed, scale, visible)
+            return
+        rects = self.rects
+        visible = visible.tolist()
+        missing = [i for i in visible if rects[i] is None]
+        for i, rect in zip(missing, itertools.starmap(QtCore.QRectF, self.xywh[missing].tolist())):
+            rects[i] = rect
+        painter.setPen(self.pen)
+        painter.setBrush(QtCore.Qt.NoBrush)
+        painter.drawRects([rects[i] for i in visible])
+
+    def paintCoarse(self, painter, exposed, scale, visible):
+        # one screen pixel at the centre of every visible box, painted as an image of the exposed area
+        w, h = int(np.ceil(exposed.width() * scale)) + 1, int(np.ceil(exposed.height() * scale)) + 1
+        x = (((self.boxes[0, visible] + self.boxes[2, visible]) / 2 - exposed.left()) * scale).astype(np.intp)
+        y = (((self.boxes[1, visible] + self.boxes[3, visible]) / 2 - exposed.top()) * scale).astype(np.intp)
+        inside = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+        pixels = np.zeros((h, w), dtype=np.uint32)
+        pixels[y[inside], x[inside]] = self.pen.color().rgba()
+        image = QtGui.QImage(pixels.data, w, h, 4 * w, QtGui.QImage.Format_ARGB32)
+        painter.drawImage(QtCore.QRectF(exposed.left(), exposed.top(), w / scale, h / scale), image)
+
+
+class ObjectQueueModel(QtCore.QAbstractListModel):
+    '''
+    the auto found nuclei left to annotate, as a list model over their object table. a row's text is only made when a
+    view asks for it, and every object keeps its label as a stable id however the queue is sampled, ordered or
+    shortened
+    '''
+    samplings = ['Every 4th', 'All', 'Random quarter']
+    orderings = ['Position', 'Largest', 'Brightest', 'Most positive']
+
+    def __init__(self, parent=None):
+        super(ObjectQueueModel, self).__init__(parent)
+        self.table = None
+        self.nuclei = None
+        self.channel = None
+        self.rows = np.zeros(0, dtype=np.intp)
+        self.sampling = self.samplings[0]
+        self.ordering = self.orderings[0]
+        self.done = set()
+
+    def setObjects(self, table, nuclei=None, done=(), channel=None):
+        # done are the labels of the objects already annotated, channel the one the objects were found in
+        self.table = table
+        self.nuclei = nuclei
+        self.channel = channel
+        self.done = set(done)
+        self.update()
+
+    def setSampling(self, sampling):
+        self.sampling = sampling
+        self.update()
+
+    def setOrdering(self, ordering):
+        self.ordering = ordering
+        self.update()
+
+    def clear(self):
+        self.setObjects(None)
+
+    def update(self):
+        self.beginResetModel()
+        n = 0 if self.table is None else len(self.table)
+        if self.sampling == 'All':
+            rows = np.arange(n)
+        elif self.sampling == 'Random quarter':
+            # seeded so the same objects come up every time the queue is rebuilt
+            rows = np.sort(np.random.default_rng(0).permutation(n)[:n // 4])
+        else:
+            rows = np.arange(4, n, 4)
+        if len(self.done) > 0:
+            rows = rows[~np.isin(self.table['label'][rows], list(self.done))]
+        key = self.sortKey()
+        if key is not None:
+            rows = rows[np.argsort(-key[rows], kind='stable')]
+        self.rows = rows
+        self.endResetModel()
+
+    def sortKey(self):
+        if self.table is None or self.ordering == 'Position':
+            return None
+        if self.ordering == 'Largest':
+            return self.table['area']
+        if self.ordering == 'Brightest':
+            if 'mean_' + str(self.channel) not in self.table.dtype.names:
+                return None
+            return self.table['mean_' + self.channel]
+        if self.nuclei is None:
+            return None
+        # the fraction of the nucleus covered by the other channels' objects, summed over the channels
+        nuclei = self.nuclei[self.table['label'] - 1]
+        return sum(nuclei[name].astype(np.float64) for name in nuclei.dtype.names if name.startswith('overlap_'))
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        obj = self.table[self.rows[index.row()]]
+        if role == QtCore.Qt.UserRole:
+            return int(obj['label'])
+        if role != QtCore.Qt.DisplayRole:
+            return None
+        x, y = self.center(index.row())
+        text = f'{x}, {y}'
+        if self.nuclei is not None:
+            # mark which other channels the nucleus is positive for
+            nucleus = self.nuclei[obj['label'] - 1]
+            text += '  ' + ' '.join(name[len('positive_'):] + ('+' if nucleus[name] else '-')
+                                    for name in nucleus.dtype.names if name.startswith('positive_'))
+        return text
+
+    def center(self, row):
+        x, y = table_centers(self.table[self.rows[row:row + 1]])
+        return int(x[0]), int(y[0])
+
+    def label(self, row):
+        return int(self.table['label'][self.rows[row]])
+
+    def rowOfLabel(self, label):
+        found = np.flatnonzero(self.table['label'][self.rows] == label) if len(self.rows) else []
+        return int(found[0]) if len(found) else -1
+
+    def markDone(self, label):
+        self.done.add(label)
+        row = self.rowOfLabel(label)
+        if row >= 0:
+            self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+            self.rows = np.delete(self.rows, row)
+            self.endRemoveRows()
 
 
 class PhotoViewer(QtWidgets.QGraphicsView):
@@ -22,6 +481,9 @@ class PhotoViewer(QtWidgets.QGraphicsView):
         self.scene = QtWidgets.QGraphicsScene(self)
         self._photo = QtWidgets.QGraphicsPixmapItem()
         self.scene.addItem(self._photo)
+        self._tiledPhoto = TiledImageItem()
+        self._tiledPhoto.hide()
+        self.scene.addItem(self._tiledPhoto)
         self.setScene(self.scene)
         self.setTransformationAnchor(QtWidgets.QGraphicsView.AnchorUnderMouse)
         self.setResizeAnchor(QtWidgets.QGraphicsView.AnchorUnderMouse)
@@ -33,8 +495,23 @@ class PhotoViewer(QtWidgets.QGraphicsView):
     def hasPhoto(self):
         return not self._empty
 
+    def imageItem(self):
+        if self._tiledPhoto.isVisible():
+            return self._tiledPhoto
+        return self._photo
+
+    def prefetchAround(self, x, y):
+        '''
+        renders the tiles needed to show the scene centred on (x, y) at the current zoom
+        '''
+        if not self._tiledPhoto.isVisible():
+            return
+        rect = self.mapToScene(self.viewport().rect()).boundingRect()
+        rect.moveCenter(QtCore.QPointF(x, y))
+        self._tiledPhoto.prefetch(rect, np.hypot(self.transform().m11(), self.transform().m12()))
+
     def fitInView(self, scale=True):
-        rect = QtCore.QRectF(self._photo.pixmap().rect())
+        rect = self.imageItem().boundingRect()
         if not rect.isNull():
             self.setSceneRect(rect)
 
@@ -63,6 +540,23 @@ class PhotoViewer(QtWidgets.QGraphicsView):
             self._empty = True
             self.setDragMode(QtWidgets.QGraphicsView.NoDrag)
             self._photo.setPixmap(QtGui.QPixmap())
+        self._tiledPhoto.hide()
+        self._tiledPhoto.setPyramid(None)
+        self._photo.show()
+        self.fitInView()
+
+    def setPyramid(self, pyramid=None, channel_change=False):
+        # tiled level of detail alternative to setPhoto for images too large to keep as one pixmap
+        if pyramid is None:
+            self.setPhoto(None, channel_change)
+            return
+        self._empty = False
+        if not channel_change:
+            self.setDragMode(QtWidgets.QGraphicsView.ScrollHandDrag)
+        self._photo.setPixmap(QtGui.QPixmap())
+        self._photo.hide()
+        self._tiledPhoto.setPyramid(pyramid)
+        self._tiledPhoto.show()
         self.fitInView()
 
     def wheelEvent(self, event):
@@ -93,17 +587,21 @@ class PhotoViewer(QtWidgets.QGraphicsView):
         #     self.setDragMode(QtWidgets.QGraphicsView.ScrollHandDrag)
 
     def mousePressEvent(self, event):
-        if self._photo.isUnderMouse():
+        if self.imageItem().isUnderMouse():
             self.photoClicked.emit(self.mapToScene(event.pos()).toPoint())
         super(PhotoViewer, self).mousePressEvent(event)
 
     def mouseReleaseEvent(self, event: QtGui.QMouseEvent) -> None:
-        if self._photo.isUnderMouse():
+        if self.imageItem().isUnderMouse():
             self.photoReleased.emit(self.mapToScene(event.pos()).toPoint())
         super(PhotoViewer, self).mouseReleaseEvent(event)
 
 
 class Window(QtWidgets.QWidget):
+    spanFinished = QtCore.pyqtSignal(str, float, object)
+    channelColors = [QtGui.QColor(255, 0, 0), QtGui.QColor(0, 255, 0), QtGui.QColor(0, 0, 255),
+                     QtGui.QColor(102, 51, 0)]
+
     def __init__(self):
         super(Window, self).__init__()
         self.setWindowIcon(QtGui.QIcon('DigiOmics-logo1-215x200.png'))
@@ -120,6 +618,18 @@ class Window(QtWidgets.QWidget):
         self.btnLoad.setText('Open Image\nDirectory')
         self.btnLoad.clicked.connect(self.loadImage)
 
+        # a session walks through the wells of a plate in order, the next well is prepared while one is annotated
+        self.btnOpenPlate = QtWidgets.QToolButton(self)
+        self.btnOpenPlate.setText('Open Plate\nDirectory')
+        self.btnOpenPlate.clicked.connect(self.openPlate)
+        self.previousWellPushButton = QtWidgets.QPushButton(text='Previous\nWell')
+        self.previousWellPushButton.clicked.connect(lambda: self.openSessionWell(self.sessionIndex - 1))
+        self.nextWellPushButton = QtWidgets.QPushButton(text='Next\nWell')
+        self.nextWellPushButton.clicked.connect(lambda: self.openSessionWell(self.sessionIndex + 1))
+        self.wellLabel = QtWidgets.QLabel()
+        for widget in [self.previousWellPushButton, self.wellLabel, self.nextWellPushButton]:
+            widget.hide()
+
         self.removeRectPushbutton = QtWidgets.QPushButton(text='Delete Rectangles\nand Annotations')
         self.removeRectPushbutton.clicked.connect(self.removeAllRects)
 
@@ -127,6 +637,50 @@ class Window(QtWidgets.QWidget):
         self.channelComboBoxWidget = QtWidgets.QComboBox()
         self.channelComboBoxWidget.setFixedWidth(150)
         self.channelComboBoxWidget.currentTextChanged.connect(self.changeChannel)
+        # draw the image as a level of detail tile pyramid rather than one full resolution pixmap
+        self.tiledCheckBox = QtWidgets.QCheckBox('Tiled')
+        self.tiledCheckBox.setChecked(True)
+        self.tiledCheckBox.toggled.connect(self.toggleTiledRendering)
+        # all channels blended in color. the channel toggles, brightness and contrast only change the lookup tables
+        self.compositeCheckBox = QtWidgets.QCheckBox('Composite')
+        self.compositeCheckBox.toggled.connect(self.toggleComposite)
+        self.compositeGroupBox = QtWidgets.QGroupBox('Composite')
+        self.compositeGroupBoxLayout = QtWidgets.QHBoxLayout()
+        self.compositeGroupBox.setLayout(self.compositeGroupBoxLayout)
+        self.compositeCheckBoxes = {}
+        self.brightnessSlider = QtWidgets.QSlider(orientation=QtCore.Qt.Horizontal)
+        self.brightnessSlider.setRange(-128, 128)
+        self.brightnessSlider.setToolTip('Brightness')
+        self.brightnessSlider.valueChanged.connect(self.updateComposite)
+        self.contrastSlider = QtWidgets.QSlider(orientation=QtCore.Qt.Horizontal)
+        # percent
+        self.contrastSlider.setRange(10, 400)
+        self.contrastSlider.setValue(100)
+        self.contrastSlider.setToolTip('Contrast')
+        self.contrastSlider.valueChanged.connect(self.updateComposite)
+        self.compositeGroupBoxLayout.addWidget(QtWidgets.QLabel('Brightness'))
+        self.compositeGroupBoxLayout.addWidget(self.brightnessSlider)
+        self.compositeGroupBoxLayout.addWidget(QtWidgets.QLabel('Contrast'))
+        self.compositeGroupBoxLayout.addWidget(self.contrastSlider)
+        self.compositeGroupBox.hide()
+        # decoding and auto find run on the thread pool, this shows while any of it is going on. python threads
+        # rather than a QThreadPool, python QRunnables deadlock against QPixmap work on the GUI thread
+        self.threadPool = ThreadPoolExecutor(max_workers=os.cpu_count())
+        # prefetching gets its own thread so it never holds up what the user asked for
+        self.prefetchPool = ThreadPoolExecutor(max_workers=1)
+        self.activeWorkers = []
+        self.prefetchWorkers = []
+        self.displayWorker = None
+        self.autoLocateWorker = None
+        self.previewWorker = None
+        self.previewOverlays = {}
+        self.busyBar = QtWidgets.QProgressBar()
+        self.busyBar.setRange(0, 0)
+        self.busyBar.setFixedWidth(100)
+        self.busyBar.hide()
+        self.cancelPushButton = QtWidgets.QPushButton(text='Cancel')
+        self.cancelPushButton.clicked.connect(self.cancelBackgroundWork)
+        self.cancelPushButton.hide()
         self.annotationGroupBox = QtWidgets.QGroupBox('Annotation')
         self.annotateGroupBoxLayout = QtWidgets.QHBoxLayout()
         self.annotationGroupBox.setLayout(self.annotateGroupBoxLayout)
@@ -154,9 +708,13 @@ class Window(QtWidgets.QWidget):
 
         self.autoLocatePushButton = QtWidgets.QPushButton(text='Auto\nFind')
         self.autoLocatePushButton.clicked.connect(self.autoLocate)
+        # coarse boxes from a downsampled pass shown while auto find runs at full resolution
+        self.previewCheckBox = QtWidgets.QCheckBox('Quick\nPreview')
+        self.previewCheckBox.setChecked(True)
 
         self.autoAnnotatePushbutton = QtWidgets.QPushButton(text='Auto\nAnnotate')
-        self.autoAnnotatePushbutton.clicked.connect(self.snapToDapiLoc)
+        self.autoAnnotatePushbutton.clicked.connect(
+            lambda: self.snapToObject(self.locatedObjectsComboBox.currentIndex()))
 
         # Arrange layout
         self.VBlayout = QtWidgets.QVBoxLayout(self)
@@ -164,10 +722,23 @@ class Window(QtWidgets.QWidget):
         self.HBlayout = QtWidgets.QHBoxLayout()
         self.HBlayout.setAlignment(QtCore.Qt.AlignLeft)
         self.HBlayout.addWidget(self.btnLoad)
+        self.HBlayout.addWidget(self.btnOpenPlate)
+        self.HBlayout.addWidget(self.previousWellPushButton)
+        self.HBlayout.addWidget(self.wellLabel)
+        self.HBlayout.addWidget(self.nextWellPushButton)
         self.HBlayout.addWidget(self.channelLabel)
         self.HBlayout.addWidget(self.channelComboBoxWidget)
-
-        # self.HBlayout.addWidget(self.loadAnnotationPushButton)
+        self.HBlayout.addWidget(self.tiledCheckBox)
+        self.HBlayout.addWidget(self.compositeCheckBox)
+        self.HBlayout.addWidget(self.compositeGroupBox)
+        self.HBlayout.addWidget(self.busyBar)
+        self.HBlayout.addWidget(self.cancelPushButton)
+        if os.environ.get(STATUS_ENV):
+            # how long the last thing took and the peak memory so far, see instrumentation.py
+            self.timingLabel = QtWidgets.QLabel()
+            self.HBlayout.addWidget(self.timingLabel)
+            self.spanFinished.connect(self.showTiming)
+            tracer.add_listener(self.spanListener)
 
         self.VBlayout.addLayout(self.HBlayout)
         self.channels = {}
@@ -175,17 +746,56 @@ class Window(QtWidgets.QWidget):
         self.annotation_pen = QtGui.QPen(QtGui.QColor(0, 0, 0), 3, QtCore.Qt.SolidLine)
         self.deletingAnnotations = False
         self.annotationType = 'None'
-        self.annotations = []
-        self.meta_annotations = []
+        self.annotations = {}
+        self.annotationIndex = GridIndex()
+        self.resetAnnotations()
+        # where the annotations are saved, and the store id of every annotation already saved there
+        self.annotationStore = None
+        self.savedAnnotations = {}
+        # the annotations of the other wells opened since, see stashWellAnnotations
+        self.wellAnnotations = {}
+        self.sessionWells = []
+        self.sessionIndex = -1
+        self.sessionThresholds = None
+        # the bit depths of the channels of the well the session thresholds were set on
+        self.sessionBitDepths = None
+        # auto find results of the next well of the session, and the worker preparing it
+        self.preloadedWells = {}
+        self.preloadWorker = None
+        self.preloadDirectory = None
         self.channelGroupBoxes = []
         self.channelSliders = {}
+        self.channelShowCheckBoxes = {}
         self.obj_channels = None
+        # which objects of the other channels every dapi object overlaps, see associate_objects
+        self.nuclei = None
+        self.segmentationWorkers = os.cpu_count() or 1
+        # the queue of auto found nuclei for assisted annotation, and how it is sampled and ordered
+        self.objectQueue = ObjectQueueModel(self)
         self.locatedObjectsComboBox = QtWidgets.QComboBox()
-        self.locatedObjectsComboBox.currentTextChanged.connect(self.snapToDapiLoc)
+        self.locatedObjectsComboBox.setModel(self.objectQueue)
+        self.locatedObjectsComboBox.view().setUniformItemSizes(True)
+        self.locatedObjectsComboBox.currentIndexChanged.connect(self.snapToObject)
+        self.queueSamplingComboBox = QtWidgets.QComboBox()
+        self.queueSamplingComboBox.addItems(ObjectQueueModel.samplings)
+        self.queueSamplingComboBox.currentTextChanged.connect(self.objectQueue.setSampling)
+        self.queueOrderComboBox = QtWidgets.QComboBox()
+        self.queueOrderComboBox.addItems(ObjectQueueModel.orderings)
+        self.queueOrderComboBox.currentTextChanged.connect(self.objectQueue.setOrdering)
         self.annotationAssistPushButton = QtWidgets.QPushButton('Assisted\nAnnotation')
         self.annotationAssistPushButton.setCheckable(True)
         self.annotationAssistPushButton.clicked.connect(self.toggleAssistedAnnotation)
         self.trackingAnnotations = False
+        self.channelOverlays = {}
+        self.objectIndex = {}
+        self.pendingSliderChannels = set()
+        self.sliderTimer = QtCore.QTimer(self)
+        self.sliderTimer.setSingleShot(True)
+        self.sliderTimer.setInterval(30)
+        self.sliderTimer.timeout.connect(self.resegmentPendingChannels)
+        # every re-segmentation gets the next generation, only the latest one's objects are drawn
+        self.resegmentWorker = None
+        self.resegmentGeneration = 0
 
     def stopAssistedAnnotation(self):
 
@@ -201,16 +811,14 @@ class Window(QtWidgets.QWidget):
         self.trackingAnnotations = False
 
     def startAssistedAnnotation(self):
-        text = self.locatedObjectsComboBox.currentText()
-        if text == '':
+        if self.objectQueue.rowCount() == 0:
             return
         self.viewer.toggleDragMode(False)
         self.annotateNoneRadioButton.setEnabled(False)
         # add the list of auto located dapi things
         self.locatedObjectsComboBox.setEnabled(True)
         # go to the first index of the auto located things
-        text = self.locatedObjectsComboBox.currentText()
-        self.snapToDapiLoc(text)
+        self.snapToObject(self.locatedObjectsComboBox.currentIndex())
         # set it so we can only zoom directly in and out
         self.viewer.setTransformationAnchor(QtWidgets.QGraphicsView.AnchorViewCenter)
         self.viewer.setResizeAnchor(QtWidgets.QGraphicsView.AnchorViewCenter)
@@ -247,15 +855,26 @@ class Window(QtWidgets.QWidget):
             # make slider widget
             tempSliderWidget = QtWidgets.QSlider(orientation=QtCore.Qt.Horizontal)
             tempSliderWidget.setObjectName(k)
-            tempSliderWidget.setMaximum(255)
+            # thresholds are in the channel's native pixel values, 0-255 for 8 bit images, 0-65535 for 16 bit
+            bitDepth = min(well_manifest(self.directory)['channels'][k]['bit_depth'], 16)
+            tempSliderWidget.setMaximum(2 ** bitDepth - 1)
             tempSliderWidget.setMinimum(0)
+            tempSliderWidget.setPageStep(10 * 2 ** max(bitDepth - 8, 0))
             tempSliderWidget.setSliderPosition(int(channelThreshValues[k]))
+            tempSliderWidget.valueChanged.connect(lambda _, k=k: self.sliderMoved(k))
+
+            # toggles the channel's boxes
+            tempShowCheckBox = QtWidgets.QCheckBox('Show boxes')
+            tempShowCheckBox.setChecked(True)
+            tempShowCheckBox.toggled.connect(lambda state, k=k: self.showChannelObjects(k, state))
 
             # add slider widget to overall vGroupBox
             tempGroupBoxVLayout.addWidget(tempSliderWidget)
+            tempGroupBoxVLayout.addWidget(tempShowCheckBox)
             self.HBlayout.addWidget(tempGroupBox)
             self.channelGroupBoxes.append(tempGroupBox)
             self.channelSliders[k] = tempSliderWidget
+            self.channelShowCheckBoxes[k] = tempShowCheckBox
 
 
             if self.locatedObjectsComboBox is not None:
@@ -268,72 +887,242 @@ class Window(QtWidgets.QWidget):
 
 
     def autoLocate(self):
-        self.removeAllRects()
+        if self.autoLocateWorker is not None:
+            return
+        self.clearOverlays()
         self.stopAssistedAnnotation()
-        self.locatedObjectsComboBox.clear()
+        self.objectQueue.clear()
 
         if len(self.channelGroupBoxes) != 0:
             # if we do have channel group boxes
             channelThreshValues = self.getSliderValues(None)
-            self.obj_channels, channelThreshValues = get_obj_channels(self.directory, channelThreshValues)
-        elif len(self.channelGroupBoxes) == 0:
+        else:
+            channelThreshValues = None
+        self.startAutoLocate(channelThreshValues)
+
+    def startAutoLocate(self, channelThreshValues):
+        self.autoLocatePushButton.setEnabled(False)
+        if self.previewCheckBox.isChecked():
+            self.previewWorker = self.runInBackground(previewObjects, (self.directory, channelThreshValues),
+                                                      self.previewFinished)
+        self.autoLocateWorker = self.runInBackground(findObjects, (self.directory, channelThreshValues,
+                                                                   self.segmentationWorkers), self.autoLocateFinished)
+
+    def previewFinished(self, previews):
+        # dashed coarse boxes until the full resolution objects are in, they take their place
+        if self.autoLocateWorker is None:
+            return
+        self.clearPreview()
+        with span('preview draw'):
+            for i, (k, objs) in enumerate(previews.items()):
+                item = ObjectBoxesItem(self.channelColors[i])
+                item.pen.setStyle(QtCore.Qt.DashLine)
+                item.setTable(objs)
+                self.viewer.scene.addItem(item)
+                self.previewOverlays[k] = item
+
+    def clearPreview(self):
+        for overlay in self.previewOverlays.values():
+            self.viewer.scene.removeItem(overlay)
+        self.previewOverlays = {}
+
+    def autoLocateFinished(self, result):
+        self.clearPreview()
+        self.obj_channels, channelThreshValues, self.nuclei = result
+        if len(self.channelGroupBoxes) == 0:
             # if we dont have channel group boxes
-            self.obj_channels, channelThreshValues = get_obj_channels(self.directory)
             self.addChannelSelections(channelThreshValues)
             # add auto-annotation gui elements
             self.HBlayout.addWidget(self.annotationAssistPushButton)
             self.HBlayout.addWidget(self.locatedObjectsComboBox)
+            self.HBlayout.addWidget(self.queueSamplingComboBox)
+            self.HBlayout.addWidget(self.queueOrderComboBox)
             self.locatedObjectsComboBox.setEnabled(False)
-        if 'DAPI' in self.obj_channels.keys():
-            dapiChan = 'DAPI'
-        elif 'dapi' in self.obj_channels.keys():
-            dapiChan = 'dapi'
-        else:
+        if self.dapiChannel() is None:
             QMessageBox.about(self, "Error", "No DAPI channel detected for auto-finding")
             return
-        # draw all of our boxes
-        colors = [QtGui.QColor(255, 0, 0), QtGui.QColor(0, 255, 0), QtGui.QColor(0, 0, 255), QtGui.QColor(102, 51, 0)]
-        temp_items = {}
-        for i, [k, v] in enumerate(self.obj_channels.items()):
-            color = colors[i]
-            objs = self.obj_channels[k]
-            temp_items[k] = []
-            for obj in objs:
-                s = (obj[1].stop - obj[1].start) * (obj[0].stop - obj[0].start)
-                # filter out super large and super small boxes
-                if 1E6 > s > 100:
-                    self.viewer.scene.addRect(QtCore.QRectF(obj[1].start, obj[0].start, obj[1].stop - obj[1].start
-                                                            , obj[0].stop - obj[0].start), color)
-                    temp_items[k].append(obj)
-        self.obj_channels = temp_items
-        for i in range(4, len(self.obj_channels[dapiChan]), 4):
-            obj = self.obj_channels[dapiChan][i]
-            x = int(obj[1].start + (obj[1].stop - obj[1].start) / 2)
-            y = int(obj[0].start + (obj[0].stop - obj[0].start) / 2)
-            self.locatedObjectsComboBox.addItem(f'{x}, {y}')
-        self.annotateNoneRadioButton.click()
-
-    def snapToDapiLoc(self, text):
-        if self.annotationAssistPushButton.isChecked():
-            x, y = int(text.split(', ')[0]), int(text.split(', ')[1])
-            self.viewer.centerOn(x, y)
+        with span('autoLocate draw'):
+            # draw all of our boxes
+            for i, k in enumerate(list(self.obj_channels.keys())):
+                self.obj_channels[k] = self.drawChannelObjects(i, k, self.obj_channels[k])
+            self.fillLocatedObjects()
+            self.annotateNoneRadioButton.click()
+        if self.sessionWells:
+            # the well on screen is ready, now the next one
+            self.preloadNextWell(self.getSliderValues(None))
+
+    def runInBackground(self, fn, args, onFinished, busy=True):
+        worker = Worker(fn, *args)
+        worker.finished.connect(onFinished)
+        worker.failed.connect(self.backgroundFailed)
+        worker.done.connect(lambda: self.workerDone(worker))
+        if busy:
+            self.activeWorkers.append(worker)
+            self.busyBar.show()
+            self.cancelPushButton.show()
+            worker.start(self.threadPool)
+        else:
+            self.prefetchWorkers.append(worker)
+            worker.start(self.prefetchPool)
+        return worker
+
+    def workerDone(self, worker):
+        if worker in self.activeWorkers:
+            self.activeWorkers.remove(worker)
+        if worker in self.prefetchWorkers:
+            self.prefetchWorkers.remove(worker)
+        if worker is self.displayWorker:
+            self.displayWorker = None
+        if worker is self.preloadWorker:
+            self.preloadWorker = None
+        if worker is self.autoLocateWorker:
+            self.autoLocateWorker = None
+            self.autoLocatePushButton.setEnabled(True)
+        if worker is self.previewWorker:
+            self.previewWorker = None
+        if worker is self.resegmentWorker:
+            self.resegmentWorker = None
+            if self.pendingSliderChannels:
+                self.sliderTimer.start()
+        if len(self.activeWorkers) == 0:
+            self.busyBar.hide()
+            self.cancelPushButton.hide()
+
+    def cancelWorker(self, worker):
+        if worker.cancel():
+            self.workerDone(worker)
+
+    def cancelBackgroundWork(self):
+        for worker in self.activeWorkers + self.prefetchWorkers:
+            self.cancelWorker(worker)
+
+    def backgroundFailed(self, message):
+        print(message)
+        QMessageBox.about(self, "Error", message.strip().splitlines()[-1])
+
+    def spanListener(self, name, seconds, peak, depth):
+        # called on whichever thread ran the span, the signal brings it over to the GUI thread
+        if depth == 0:
+            self.spanFinished.emit(name, seconds, peak)
+
+    def showTiming(self, name, seconds, peak):
+        text = f'{name}: {seconds:.2f}s'
+        if peak is not None:
+            text += f', peak memory {peak / 1024 ** 3:.2f} GB'
+        self.timingLabel.setText(text)
+
+    def dapiChannel(self):
+        return nucleus_channel(self.obj_channels.keys())
+
+    def showChannelObjects(self, k, state):
+        # the overlay is gone after the boxes were cleared, and not there yet while auto find runs
+        overlay = self.channelOverlays.get(k)
+        if overlay is not None:
+            overlay.setVisible(state)
+
+    def drawChannelObjects(self, i, k, objs):
+        # filter out super large and super small boxes
+        objs = filter_objects(objs)
+        if k not in self.channelOverlays:
+            self.channelOverlays[k] = ObjectBoxesItem(self.channelColors[i])
+            checkBox = self.channelShowCheckBoxes.get(k)
+            self.channelOverlays[k].setVisible(checkBox is None or checkBox.isChecked())
+            self.viewer.scene.addItem(self.channelOverlays[k])
+        self.channelOverlays[k].setTable(objs)
+        self.objectIndex[k] = GridIndex(table_boxes(objs))
+        return objs
+
+    def fillLocatedObjects(self):
+        dapiChan = self.dapiChannel()
+        objs = self.obj_channels[dapiChan]
+        row = self.locatedObjectsComboBox.currentIndex()
+        if objs is self.objectQueue.table:
+            # the same nuclei when only another channel changed, stay on the current one
+            done = self.objectQueue.done
+            current = self.objectQueue.label(row) if row >= 0 else None
+        else:
+            # new labels, the nuclei already annotated are the ones whose centre is in an annotation
+            x, y = table_centers(objs)
+            annotated = np.zeros(len(objs), dtype=bool)
+            for _, x0, y0, x1, y1 in self.annotations.values():
+                annotated |= (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+            done = objs['label'][annotated].tolist()
+            current = None
+        self.locatedObjectsComboBox.blockSignals(True)
+        self.objectQueue.setObjects(objs, self.nuclei, done, dapiChan)
+        row = self.objectQueue.rowOfLabel(current) if current is not None else 0
+        self.locatedObjectsComboBox.setCurrentIndex(max(row, 0))
+        self.locatedObjectsComboBox.blockSignals(False)
+
+    def sliderMoved(self, name):
+        # re-segment live while the slider is dragged, at most once per timer interval
+        if self.obj_channels is None or name not in self.obj_channels:
+            return
+        self.pendingSliderChannels.add(name)
+        if not self.sliderTimer.isActive():
+            self.sliderTimer.start()
+
+    def resegmentPendingChannels(self):
+        # one re-segmentation at a time, the slider values at the time it is done are picked up after it
+        if self.autoLocateWorker is not None or self.resegmentWorker is not None or not self.pendingSliderChannels:
+            return
+        self.resegmentGeneration += 1
+        generation = self.resegmentGeneration
+        names = sorted(self.pendingSliderChannels)
+        self.pendingSliderChannels = set()
+        self.resegmentWorker = self.runInBackground(
+            resegmentChannels, (self.directory, names, self.getSliderValues(None)),
+            lambda result: self.resegmentFinished(generation, result))
+
+    def resegmentFinished(self, generation, result):
+        # results of thresholds since replaced, or of objects since cleared, are dropped
+        if generation != self.resegmentGeneration or self.obj_channels is None:
+            return
+        tables, self.nuclei = result
+        with span('resegment draw', channels=sorted(tables)):
+            names = list(self.obj_channels.keys())
+            for name, objs in tables.items():
+                self.obj_channels[name] = self.drawChannelObjects(names.index(name), name, objs)
+            # a well without a nuclear channel has no queue, auto find already said so
+            if self.dapiChannel() is not None:
+                self.fillLocatedObjects()
+
+    def snapToObject(self, row):
+        if self.annotationAssistPushButton.isChecked() and 0 <= row < self.objectQueue.rowCount():
+            self.viewer.centerOn(*self.objectQueue.center(row))
+            # have the next cell rendered before it is asked for
+            QtCore.QTimer.singleShot(0, self.prefetchNextObject)
+
+    def prefetchNextObject(self):
+        row = self.locatedObjectsComboBox.currentIndex() + 1
+        if 0 < row < self.objectQueue.rowCount():
+            self.viewer.prefetchAround(*self.objectQueue.center(row))
 
     def startAnnotating(self):
         # add all of the necessary GUI elements for annotating
         self.HBlayout.addWidget(self.annotationGroupBox)
         self.HBlayout.addWidget(self.saveAnnotationPushButton)
+        self.HBlayout.addWidget(self.loadAnnotationPushButton)
         self.HBlayout.addWidget(self.autoLocatePushButton)
+        self.HBlayout.addWidget(self.previewCheckBox)
         self.HBlayout.addWidget(self.removeRectPushbutton)
 
-    def loadImage(self):
+    def resetWell(self):
         # reset the gui for new image
         self.removeAllRects()
+        self.nuclei = None
         self.channelComboBoxWidget.clear()
         self.stopAssistedAnnotation()
-        if self.locatedObjectsComboBox is not None:
-            self.locatedObjectsComboBox.clear()
+        self.objectQueue.clear()
         if len(self.channelGroupBoxes) != 0:
             self.removeChannelGroupBoxes()
+
+    def loadImage(self):
+        self.endSession()
+        self.resetWell()
+        self.annotationStore = None
+        self.savedAnnotations = {}
+        self.wellAnnotations = {}
         # now setup gui with new image
         ret = str(QFileDialog.getExistingDirectory(self, "Select directory containing images for annotation"))
         if ret == '':
@@ -341,22 +1130,142 @@ class Window(QtWidgets.QWidget):
         if not validateDirectoryFormat(ret):
             QMessageBox.about(self, "Error", "Invalid LCL Record Directory")
             return False
-        self.directory = ret
-        self.channels = get_all_paths_and_channels(self.directory)
-        for channel in self.channels.keys():
-            self.channelComboBoxWidget.addItem(channel)
-        if 'Default' in self.channels.keys():
-            self.channelComboBoxWidget.setCurrentText('Default')
-            self.viewer.setPhoto(QtGui.QPixmap(self.channels['Default']))
-        else:
-            channel = list(self.channels.keys())[0]
+        self.openWell(ret)
+
+    def openWell(self, directory):
+        with span('loadImage', well=directory):
+            for worker in self.activeWorkers + self.prefetchWorkers:
+                # a well being preloaded is left to finish, it is the one being opened
+                if worker is not self.preloadWorker or not self.preloading(directory):
+                    self.cancelWorker(worker)
+            self.directory = directory
+            self.channels = get_all_paths_and_channels(self.directory)
+            self.setupCompositeChannels()
+            self.viewer.setPhoto(None)
+            self.channelComboBoxWidget.blockSignals(True)
+            for channel in self.channels.keys():
+                self.channelComboBoxWidget.addItem(channel)
+            if 'Default' in self.channels.keys():
+                channel = 'Default'
+            else:
+                channel = list(self.channels.keys())[0]
             self.channelComboBoxWidget.setCurrentText(channel)
-            self.viewer.setPhoto(QtGui.QPixmap(self.channels[channel]))
-        self.viewer.zoom = 0
-        self.annotateNoneRadioButton.setChecked(True)
-        self.startAnnotating()
-        self.annotateNoneRadioButton.click()
-        self.obj_channels = None
+            self.channelComboBoxWidget.blockSignals(False)
+            self.displayChannel(channel)
+            self.viewer.zoom = 0
+            self.annotateNoneRadioButton.setChecked(True)
+            self.startAnnotating()
+            self.annotateNoneRadioButton.click()
+            self.obj_channels = None
+            self.restoreWellAnnotations(directory)
+
+    def openPlate(self):
+        ret = str(QFileDialog.getExistingDirectory(self, "Select plate directory containing the well directories"))
+        if ret == '':
+            return
+        wells = find_well_directories(ret)
+        if len(wells) == 0:
+            QMessageBox.about(self, "Error", "No LCL Record Directories found")
+            return
+        self.endSession()
+        self.resetWell()
+        self.annotationStore = None
+        self.wellAnnotations = {}
+        self.directory = None
+        self.sessionWells = wells
+        for widget in [self.previousWellPushButton, self.wellLabel, self.nextWellPushButton]:
+            widget.show()
+        self.openSessionWell(0)
+
+    def endSession(self):
+        self.sessionWells = []
+        self.sessionIndex = -1
+        self.sessionThresholds = None
+        self.sessionBitDepths = None
+        self.preloadedWells = {}
+        for widget in [self.previousWellPushButton, self.wellLabel, self.nextWellPushButton]:
+            widget.hide()
+
+    def openSessionWell(self, i):
+        if not 0 <= i < len(self.sessionWells):
+            return
+        # the thresholds set on this well are used on the next one
+        if len(self.channelGroupBoxes) != 0:
+            self.sessionThresholds = self.getSliderValues(None)
+            self.sessionBitDepths = channelBitDepths(self.directory)
+        self.stashWellAnnotations()
+        self.resetWell()
+        self.sessionIndex = i
+        directory = self.sessionWells[i]
+        self.wellLabel.setText(f'{i + 1}/{len(self.sessionWells)}\n{os.path.basename(directory)}')
+        self.previousWellPushButton.setEnabled(i > 0)
+        self.nextWellPushButton.setEnabled(i + 1 < len(self.sessionWells))
+        self.openWell(directory)
+        preloaded = self.preloadedWells.pop(directory, None)
+        if preloaded is not None and sameThresholds(preloaded[1], self.thresholdsFor(directory)):
+            self.autoLocateFinished(preloaded)
+        elif not self.preloading(directory):
+            self.startAutoLocate(self.thresholdsFor(directory))
+        # otherwise wellPreloaded shows the objects once the preload is done
+
+    def thresholdsFor(self, directory):
+        # the session thresholds, or None for the presets if the well's channels have other bit depths
+        if self.sessionThresholds is None or channelBitDepths(directory) != self.sessionBitDepths:
+            return None
+        return self.sessionThresholds
+
+    def preloadNextWell(self, channelThreshValues):
+        if not self.sessionIndex + 1 < len(self.sessionWells):
+            return
+        directory = self.sessionWells[self.sessionIndex + 1]
+        if channelBitDepths(directory) != channelBitDepths(self.directory):
+            channelThreshValues = None
+        # only the next well is kept ready
+        self.preloadedWells = {k: v for k, v in self.preloadedWells.items() if k == directory}
+        if directory in self.preloadedWells or self.preloading(directory):
+            return
+        self.preloadDirectory = directory
+        self.preloadWorker = self.runInBackground(
+            preloadWell, (directory, channelThreshValues, self.tiledCheckBox.isChecked(), self.segmentationWorkers),
+            lambda result: self.wellPreloaded(directory, result), busy=False)
+
+    def preloading(self, directory):
+        return self.preloadWorker is not None and not self.preloadWorker.cancelled and self.preloadDirectory == directory
+
+    def wellPreloaded(self, directory, result):
+        if not self.sessionWells:
+            return
+        if directory != self.directory or self.obj_channels is not None or self.autoLocateWorker is not None:
+            self.preloadedWells[directory] = result
+        elif sameThresholds(result[1], self.thresholdsFor(directory)):
+            # opened while it was still being prepared
+            self.autoLocateFinished(result)
+        else:
+            self.startAutoLocate(self.thresholdsFor(directory))
+
+    def stashWellAnnotations(self):
+        # puts the annotations of the well on screen aside, with the ids they were saved under, and starts empty ones
+        if self.directory is not None:
+            self.wellAnnotations[self.directory] = (self.annotations, self.meta_annotations, self.annotationIndex,
+                                                    self.savedAnnotations)
+        self.annotations = {}
+        self.meta_annotations = {}
+        self.annotationIndex = GridIndex()
+        self.savedAnnotations = {}
+        self.annotationItems = {}
+
+    def restoreWellAnnotations(self, directory):
+        # draws the annotations of a well opened before again, or the ones saved for it in the current store
+        if directory not in self.wellAnnotations:
+            if self.annotationStore is not None:
+                self.addStoredAnnotations(self.annotationStore)
+            return
+        self.annotations, self.meta_annotations, self.annotationIndex, self.savedAnnotations = \
+            self.wellAnnotations.pop(directory)
+        self.annotationItems = {}
+        for key, (annotationType, min_x, min_y, max_x, max_y) in self.annotations.items():
+            self.annotationItems[key] = self.viewer.scene.addRect(
+                QtCore.QRectF(min_x, min_y, max_x - min_x, max_y - min_y), self.annotationPen(annotationType))
 
     def photoClicked(self, pos):
         if self.viewer.dragMode() == QtWidgets.QGraphicsView.NoDrag:
@@ -376,44 +1285,147 @@ class Window(QtWidgets.QWidget):
             max_x = max(pos.x(), self.rect_start[0])
             max_y = max(pos.y(), self.rect_start[1])
 
-            self.viewer.scene.addRect(QtCore.QRectF(min_x, min_y, max_x - min_x, max_y - min_y),
-                                      self.annotation_pen)
+            rect = self.viewer.scene.addRect(QtCore.QRectF(min_x, min_y, max_x - min_x, max_y - min_y),
+                                             self.annotation_pen)
             msgBox = QMessageBox()
 
             msgBox.setInformativeText("Accept Annotation And Move on?")
             msgBox.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
             ret = msgBox.exec_()
             if ret == QMessageBox.No:
-                rect = self.viewer.scene.itemAt(pos, QtGui.QTransform())
                 self.viewer.scene.removeItem(rect)
                 return
 
-            self.annotations.append((self.annotationType, min_x, min_y, max_x, max_y))
+            key = self.annotationIndex.add([min_x, min_y, max_x, max_y])
+            self.annotations[key] = (self.annotationType, min_x, min_y, max_x, max_y)
+            self.annotationItems[key] = rect
 
-            if 'DAPI' in self.obj_channels.keys():
-                dapiChan = 'DAPI'
-            elif 'dapi' in self.obj_channels.keys():
-                dapiChan = 'dapi'
+            dapiChan = self.dapiChannel()
             ul = self.viewer.mapToScene(self.rect().topLeft())
             br = self.viewer.mapToScene(self.rect().bottomRight())
             zoom = self.viewer.zoom
-            idx = self.locatedObjectsComboBox.currentIndex()
-            obj = self.obj_channels[dapiChan][idx]
-
-            self.locatedObjectsComboBox.removeItem(idx)
-            self.meta_annotations.append((zoom, [int(i) for i in [ul.x(), ul.y(), br.x(), br.y()]],
-                                              [(obj[1].stop - obj[1].start) * (obj[0].stop - obj[0].start)]))
+            meta_box = [int(i) for i in [ul.x(), ul.y(), br.x(), br.y()]]
+            # the nucleus the drawn box belongs to, by location, is done with. there is none to match in a well
+            # without nuclei, or once the boxes were cleared
+            index = self.objectIndex.get(dapiChan)
+            match = index.best_match(min_x, min_y, max_x, max_y) if index is not None else None
+            if match is None:
+                self.meta_annotations[key] = (zoom, meta_box, None, None)
+            else:
+                obj = self.obj_channels[dapiChan][match]
+                self.objectQueue.markDone(int(obj['label']))
+                self.meta_annotations[key] = (zoom, meta_box, [int(obj['bbox_area'])], int(obj['label']))
         elif self.deletingAnnotations:
             self.deleteAnnotation(pos)
         print('annotations:', self.annotations)
         print('meta annotations:', self.meta_annotations)
 
+    def showChannel(self, channel, channel_change=False):
+        with span('showChannel', channel=channel):
+            if self.tiledCheckBox.isChecked():
+                self.viewer.setPyramid(channelPyramid(self.channels[channel]), channel_change)
+            else:
+                self.viewer.setPhoto(channelPixmap(self.channels[channel]), channel_change)
+
+    def displayChannel(self, channel, channel_change=False):
+        # shows the channel straight away if it is already decoded, otherwise decodes it in the background first
+        if self.compositeCheckBox.isChecked():
+            self.displayComposite(channel_change)
+            return
+        path = self.channels[channel]
+        tiled = self.tiledCheckBox.isChecked()
+        if self.displayWorker is not None:
+            self.cancelWorker(self.displayWorker)
+        if channel_cache.contains(path, 'pyramid' if tiled else 'pixmap'):
+            self.channelReady(channel, channel_change)
+        else:
+            self.displayWorker = self.runInBackground(prepareChannel, (path, tiled),
+                                                      lambda _: self.channelReady(channel, channel_change))
+
+    def channelReady(self, channel, channel_change):
+        if channel != self.channelComboBoxWidget.currentText():
+            return
+        tf = self.viewer.transform()
+        self.showChannel(channel, channel_change)
+        if channel_change:
+            self.viewer.setTransform(tf)
+        self.prefetchChannels()
+
+    def prefetchChannels(self):
+        # decode the well's other channels on the prefetch thread so switching to them is instant
+        tiled = self.tiledCheckBox.isChecked()
+        pending = [worker.args[0] for worker in self.prefetchWorkers]
+        for path in self.channels.values():
+            if path not in pending and not channel_cache.contains(path, 'pyramid' if tiled else 'array'):
+                self.runInBackground(prepareChannel, (path, tiled), lambda _: None, busy=False)
+
     def changeChannel(self, channel):
         if channel == '':
             return
+        with span('changeChannel', channel=channel):
+            self.displayChannel(channel, True)
+
+    def toggleTiledRendering(self, _):
+        self.changeChannel(self.channelComboBoxWidget.currentText())
+
+    def toggleComposite(self, state):
+        self.compositeGroupBox.setVisible(state)
+        self.changeChannel(self.channelComboBoxWidget.currentText())
+
+    def setupCompositeChannels(self):
+        # a toggle for every channel of the well, the fluorescence channels start switched on
+        for checkBox in self.compositeCheckBoxes.values():
+            self.compositeGroupBoxLayout.removeWidget(checkBox)
+            sip.delete(checkBox)
+        self.compositeCheckBoxes = {}
+        for i, name in enumerate(self.channels):
+            checkBox = QtWidgets.QCheckBox(name)
+            checkBox.setChecked(name != 'Default')
+            checkBox.toggled.connect(self.updateComposite)
+            self.compositeGroupBoxLayout.insertWidget(i, checkBox)
+            self.compositeCheckBoxes[name] = checkBox
+
+    def compositeLuts(self):
+        brightness = self.brightnessSlider.value()
+        contrast = self.contrastSlider.value() / 100
+        luts = []
+        for i, name in enumerate(self.channels):
+            color = compositeColors.get(name, otherCompositeColors[i % len(otherCompositeColors)])
+            if not self.compositeCheckBoxes[name].isChecked():
+                color = (0, 0, 0)
+            luts.append(channel_lut(color, brightness, contrast))
+        return luts
+
+    def displayComposite(self, channel_change=False):
+        # like displayChannel, the display buffers of every channel are built in the background the first time
+        paths = list(self.channels.values())
+        if self.displayWorker is not None:
+            self.cancelWorker(self.displayWorker)
+        if all(channel_cache.contains(path, 'stretched_pyramid') for path in paths):
+            self.compositeReady(channel_change)
+        else:
+            self.displayWorker = self.runInBackground(prepareComposite, (paths,),
+                                                      lambda _: self.compositeReady(channel_change))
+
+    def compositeReady(self, channel_change):
+        if not self.compositeCheckBox.isChecked():
+            return
         tf = self.viewer.transform()
-        self.viewer.setPhoto(QtGui.QPixmap(os.path.join(self.channels[channel])), True)
-        self.viewer.setTransform(tf)
+        with span('showComposite'):
+            pyramids = [channelStretchedPyramid(path) for path in self.channels.values()]
+            self.viewer.setPyramid(CompositePyramid(pyramids, self.compositeLuts()), channel_change)
+        if channel_change:
+            self.viewer.setTransform(tf)
+
+    def updateComposite(self):
+        # only the lookup tables change, the tiles in view are blended again from the display buffers
+        if self.compositeCheckBox.isChecked() and self.directory is not None:
+            self.displayComposite(True)
+
+    def annotationPen(self, annotationType):
+        if annotationType == 'Positive':
+            return QtGui.QPen(QtGui.QColor(254, 211, 48), 4, QtCore.Qt.SolidLine)
+        return QtGui.QPen(QtGui.QColor(165, 94, 234), 4, QtCore.Qt.SolidLine)
 
     def annotateNone(self):
         self.viewer.toggleDragMode(True)
@@ -425,14 +1437,14 @@ class Window(QtWidgets.QWidget):
     def annotatePositive(self):
         self.viewer.toggleDragMode(False)
         self.deletingAnnotations = False
-        self.annotation_pen = QtGui.QPen(QtGui.QColor(254, 211, 48), 4, QtCore.Qt.SolidLine)
+        self.annotation_pen = self.annotationPen('Positive')
         self.annotationType = 'Positive'
         print('annotating positive')
 
     def annotateNegative(self):
         self.viewer.toggleDragMode(False)
         self.deletingAnnotations = False
-        self.annotation_pen = QtGui.QPen(QtGui.QColor(165, 94, 234), 4, QtCore.Qt.SolidLine)
+        self.annotation_pen = self.annotationPen('Negative')
         self.annotationType = 'Negative'
         print('annotating negative')
 
@@ -443,12 +1455,31 @@ class Window(QtWidgets.QWidget):
         self.annotationType = 'None'
         print('deleting annotation')
 
+    def clearOverlays(self):
+        # only the detected object boxes, the user's annotation rectangles stay
+        self.clearPreview()
+        for overlay in self.channelOverlays.values():
+            self.viewer.scene.removeItem(overlay)
+        self.channelOverlays = {}
+        self.objectIndex = {}
+        # a re-segmentation still running is of the objects just cleared
+        self.resegmentGeneration += 1
+        self.pendingSliderChannels = set()
+
+    def resetAnnotations(self):
+        # annotations, their meta annotations and rectangles are keyed by their id in the annotation index. ids are
+        # never reused, so a new annotation can't be mistaken for one that was already saved
+        for key in self.annotations:
+            self.annotationIndex.remove(key)
+        self.annotations = {}
+        self.meta_annotations = {}
+        self.annotationItems = {}
+
     def removeAllRects(self):
-        # TODO: make this only remove non-annotation rectangles
-        self.annotations = []
-        self.meta_annotations = []
+        self.resetAnnotations()
+        self.clearOverlays()
         for item in self.viewer.scene.items():
-            if item.type() == 3:
+            if isinstance(item, QtWidgets.QGraphicsRectItem):
                 self.viewer.scene.removeItem(item)
 
     def removeChannelGroupBoxes(self):
@@ -459,67 +1490,115 @@ class Window(QtWidgets.QWidget):
                 sip.delete(groupBox)
                 groupBox = None
                 self.channelGroupBoxes = []
+            self.channelShowCheckBoxes = {}
             self.HBlayout.removeWidget(self.autoAnnotatePushbutton)
             self.HBlayout.removeWidget(self.annotationAssistPushButton)
             self.HBlayout.removeWidget(self.locatedObjectsComboBox)
+            self.HBlayout.removeWidget(self.queueSamplingComboBox)
+            self.HBlayout.removeWidget(self.queueOrderComboBox)
 
     def deleteAnnotation(self, pos):
-        rect = self.viewer.scene.itemAt(pos, QtGui.QTransform())
-        if type(rect) != QtWidgets.QGraphicsPixmapItem:
-            if len(self.annotations) == len(self.meta_annotations):
-                for i, annotation in enumerate(self.annotations):
-                    if annotation[1] < pos.x() < annotation[3] and annotation[2] < pos.y() < annotation[4]:
-                        self.annotations.remove(annotation)
-                        print('deleting:', annotation)
-                        print('and meta annotation:', self.meta_annotations.pop(i))
-            else:
-                for annotation in self.annotations:
-                    if annotation[1] < pos.x() < annotation[3] and annotation[2] < pos.y() < annotation[4]:
-                        self.annotations.remove(annotation)
-                        print('deleting:', annotation)
-            self.viewer.scene.removeItem(rect)
+        for key in self.annotationIndex.query_point(pos.x(), pos.y()).tolist():
+            self.annotationIndex.remove(key)
+            self.viewer.scene.removeItem(self.annotationItems.pop(key))
+            print('deleting:', self.annotations.pop(key))
+            print('and meta annotation:', self.meta_annotations.pop(key))
 
     def saveAnnotations(self):
-        fileName, _ = QFileDialog.getSaveFileName(self, "Enter location to save annotations", "", "Pickle files (*.p)")
-        if fileName[-2:] != '.p':
-            fileName += '.p'
-        print('saving annotations...', fileName)
-        # build a pickle that has a list of tuples of form ([annotation type], [channel list],
-        # [annotation array of shape (x, y, channels)], zoom level, [meta_annotation array of shape (x, y, channels)])
-        save_list = []
-
-        for annotation, meta_annotation in zip(self.annotations, self.meta_annotations):
-            temp_tuple = (annotation[0], list(self.channels.keys()))
-            # Qt and numpy change X and Y...
-            annotation_array = np.zeros((annotation[4] - annotation[2],
-                                         annotation[3] - annotation[1],
-                                         len(self.channels.keys())))
-            # switching this here to get the actual array
-            meta_annotation = meta_annotation[1]
-            meta_annotation_array = np.zeros((meta_annotation[3] - meta_annotation[1],
-                                              meta_annotation[2] - meta_annotation[0],
-                                              len(self.channels.keys())))
-            for i, channel in enumerate(self.channels.keys()):
-                img = np.array(Image.open(self.channels[channel]))
-                annotation_array[:, :, i] = img[annotation[2]:annotation[4], annotation[1]:annotation[3]]
-                meta_annotation_array[:, :, i] = img[meta_annotation[1]:meta_annotation[3],
-                                                 meta_annotation[0]:meta_annotation[2]]
-            temp_tuple += (annotation_array, meta_annotation_array, self.viewer.zoom)
-            save_list.append(temp_tuple)
-        pickle.dump(save_list, open(fileName, 'wb'))
+        if self.annotationStore is None:
+            fileName, _ = QFileDialog.getSaveFileName(self, "Enter location to save annotations", "",
+                                                      "Annotation stores (*.lcl)")
+            if fileName == '':
+                return
+            if fileName[-4:] != '.lcl':
+                fileName += '.lcl'
+            self.annotationStore = AnnotationStore(fileName)
+            # nothing is in the new store yet, of this well or the others of the session
+            self.savedAnnotations.clear()
+            for _, _, _, savedAnnotations in self.wellAnnotations.values():
+                savedAnnotations.clear()
+        print('saving annotations...', self.annotationStore.path)
+        with span('saveAnnotations'):
+            self.saveWellAnnotations(self.directory, self.channels, self.annotations, self.meta_annotations,
+                                     self.savedAnnotations)
+            for directory, (annotations, meta_annotations, _, savedAnnotations) in self.wellAnnotations.items():
+                self.saveWellAnnotations(directory, get_all_paths_and_channels(directory), annotations,
+                                         meta_annotations, savedAnnotations)
         print('done')
 
-    def loadAnnotations(self):
-        print('loading annotations...')
-        # TODO: finish implementing this
-        # fileName, _ = QFileDialog.getSaveFileName(self, "Enter location to load annotations", "", "Pickle files (*.p)")
-        # data = pickle.load(open(fileName, 'rb'))
-        # for annotation in data:
-        #     x, y = annotation[2].shape[1], annotation[2].shape[0]
-        #     if annotation[0] == 'Positive':
-        #
-        #     elif annotation[0] == 'Negative'
+    def saveWellAnnotations(self, directory, channels, annotations, meta_annotations, savedAnnotations):
+        # only what changed since the last save is written: crops of new annotations are appended to the store and
+        # deleted ones are marked as such
+        deleted = [key for key in savedAnnotations if key not in annotations]
+        self.annotationStore.delete([savedAnnotations.pop(key) for key in deleted])
+        keys = [key for key in annotations if key not in savedAnnotations]
+        if len(keys) == 0:
+            return
+        boxes = [annotations[key][1:5] for key in keys]
+        boxes += [meta_annotations[key][1] for key in keys]
+
+        progress = QtWidgets.QProgressDialog('Saving annotations...', None, 0, len(channels), self)
+        progress.setWindowModality(QtCore.Qt.WindowModal)
+        progress.setMinimumDuration(0)
+
+        def updateProgress(done, total):
+            progress.setValue(done)
+            QtWidgets.QApplication.processEvents()
+
+        # each channel is only decoded once, and every crop is cut out of it at the same time
+        crops = extract_crops(list(channels.values()), boxes, updateProgress)
+        progress.close()
+        new = []
+        for i, key in enumerate(keys):
+            annotation, meta_annotation = annotations[key], meta_annotations[key]
+            new.append({'type': annotation[0], 'channels': list(channels.keys()),
+                        'box': [int(v) for v in annotation[1:5]], 'zoom': meta_annotation[0],
+                        'meta_box': meta_annotation[1], 'meta_area': meta_annotation[2],
+                        'object_label': meta_annotation[3], 'well': os.path.abspath(directory),
+                        'crop': crops[i], 'meta_crop': crops[len(keys) + i]})
+        for key, i in zip(keys, self.annotationStore.append(new)):
+            savedAnnotations[key] = i
 
+    def loadAnnotations(self):
+        # redraws the saved annotations of this well from the store's metadata, none of the crops are read. an old
+        # pickle is converted to a store next to it first, it has no box positions so there is nothing to draw
+        if self.directory is None:
+            QMessageBox.about(self, "Error", "Please open an image directory before loading annotations")
+            return
+        fileName, _ = QFileDialog.getOpenFileName(self, "Select annotations to load", "",
+                                                  "Annotations (index.jsonl *.p)")
+        if fileName == '':
+            return
+        print('loading annotations...', fileName)
+        with span('loadAnnotations'):
+            if fileName[-2:] == '.p':
+                store = import_pickle(fileName)
+            else:
+                store = AnnotationStore(os.path.dirname(fileName))
+            for item in self.annotationItems.values():
+                self.viewer.scene.removeItem(item)
+            self.resetAnnotations()
+            self.annotationStore = store
+            self.savedAnnotations = {}
+            # the other wells of the session are read from the new store when they are opened again
+            self.wellAnnotations = {}
+            self.addStoredAnnotations(store)
+            print('loaded', len(self.annotations), 'annotations')
+
+    def addStoredAnnotations(self, store):
+        # draws the annotations of this well saved in the store and notes their ids
+        well = os.path.abspath(self.directory)
+        for i, record in store.records().items():
+            if record['box'] is None or record['well'] not in [None, well]:
+                continue
+            min_x, min_y, max_x, max_y = record['box']
+            key = self.annotationIndex.add(record['box'])
+            self.annotations[key] = (record['type'], min_x, min_y, max_x, max_y)
+            self.meta_annotations[key] = (record['zoom'], record['meta_box'], record['meta_area'],
+                                          record['object_label'])
+            self.annotationItems[key] = self.viewer.scene.addRect(
+                QtCore.QRectF(min_x, min_y, max_x - min_x, max_y - min_y), self.annotationPen(record['type']))
+            self.savedAnnotations[key] = i
 
 if __name__ == '__main__':
     app = QtWidgets.QApplication(sys.argv)
@@ -0,0 +1,187 @@
+'''
+times the annotator's heavy paths on synthetic wells at several scales and writes the results as JSON, e.g.
+
+    python benchmarks/run_benchmarks.py --sizes 2000 6000 --bit-depths 8 16 --output before.json
+    python benchmarks/run_benchmarks.py --sizes 2000 6000 --bit-depths 8 16 --output after.json --compare before.json
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_well import generate_well
+from image_cache import channel_cache, read_image
+from annotation_store import AnnotationStore
+from rawstore import convert_well, RAW_DIRECTORY
+from utils import get_obj_channels, get_obj_channel_paths, get_all_paths_and_channels, threshold_engine, \
+    verify_backends, SEGMENTATION_BACKENDS, extract_crops, filter_objects, table_boxes, get_objs_tiled, read_gray, \
+    coarse_objects
+
+
+def timed(fn, repeat, setup=None):
+    '''
+    runs setup() then fn() repeat times and returns the fastest and median seconds of fn and its last result
+    '''
+    times = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times)), result
+
+
+def well_directory(data_dir, size, density, bit_depth, seed):
+    # wells are only generated once per set of parameters, the generator is seeded so they are always the same
+    d = os.path.join(data_dir, f'well_{size}_{density:g}_{bit_depth}bit_{seed}', 'A1')
+    if not os.path.exists(os.path.join(d, 'meta.yml')):
+        generate_well(d, size, density, bit_depth, seed=seed)
+    return d
+
+
+def bench_well(d, repeat, n_annotations):
+    results = {}
+    paths = list(get_all_paths_and_channels(d).values())
+    channel_paths = get_obj_channel_paths(d)
+
+    results['load'] = timed(lambda: [read_image(p) for p in paths], repeat)[:2] + (None,)
+    results['segment_cold'] = timed(lambda: get_obj_channels(d, as_table=True), repeat, channel_cache.clear)
+    obj_channels, thresholds = results['segment_cold'][2]
+    results['segment_cold'] = results['segment_cold'][:2] + ({k: len(v) for k, v in obj_channels.items()},)
+    results['segment_warm'] = timed(lambda: get_obj_channels(d, thresholds, as_table=True), repeat)[:2] + (None,)
+
+    dapi = threshold_engine(channel_paths['DAPI'])
+    steps = [thresholds['DAPI'] + i for i in range(1, 11)]
+    # ten slider steps on a warm engine
+    results['rethreshold_10_steps'] = timed(lambda: [dapi.table(t) for t in steps], repeat,
+                                            lambda: dapi._results.clear())[:2] + (None,)
+    for backend, (same, _) in verify_backends(dapi.img, thresholds['DAPI']).items():
+        segment = SEGMENTATION_BACKENDS[backend]
+        results['backend_' + backend] = timed(lambda: segment(dapi.img, thresholds['DAPI']), repeat)[:2] + (same,)
+    img = read_gray(channel_paths['DAPI'])
+    results['tiled_1024'] = timed(lambda: get_objs_tiled(img, thresholds['DAPI'], 1024), repeat)[:2] + (None,)
+    # the boxes Auto Find shows before the full resolution objects are in
+    results['coarse_preview'] = timed(lambda: len(coarse_objects(dapi.img, thresholds['DAPI'])), repeat)
+
+    results['overlay'] = bench_overlay(obj_channels, img.shape, repeat)
+
+    # annotations around the first nuclei, and meta annotations of ten times their size around them
+    boxes = table_boxes(filter_objects(obj_channels['DAPI']))[:n_annotations].tolist()
+    meta = [[x0 - 5 * (x1 - x0), y0 - 5 * (y1 - y0), x1 + 5 * (x1 - x0), y1 + 5 * (y1 - y0)] for x0, y0, x1, y1 in boxes]
+    store_dir = tempfile.mkdtemp(suffix='.lcl')
+
+    def export():
+        shutil.rmtree(store_dir, ignore_errors=True)
+        crops = extract_crops(paths, boxes + meta)
+        store = AnnotationStore(store_dir)
+        store.append([{'type': 'Positive', 'channels': list(range(len(paths))), 'box': box, 'zoom': 0,
+                       'meta_box': meta_box, 'crop': crops[i], 'meta_crop': crops[len(boxes) + i]}
+                      for i, (box, meta_box) in enumerate(zip(boxes, meta))])
+        return len(boxes)
+
+    results['crop_export'] = timed(export, repeat)
+    results['annotation_load'] = timed(lambda: len(AnnotationStore(store_dir).metadata_table()), repeat)
+
+    # the same crops read from the well's raw store instead of decoded, it is removed again so the next run decodes
+    results['raw_convert'] = timed(lambda: len(convert_well(d, overwrite=True)['channels']), repeat)
+    results['crop_export_raw'] = timed(export, repeat, channel_cache.clear)
+    shutil.rmtree(os.path.join(d, RAW_DIRECTORY), ignore_errors=True)
+    shutil.rmtree(store_dir, ignore_errors=True)
+    channel_cache.clear()
+    return results
+
+
+def bench_overlay(obj_channels, shape, repeat):
+    '''
+    times putting every channel's boxes in a scene and rendering it offscreen, zoomed to fit and at full resolution
+    '''
+    from PyQt5 import QtCore, QtGui, QtWidgets
+    from annotator import ObjectBoxesItem
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    colors = [QtGui.QColor(255, 0, 0), QtGui.QColor(0, 255, 0), QtGui.QColor(0, 0, 255)]
+
+    def draw():
+        scene = QtWidgets.QGraphicsScene()
+        for i, objs in enumerate(obj_channels.values()):
+            item = ObjectBoxesItem(colors[i % len(colors)])
+            item.setTable(filter_objects(objs))
+            scene.addItem(item)
+        for target, source in [(QtCore.QRectF(0, 0, 1000, 1000), QtCore.QRectF(0, 0, shape[1], shape[0])),
+                               (QtCore.QRectF(0, 0, 1000, 1000), QtCore.QRectF(0, 0, 1000, 1000))]:
+            image = QtGui.QImage(1000, 1000, QtGui.QImage.Format_RGB32)
+            painter = QtGui.QPainter(image)
+            scene.render(painter, target, source)
+            painter.end()
+        app.processEvents()
+        return sum(len(objs) for objs in obj_channels.values())
+
+    return timed(draw, repeat)
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(baseline, results):
+    '''
+    prints how each benchmark changed against a baseline results file
+    '''
+    old = {(r['size'], r['bit_depth'], r['density'], r['benchmark']): r['seconds_min'] for r in baseline['results']}
+    print(f'{"benchmark":<28}{"size":>7}{"bits":>5}{"before":>10}{"after":>10}{"ratio":>8}')
+    for r in results['results']:
+        before = old.get((r['size'], r['bit_depth'], r['density'], r['benchmark']))
+        if before is None:
+            continue
+        print(f'{r["benchmark"]:<28}{r["size"]:>7}{r["bit_depth"]:>5}{before:>10.4f}{r["seconds_min"]:>10.4f}'
+              f'{r["seconds_min"] / max(before, 1e-9):>8.2f}')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the annotator on synthetic wells.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 4000])
+    parser.add_argument('--bit-depths', type=int, nargs='+', default=[8, 16])
+    parser.add_argument('--density', type=float, default=5e-5, help='Nuclei per pixel.')
+    parser.add_argument('--annotations', type=int, default=200, help='Annotations to export and load.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'lcl_benchmarks'),
+                        help='Where the synthetic wells are generated, they are reused between runs.')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None, help='Results file of an earlier run to compare against.')
+    args = parser.parse_args(args)
+
+    results = {'environment': environment(), 'results': []}
+    for size in args.sizes:
+        for bit_depth in args.bit_depths:
+            d = well_directory(args.data_dir, size, args.density, bit_depth, args.seed)
+            for name, (fastest, median, extra) in bench_well(d, args.repeat, args.annotations).items():
+                results['results'].append({'size': size, 'bit_depth': bit_depth, 'density': args.density,
+                                           'benchmark': name, 'seconds_min': fastest, 'seconds_median': median,
+                                           'repeat': args.repeat, 'info': extra})
+                print(f'{size} {bit_depth}bit {name}: {fastest:.4f}s (median {median:.4f}s)')
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1, default=lambda o: o.item())
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
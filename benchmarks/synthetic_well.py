@@ -0,0 +1,54 @@
+import argparse
+import os
+import cv2
+import numpy as np
+
+CHANNELS = ['Default', 'DAPI', '488', '647']
+
+
+def generate_well(directory, size=2000, density=5e-5, bit_depth=8, positive_fraction=0.3, seed=0,
+                  name='A1__202103011200'):
+    '''
+    writes a synthetic well record into directory: one tif per channel named <name>-<channel>.tif, the way
+    get_all_paths_and_channels and get_obj_channel_paths expect, and a meta.yml. the DAPI channel has about
+    density * size ** 2 nuclei, positive_fraction of which also have a cell in the 488 and/or 647 channels, on a noisy
+    background. returns the channel paths
+    '''
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    dtype = np.uint8 if bit_depth <= 8 else np.uint16
+    scale = (2 ** bit_depth - 1) / 255
+    n = int(density * size * size)
+    centres = rng.integers(10, size - 10, (n, 2))
+    radii = rng.integers(3, 9, n)
+    positive = {'488': rng.random(n) < positive_fraction, '647': rng.random(n) < positive_fraction}
+    paths = {}
+    for channel in CHANNELS:
+        img = (rng.integers(0, 30, (size, size)) * scale).astype(dtype)
+        for i, ((y, x), r) in enumerate(zip(centres.tolist(), radii.tolist())):
+            if channel == 'Default':
+                # brightfield, every cell shows up dimly
+                value, radius = rng.integers(40, 80), r + 3
+            elif channel == 'DAPI':
+                value, radius = rng.integers(120, 255), r
+            elif positive[channel][i]:
+                value, radius = rng.integers(120, 255), r + int(rng.integers(1, 4))
+            else:
+                continue
+            cv2.circle(img, (x, y), int(radius), int(value * scale), -1)
+        paths[channel] = os.path.join(directory, f'{name}-{channel}.tif')
+        cv2.imwrite(paths[channel], img)
+    with open(os.path.join(directory, 'meta.yml'), 'w') as f:
+        f.write(f'synthetic: true\nsize: {size}\ndensity: {density}\nbit_depth: {bit_depth}\nseed: {seed}\n')
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes a synthetic well record for benchmarking.')
+    parser.add_argument('directory')
+    parser.add_argument('--size', type=int, default=2000, help='Width and height of the channel images.')
+    parser.add_argument('--density', type=float, default=5e-5, help='Nuclei per pixel.')
+    parser.add_argument('--bit-depth', type=int, default=8, choices=[8, 12, 16])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_well(args.directory, args.size, args.density, args.bit_depth, seed=args.seed)
@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from annotation_store import AnnotationStore
+from image_cache import read_image
+from instrumentation import traced
+from manifest import well_manifest
+from utils import find_well_directories, get_all_paths_and_channels, get_obj_channel_paths, load_well_detections, \
+    nucleus_channel, segment_channel, filter_objects, table_boxes, table_centers, crop_into, crops_into
+
+INDEX_FILE = 'index.npy'
+META_FILE = 'meta.json'
+SHARD_DIRECTORY = 'shards'
+
+# one row per exported crop. well is the position of the well in the dataset's well list, object the nucleus label,
+# shard and offset where the crop is: the row of a fixed size shard, or the first element of it in a flat shard.
+# annotation is the type of the human annotation around the nucleus, if there is one
+INDEX_DTYPE = np.dtype([('well', np.int32), ('object', np.int32), ('x0', np.int32), ('y0', np.int32),
+                        ('x1', np.int32), ('y1', np.int32), ('shard', np.int32), ('offset', np.int64),
+                        ('height', np.int32), ('width', np.int32), ('annotation', 'U16')])
+
+
+def shard_name(well, shard):
+    return os.path.join(SHARD_DIRECTORY, f'well{well:05d}_{shard:03d}.npy')
+
+
+def well_objects(d, channelThreshValues=None):
+    '''
+    returns the object table of the nuclei of a well without the super small and super large ones, from its stored
+    detections when they match channelThreshValues, or None if it has no nuclear channel
+    '''
+    paths = get_obj_channel_paths(d)
+    nucleus = nucleus_channel(paths)
+    if nucleus is None:
+        return None
+    cached = load_well_detections(d, channelThreshValues)
+    if cached is not None:
+        table = cached[0][nucleus]
+    else:
+        thresh_val = channelThreshValues.get(nucleus) if channelThreshValues is not None else None
+        table, _ = segment_channel(paths[nucleus], thresh_val, intensity_paths={})
+    return filter_objects(table)
+
+
+@traced()
+def export_well(d, well, output, channels, dtype, crop_size=None, padding=0, channelThreshValues=None,
+                shard_size=4096, annotations=()):
+    '''
+    cuts a crop of every nucleus of a well out of the given channels into memory mapped shards below output, and
+    returns the index rows of the crops and the number of shards. crops are crop_size squares around the nuclei's
+    centres, or their bounding boxes grown by padding on every side when crop_size is None. the channels are decoded
+    one at a time and every crop is written straight into its shard
+    '''
+    objs = well_objects(d, channelThreshValues)
+    if objs is None or len(objs) == 0:
+        return np.zeros(0, dtype=INDEX_DTYPE), 0
+    if crop_size is not None:
+        x, y = table_centers(objs)
+        boxes = np.stack([x - crop_size // 2, y - crop_size // 2, x - crop_size // 2 + crop_size,
+                          y - crop_size // 2 + crop_size], axis=1)
+    else:
+        boxes = table_boxes(objs) + np.array([-padding, -padding, padding, padding])
+    index = np.zeros(len(objs), dtype=INDEX_DTYPE)
+    index['well'] = well
+    index['object'] = objs['label']
+    for i, k in enumerate(['x0', 'y0', 'x1', 'y1']):
+        index[k] = boxes[:, i]
+    index['height'] = index['y1'] - index['y0']
+    index['width'] = index['x1'] - index['x0']
+    # an object is annotated if its centre is in an annotation box, like the assisted annotation queue has it
+    x, y = table_centers(objs)
+    for annotationType, (x0, y0, x1, y1) in annotations:
+        index['annotation'][(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)] = annotationType
+
+    shards = []
+    for shard, start in enumerate(range(0, len(index), shard_size)):
+        rows = index[start:start + shard_size]
+        rows['shard'] = shard
+        if crop_size is not None:
+            rows['offset'] = np.arange(len(rows))
+            shape = (len(rows), crop_size, crop_size, len(channels))
+        else:
+            sizes = rows['height'].astype(np.int64) * rows['width'] * len(channels)
+            rows['offset'] = np.cumsum(sizes) - sizes
+            shape = (int(sizes.sum()),)
+        shards.append(np.lib.format.open_memmap(os.path.join(output, shard_name(well, shard)), mode='w+',
+                                                dtype=dtype, shape=shape))
+
+    paths = get_all_paths_and_channels(d)
+    if crop_size is not None:
+        # a shard's crops are copied out of each channel together
+        for c, name in enumerate(channels):
+            img = read_image(paths[name])
+            for shard, data in enumerate(shards):
+                rows = slice(shard * shard_size, shard * shard_size + len(data))
+                crops_into(data[..., c], img, boxes[rows, 0], boxes[rows, 1])
+            del img
+    else:
+        # the view of every crop in its shard is found once, not again for every channel
+        views = [shards[row['shard']][row['offset']:row['offset'] + row['height'] * row['width'] * len(channels)]
+                 .reshape(row['height'], row['width'], len(channels)) for row in index]
+        for c, name in enumerate(channels):
+            img = read_image(paths[name])
+            for view, box in zip(views, boxes):
+                crop_into(view[..., c], img, box)
+            del img
+    for data in shards:
+        data.flush()
+    return index, len(shards)
+
+
+def export_crops(wells, output, crop_size=None, padding=0, channelThreshValues=None, workers=None, shard_size=4096,
+                 annotation_store=None, channels=None):
+    '''
+    exports a crop of every nucleus of the wells into a dataset directory (see export_well), one well per process at a
+    time, and returns it as a CropDataset. channels default to those of the first well, wells without all of them are
+    skipped. the crops keep the widest native dtype of the channels. with annotation_store the human annotations saved
+    in it label the nuclei they were drawn around
+    '''
+    if len(wells) == 0:
+        raise ValueError('no wells to export')
+    if channels is None:
+        channels = list(get_all_paths_and_channels(wells[0]))
+    usable, dtypes = [], []
+    for d in wells:
+        manifest = well_manifest(d)['channels']
+        if all(name in manifest for name in channels):
+            usable.append(os.path.abspath(d))
+            dtypes += [manifest[name]['dtype'] or 'uint8' for name in channels]
+        else:
+            print('skipping, not every channel:', d)
+    dtype = np.result_type(*dtypes) if dtypes else np.uint8
+    annotations = {d: [] for d in usable}
+    if annotation_store is not None:
+        for record in AnnotationStore(annotation_store).records().values():
+            # stores from before annotations knew their well only work for a single well, like in the annotator
+            well = record.get('well') or (usable[0] if len(usable) == 1 else None)
+            if record['box'] is not None and well in annotations:
+                annotations[well].append((record['type'], record['box']))
+
+    os.makedirs(os.path.join(output, SHARD_DIRECTORY), exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(export_well, d, i, output, channels, dtype, crop_size, padding, channelThreshValues,
+                               shard_size, annotations[d]) for i, d in enumerate(usable)]
+        results = [future.result() for future in futures]
+    np.save(os.path.join(output, INDEX_FILE), np.concatenate([index for index, _ in results]
+                                                             or [np.zeros(0, dtype=INDEX_DTYPE)]))
+    with open(os.path.join(output, META_FILE), 'w') as f:
+        json.dump({'wells': usable, 'shards': [n for _, n in results], 'channels': channels,
+                   'dtype': np.dtype(dtype).str, 'crop_size': crop_size, 'padding': padding}, f, indent=1)
+    return CropDataset(output)
+
+
+class CropDataset:
+    '''
+    an exported crop dataset, read without loading it: the index is memory mapped, and so is every shard the first
+    time a crop in it is read
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.index = np.load(os.path.join(path, INDEX_FILE), mmap_mode='r')
+        self.channels = self.meta['channels']
+        self.wells = self.meta['wells']
+        self.crop_size = self.meta['crop_size']
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def shard(self, well, shard):
+        key = (int(well), int(shard))
+        if key not in self._shards:
+            self._shards[key] = np.load(os.path.join(self.path, shard_name(*key)), mmap_mode='r')
+        return self._shards[key]
+
+    def crop(self, i):
+        '''
+        returns crop i as a (y, x, channels) view of its shard
+        '''
+        row = self.index[i]
+        data = self.shard(row['well'], row['shard'])
+        if self.crop_size is not None:
+            return data[row['offset']]
+        size = int(row['height']) * int(row['width']) * len(self.channels)
+        return data[row['offset']:row['offset'] + size].reshape(row['height'], row['width'], len(self.channels))
+
+    def batches(self, batch_size=256):
+        '''
+        yields the crops in (index rows, crops) batches of up to batch_size from one shard at a time. fixed size crops
+        come as one (n, y, x, channels) view of their shard, others as a list of views
+        '''
+        i = 0
+        while i < len(self.index):
+            j = min(i + batch_size, len(self.index))
+            rows = self.index[i:j]
+            # a batch does not cross shards
+            same = (rows['well'] == rows['well'][0]) & (rows['shard'] == rows['shard'][0])
+            j = i + (len(rows) if same.all() else int(np.argmin(same)))
+            rows = self.index[i:j]
+            if self.crop_size is not None:
+                data = self.shard(rows['well'][0], rows['shard'][0])
+                yield rows, data[rows['offset'][0]:rows['offset'][-1] + 1]
+            else:
+                yield rows, [self.crop(k) for k in range(i, j)]
+            i = j
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Exports a crop of every nucleus auto find detects in the well '
+                                                 'directories below the given directory as a sharded dataset.')
+    parser.add_argument('directory', help='Plate or experiment directory containing the well directories.')
+    parser.add_argument('output', help='Directory the dataset is written to.')
+    parser.add_argument('--size', type=int, default=None,
+                        help='Side of the square crops around the nuclei. By default the crops are the nuclei\'s '
+                             'bounding boxes grown by --padding.')
+    parser.add_argument('--padding', type=int, default=10, help='Pixels added around the bounding boxes.')
+    parser.add_argument('--thresholds', default=None,
+                        help='JSON of per channel thresholds in the channel\'s native pixel values, e.g. '
+                             '\'{"DAPI": 60}\'. Defaults to the stored detections, or the preset.')
+    parser.add_argument('--annotations', default=None, help='Annotation store (.lcl) whose labels are exported.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of wells exported at once.')
+    parser.add_argument('--shard-size', type=int, default=4096, help='Crops per shard file.')
+    args = parser.parse_args(args)
+    wells = find_well_directories(args.directory)
+    print(f'found {len(wells)} wells in {args.directory}')
+    if not wells:
+        parser.error(f'no well directories in {args.directory}')
+    dataset = export_crops(wells, args.output, args.size, args.padding,
+                           json.loads(args.thresholds) if args.thresholds else None, args.workers, args.shard_size,
+                           args.annotations)
+    print(f'exported {len(dataset)} crops to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from instrumentation import span
+from rawstore import raw_image
+
+Image.MAX_IMAGE_PIXELS = None
+
+
+def decode_image(path):
+    '''
+    decodes an image file into a numpy array in its native dtype
+    '''
+    return np.array(Image.open(path))
+
+
+def read_image(path):
+    '''
+    returns an image file as a numpy array in its native dtype, memory mapped from its well's raw store if it was
+    converted to one (see rawstore.py), decoded otherwise
+    '''
+    img = raw_image(path)
+    return img if img is not None else decode_image(path)
+
+
+def image_header(path):
+    '''
+    returns the dtype, shape and bits per sample an image file decodes to, read from its header without decoding it
+    '''
+    with Image.open(path) as img:
+        mode, (width, height), bands = img.mode, img.size, len(img.getbands())
+    if mode.startswith('I;16'):
+        dtype, bit_depth = 'uint16', 16
+    else:
+        dtype, bit_depth = {'1': ('bool', 1), 'I': ('int32', 32), 'F': ('float32', 32)}.get(mode, ('uint8', 8))
+    return {'dtype': dtype, 'shape': [height, width] + ([bands] if bands > 1 else []), 'bit_depth': bit_depth}
+
+
+def image_bit_depth(path):
+    '''
+    returns the bits per sample of an image file's native dtype from its header, without decoding it
+    '''
+    return image_header(path)['bit_depth']
+
+
+def _buffers(value):
+    '''
+    returns the memory a cached value holds as (buffer id, bytes) pairs. arrays are counted by the array that owns
+    their memory, so views and aliases of one buffer, in one value or in several, have the same id. values that are
+    more than an array list theirs with a buffers() method
+    '''
+    if isinstance(value, np.ndarray):
+        while isinstance(value.base, np.ndarray):
+            value = value.base
+        return [(id(value), value.nbytes)]
+    if hasattr(value, 'width') and hasattr(value, 'depth'):
+        # QImage / QPixmap
+        return [(id(value), value.width() * value.height() * value.depth() // 8)]
+    if isinstance(value, (list, tuple)):
+        return [b for v in value for b in _buffers(v)]
+    if hasattr(value, 'buffers'):
+        return [b for v in value.buffers() for b in _buffers(v)]
+    return [(id(value), getattr(value, 'nbytes', 0))]
+
+
+class ChannelImageCache:
+    '''
+    LRU cache of decoded channel images and anything derived from them (8 bit copies, display pixmaps...), keyed by
+    path and modification time and bounded by max_bytes. a file that changes on disk is decoded again. memory shared
+    by several entries (an 8 bit image is its own gray copy) is counted once. values that grow after they are stored
+    (threshold engines, pyramids) are measured again when they call the cache_listener the cache gives them
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # buffer id -> [bytes, number of entries holding it]
+        self._owners = {}
+        self._lock = threading.RLock()
+        self._building = {}
+
+    def get(self, path):
+        return self.get_derived(path, 'array', None)
+
+    def get_derived(self, path, kind, build):
+        '''
+        returns the cached value of the given kind for path, computing it with build(decoded array) on a miss
+        '''
+        path = os.path.abspath(path)
+        key = (path, kind)
+        mtime = os.stat(path).st_mtime_ns
+        with self._lock:
+            value = self._lookup(key, mtime)
+            if value is not None:
+                return value
+            # only one thread decodes a given file at a time, the others wait for its result
+            buildLock = self._building.setdefault(key, threading.Lock())
+        with buildLock:
+            with self._lock:
+                value = self._lookup(key, mtime)
+            if value is None:
+                if build is None:
+                    with span('decode', file=os.path.basename(path)):
+                        value = read_image(path)
+                else:
+                    source = self.get(path)
+                    with span('build ' + kind, file=os.path.basename(path)):
+                        value = build(source)
+                self._store(key, mtime, value)
+        with self._lock:
+            self._building.pop(key, None)
+        return value
+
+    def contains(self, path, kind='array'):
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.get((path, kind))
+            return entry is not None and entry[0] == os.stat(path).st_mtime_ns
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+            self._bytes = 0
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def _acquire(self, buffers):
+        for buffer, size in buffers.items():
+            owner = self._owners.get(buffer)
+            if owner is None:
+                self._owners[buffer] = [size, 1]
+                self._bytes += size
+            else:
+                owner[1] += 1
+
+    def _release(self, buffers):
+        for buffer in buffers:
+            owner = self._owners[buffer]
+            owner[1] -= 1
+            if owner[1] == 0:
+                self._bytes -= owner[0]
+                del self._owners[buffer]
+
+    def _remove(self, key):
+        _, _, buffers = self._entries.pop(key)
+        self._release(buffers)
+
+    def _lookup(self, key, mtime):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] != mtime:
+            # stale, the file was rewritten since we decoded it
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _store(self, key, mtime, value):
+        buffers = dict(_buffers(value))
+        if sum(buffers.values()) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (mtime, value, buffers)
+            self._acquire(buffers)
+            if hasattr(value, 'cache_listener'):
+                value.cache_listener = lambda: self._remeasure(key, value)
+            self._evict()
+
+    def _remeasure(self, key, value):
+        # a stored value grew or shrank, its buffers are counted again
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] is not value:
+                return
+            buffers = dict(_buffers(value))
+            self._acquire(buffers)
+            self._release(entry[2])
+            self._entries[key] = (entry[0], value, buffers)
+            if sum(buffers.values()) > self.max_bytes:
+                self._remove(key)
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+
+# shared by the viewer, auto find and annotation saving. the budget can be set with LCL_CACHE_MB
+channel_cache = ChannelImageCache(int(os.environ.get('LCL_CACHE_MB', 4096)) * 1024 ** 2)
@@ -0,0 +1,203 @@
+import atexit
+import ctypes
+import functools
+import json
+import multiprocessing.util
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+# where the trace is written, a {pid} in it is replaced by the process id so batch workers each get their own file
+TRACE_ENV = 'LCL_TRACE'
+# show the time of the last operation and the peak memory on screen, with or without a trace file
+STATUS_ENV = 'LCL_TRACE_STATUS'
+
+
+class _ProcessMemoryCounters(ctypes.Structure):
+    _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong)] + \
+               [(name, ctypes.c_size_t) for name in ['PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                                                     'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage',
+                                                     'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage']]
+
+
+def peak_memory():
+    '''
+    returns the peak resident memory of this process so far in bytes, None if it can not be read here
+    '''
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macos
+        return peak if sys.platform == 'darwin' else peak * 1024
+    try:
+        counters = _ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters),
+                                                 counters.cb)
+        return counters.PeakWorkingSetSize
+    except (AttributeError, OSError):
+        return None
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        local = self.tracer._local
+        self.depth = getattr(local, 'depth', 0)
+        local.depth = self.depth + 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.tracer._local.depth = self.depth
+        if exc[0] is not None:
+            self.args['error'] = exc[0].__name__
+        self.tracer.record(self.name, self.start, end, self.args, self.depth)
+        return False
+
+
+class Tracer:
+    '''
+    records how long named spans of work take, on which thread, and the peak memory at their end. the spans are written
+    to path in the chrome trace event format (open it in chrome://tracing or ui.perfetto.dev) and handed to the
+    listeners. the file is rotated once it is larger than max_bytes, the last backups of it are kept. with neither a
+    path nor listeners span does nothing. a {pid} in path is replaced by the id of the process writing, worker
+    processes do not run atexit so they have to flush themselves
+    '''
+
+    def __init__(self, path=None, max_bytes=64 * 1024 ** 2, backups=3, flush_every=256):
+        self.pattern = path or None
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_every = flush_every
+        self.listeners = []
+        self.enabled = self.pattern is not None
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+        self._pid = None
+        self._check_process()
+        if self.pattern is not None:
+            atexit.register(self.flush)
+
+    def _check_process(self):
+        # a forked worker starts with a copy of its parent's tracer: its own file, none of the parent's buffered
+        # events, and a fresh lock in case the parent's was held at the fork
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self.path = self.pattern.replace('{pid}', str(pid)) if self.pattern else None
+            self._events = []
+            self._lock = threading.Lock()
+            if self.pattern is not None:
+                # run when a multiprocessing worker exits normally, unlike atexit
+                multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+
+    def add_listener(self, listener):
+        '''
+        listener(name, seconds, peak memory in bytes, depth) is called at the end of every span, on the thread that ran
+        it. depth is 0 for spans that are not inside another one
+        '''
+        self.listeners.append(listener)
+        self.enabled = True
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def record(self, name, start, end, args, depth=0):
+        self._check_process()
+        peak = peak_memory()
+        for listener in self.listeners:
+            listener(name, end - start, peak, depth)
+        if self.path is None:
+            return
+        ts = (start - self._origin) * 1e6
+        tid = threading.get_ident()
+        event = {'name': name, 'ph': 'X', 'ts': ts, 'dur': (end - start) * 1e6, 'pid': os.getpid(), 'tid': tid,
+                 'args': args}
+        with self._lock:
+            self._events.append(event)
+            if peak is not None:
+                self._events.append({'name': 'memory', 'ph': 'C', 'ts': ts + event['dur'], 'pid': os.getpid(),
+                                     'args': {'peak_mb': peak / 1024 ** 2}})
+            if len(self._events) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        self._check_process()
+        if self.path is None:
+            return
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._events:
+            return
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            self._rotate()
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        # the closing bracket of the json array is optional in the trace format, so events can just be appended
+        with open(self.path, 'a') as f:
+            f.write(('[\n' if new else ',\n') + ',\n'.join(json.dumps(event, default=str) for event in self._events))
+        self._events = []
+
+    def _rotate(self):
+        with open(self.path, 'a') as f:
+            f.write('\n]\n')
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+
+tracer = Tracer(os.environ.get(TRACE_ENV))
+
+
+def span(name, **args):
+    '''
+    times the work in a with block as a span of the shared tracer, args are stored with it
+    '''
+    return tracer.span(name, **args)
+
+
+def traced(name=None):
+    '''
+    decorator that times every call of a function as a span of the shared tracer
+    '''
+    def decorate(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return fn(*args, **kwargs)
+            with tracer.span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+from image_cache import image_header
+from rawstore import RAW_DIRECTORY
+
+# the persistent index of an experiment lives in its own directory below the experiment root, so rewriting it does not
+# change the modification time of the root
+INDEX_DIRECTORY = '.lcl_index'
+INDEX_FILE = 'manifest.json'
+
+# manifests of the directories scanned by this process, keyed by absolute path
+_manifests = {}
+_lock = threading.Lock()
+
+
+def channel_name(filename):
+    '''
+    returns the channel of an image file named <well>__<12 digit timestamp>-<channel>.tif, or <anything>-<channel>.tif
+    '''
+    stem = filename.rpartition('.tif')[0]
+    if '__' in stem:
+        rest = stem.rpartition('__')[2]
+        if rest[:12].isdigit() and rest[12:13] == '-':
+            return rest[13:]
+        return rest.partition('-')[2]
+    return stem.rpartition('-')[2]
+
+
+def scan_directory(directory):
+    '''
+    lists a directory once and returns its manifest: its modification time, the names of its files and subdirectories,
+    and for every channel image the file name, size, modification time, dtype and shape (from the image header)
+    '''
+    # stat before listing, so a file added while scanning makes the manifest stale rather than silently incomplete
+    manifest = {'mtime_ns': os.stat(directory).st_mtime_ns, 'files': [], 'subdirs': [], 'channels': {}}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                manifest['subdirs'].append(entry.name)
+                continue
+            manifest['files'].append(entry.name)
+            if '.tif' not in entry.name or not entry.is_file():
+                continue
+            st = entry.stat()
+            channel = {'file': entry.name, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            try:
+                channel.update(image_header(entry.path))
+            except OSError:
+                # not readable as an image, it is listed but auto find will fail on it like it did before
+                channel.update({'dtype': None, 'shape': None, 'bit_depth': 8})
+            manifest['channels'][channel_name(entry.name)] = channel
+    return manifest
+
+
+def well_manifest(directory):
+    '''
+    returns the manifest of a directory (see scan_directory), scanning it only if it is new to this process or files
+    were added, removed or renamed in it since. channel images rewritten in place are not noticed, the image cache
+    checks those itself
+    '''
+    key = os.path.abspath(directory)
+    mtime = os.stat(key).st_mtime_ns
+    manifest = _manifests.get(key)
+    if manifest is None or manifest['mtime_ns'] != mtime:
+        manifest = scan_directory(key)
+        with _lock:
+            _manifests[key] = manifest
+    return manifest
+
+
+def is_well(manifest):
+    '''
+    whether a directory manifest looks like a well record: images and a meta .yml, with fluorescence channels
+    '''
+    count = sum(1 for f in manifest['files'] if '.yml' in f or '.tif' in f)
+    fluorescence = [c for c in manifest['channels'].values() if 'Default' not in c['file']]
+    return count > 1 and len(fluorescence) > 0
+
+
+class ExperimentIndex:
+    '''
+    the manifests of every directory below an experiment root, kept in an index file there. refreshing it stats each
+    known directory and only lists again the ones that changed, so finding the wells of a plate on a network share does
+    not list thousands of files every time
+    '''
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(self.root, INDEX_DIRECTORY, INDEX_FILE)
+        self.directories = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.directories = json.load(f)['directories']
+            except (OSError, ValueError, KeyError):
+                # unreadable, it is rebuilt
+                self.directories = {}
+
+    def refresh(self, save=True):
+        '''
+        brings the index up to date with the directories on disk and shares the manifests with well_manifest
+        '''
+        if save:
+            # made up front, making it later would change the root's modification time
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        directories = {}
+        changed = False
+        pending = ['.']
+        while pending:
+            rel = pending.pop()
+            full = os.path.normpath(os.path.join(self.root, rel))
+            try:
+                mtime = os.stat(full).st_mtime_ns
+            except OSError:
+                changed = True
+                continue
+            manifest = self.directories.get(rel)
+            if manifest is None or manifest['mtime_ns'] != mtime:
+                manifest = scan_directory(full)
+                changed = True
+            directories[rel] = manifest
+            with _lock:
+                _manifests[full] = manifest
+            pending += sorted((os.path.join(rel, d) for d in manifest['subdirs']
+                               if d not in (INDEX_DIRECTORY, RAW_DIRECTORY)), reverse=True)
+        changed |= directories.keys() != self.directories.keys()
+        self.directories = directories
+        if changed and save:
+            self.save()
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'root': self.root, 'directories': self.directories}, f)
+        os.replace(tmp, self.path)
+
+    def wells(self):
+        '''
+        returns the absolute paths of the well directories in the index, in the order os.walk would find them
+        '''
+        return [os.path.normpath(os.path.join(self.root, rel)) for rel, manifest in self.directories.items()
+                if is_well(manifest)]
@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# the raw store of a well lives in its own directory inside the well directory
+RAW_DIRECTORY = '.lcl_raw'
+HEADER_FILE = 'header.json'
+
+# parsed headers keyed by header path, with the header's modification time
+_headers = {}
+# open memory maps keyed by raw file path, with the stamp of the image they were converted from
+_maps = {}
+_lock = threading.Lock()
+
+
+def header_path(d):
+    return os.path.join(d, RAW_DIRECTORY, HEADER_FILE)
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def read_header(d):
+    '''
+    returns the header of a well's raw store, the shape, dtype, source image and raw file of every channel keyed by
+    channel name, or None if the well has none
+    '''
+    path = header_path(d)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _headers.get(path)
+    if cached is None or cached[0] != mtime:
+        try:
+            with open(path) as f:
+                cached = (mtime, json.load(f))
+        except (OSError, ValueError):
+            return None
+        with _lock:
+            _headers[path] = cached
+    return cached[1]
+
+
+def raw_image(path):
+    '''
+    returns a channel image from its well's raw store as a read only memory map, or None if the well has no raw store,
+    the image is not in it or the image changed since it was converted. slicing it reads only the pages of the slice
+    '''
+    d, name = os.path.split(os.path.abspath(path))
+    header = read_header(d)
+    if header is None:
+        return None
+    entry = next((c for c in header['channels'].values() if c['source'] == name), None)
+    if entry is None or _stamp(path) != entry['stamp']:
+        return None
+    raw = os.path.join(d, RAW_DIRECTORY, entry['file'])
+    cached = _maps.get(raw)
+    if cached is None or cached[0] != entry['stamp']:
+        try:
+            cached = (entry['stamp'], np.memmap(raw, dtype=entry['dtype'], mode='r', shape=tuple(entry['shape'])))
+        except (OSError, ValueError):
+            return None
+        with _lock:
+            _maps[raw] = cached
+    return cached[1]
+
+
+def convert_well(d, overwrite=False):
+    '''
+    writes every channel image of a well, decoded once, into its raw store: one uncompressed file per channel in the
+    image's native dtype and row order, and a header. channels converted before whose image did not change are kept
+    unless overwrite. returns the header
+    '''
+    from image_cache import decode_image
+    from manifest import well_manifest
+    d = os.path.abspath(d)
+    directory = os.path.join(d, RAW_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    old = (read_header(d) or {'channels': {}})['channels']
+    header = {'version': 1, 'channels': {}}
+    for name, channel in well_manifest(d)['channels'].items():
+        path = os.path.join(d, channel['file'])
+        stamp = _stamp(path)
+        entry = old.get(name)
+        if not overwrite and entry is not None and entry['source'] == channel['file'] and entry['stamp'] == stamp \
+                and os.path.exists(os.path.join(directory, entry['file'])):
+            header['channels'][name] = entry
+            continue
+        try:
+            img = decode_image(path)
+        except OSError:
+            print('not converted, unreadable:', path)
+            continue
+        if img.size == 0:
+            continue
+        entry = {'source': channel['file'], 'file': os.path.splitext(channel['file'])[0] + '.raw', 'stamp': stamp,
+                 'dtype': img.dtype.str, 'shape': list(img.shape)}
+        raw = os.path.join(directory, entry['file'])
+        out = np.memmap(raw + '.tmp', dtype=img.dtype, mode='w+', shape=img.shape)
+        out[:] = img
+        out.flush()
+        del out
+        os.replace(raw + '.tmp', raw)
+        header['channels'][name] = entry
+    # the header is written last, so it never points to a raw file that is not complete
+    tmp = header_path(d) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(header, f, indent=1)
+    os.replace(tmp, header_path(d))
+    keep = {entry['file'] for entry in header['channels'].values()} | {HEADER_FILE}
+    for f in os.listdir(directory):
+        if f not in keep:
+            os.remove(os.path.join(directory, f))
+    return header
+
+
+def convert_plate(root, workers=None, overwrite=False):
+    '''
+    converts every well directory below root (see convert_well), workers wells at a time
+    '''
+    from utils import find_well_directories
+    wells = find_well_directories(root)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for d, header in zip(wells, pool.map(convert_well, wells, [overwrite] * len(wells))):
+            print('converted', d, len(header['channels']), 'channels')
+    return wells
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Converts the channel images of every well directory below the given '
+                                                 'directory into raw stores that are memory mapped instead of decoded.')
+    parser.add_argument('directory', help='Plate or experiment directory containing the well directories.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of wells converted at once.')
+    parser.add_argument('--overwrite', action='store_true', help='Convert channels again even if they did not change.')
+    args = parser.parse_args(args)
+    convert_plate(args.directory, args.workers, args.overwrite)
+
+
+if __name__ == '__main__':
+    main()
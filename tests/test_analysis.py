@@ -0,0 +1,16 @@
+import numpy as np
+from analysis import feature_table
+from annotation_store import AnnotationStore
+
+
+def test_feature_table_after_every_annotation_is_deleted(tmp_path):
+    store = AnnotationStore(str(tmp_path / 'annotations.lcl'))
+    crop = np.ones((4, 4, 2), np.uint8)
+    ids = store.append([{'type': 'Positive', 'channels': ['DAPI', '488'], 'crop': crop}] * 3)
+    assert len(feature_table(str(tmp_path), workers=1)['id']) == 3
+    store.delete(ids)
+    assert feature_table(str(tmp_path), workers=1) == {}
+    # the second run reads the cache of the empty store
+    assert feature_table(str(tmp_path), workers=1) == {}
+    store.append([{'type': 'Negative', 'channels': ['DAPI', '488'], 'crop': crop}])
+    assert feature_table(str(tmp_path), workers=1)['id'].tolist() == [3]
@@ -0,0 +1,32 @@
+import os
+import pickle
+import numpy as np
+from annotation_store import AnnotationStore, import_pickle
+
+
+def write_pickle(path, n):
+    crop = np.zeros((4, 4, 2), np.uint8)
+    with open(path, 'wb') as f:
+        pickle.dump([('Interphase', ['DAPI', '488'], crop, crop, 1)] * n, f)
+
+
+def test_importing_a_pickle_twice_adds_it_once(tmp_path):
+    path = str(tmp_path / 'annotations.p')
+    write_pickle(path, 3)
+    store = import_pickle(path)
+    assert len(store.records()) == 3
+    assert len(import_pickle(path).records()) == 3
+    # a pickle saved again replaces what it was imported as
+    write_pickle(path, 5)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    store = import_pickle(path)
+    assert len(store.records()) == 5
+    assert len(AnnotationStore(store.path).records()) == 5
+
+
+def test_ids_are_never_reused(tmp_path):
+    store = AnnotationStore(str(tmp_path / 'store.lcl'))
+    ids = store.append([{'type': 'Mitotic'}] * 2)
+    store.delete(ids[1:])
+    assert store.append([{'type': 'Mitotic'}]) == [2]
+    assert AnnotationStore(store.path).append([{'type': 'Mitotic'}]) == [3]
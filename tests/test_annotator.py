@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import numpy as np
+import pytest
+from synthetic_well import generate_well
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+import annotator
+
+
+@pytest.fixture
+def window(monkeypatch):
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+    # an exception in a Qt callback would only be printed, fail the test on it instead
+    errors = []
+    monkeypatch.setattr(sys, 'excepthook', lambda *exc_info: errors.append(exc_info))
+    monkeypatch.setattr(annotator.QMessageBox, 'about', staticmethod(lambda *args: None))
+    w = annotator.Window()
+    w.app, w.errors = app, errors
+    yield w
+    w.cancelBackgroundWork()
+    w.close()
+
+
+def wait_idle(w, timeout=60):
+    end = time.time() + timeout
+    while time.time() < end:
+        w.app.processEvents()
+        if not w.activeWorkers and not w.sliderTimer.isActive():
+            return
+    raise TimeoutError
+
+
+def test_slider_in_a_well_without_nuclear_channel(window, tmp_path, monkeypatch):
+    generate_well(str(tmp_path), size=300, density=1e-3)
+    for f in os.listdir(tmp_path):
+        if '-DAPI' in f:
+            os.rename(tmp_path / f, tmp_path / f.replace('-DAPI', '-Hoechst'))
+    monkeypatch.setattr(annotator.QFileDialog, 'getExistingDirectory', staticmethod(lambda *args: str(tmp_path)))
+    window.loadImage()
+    window.autoLocate()
+    wait_idle(window)
+    window.channelSliders['488'].setValue(60)
+    wait_idle(window)
+    assert window.errors == []
+    assert len(window.obj_channels['488']) > 0
+
+
+def paint_boxes(item, scale, size=(300, 200)):
+    from PyQt5 import QtCore, QtGui
+    image = QtGui.QImage(*size, QtGui.QImage.Format_ARGB32)
+    image.fill(0)
+    painter = QtGui.QPainter(image)
+    painter.scale(scale, scale)
+    option = QtWidgets.QStyleOptionGraphicsItem()
+    option.exposedRect = QtCore.QRectF(0, 0, size[0] / scale, size[1] / scale)
+    item.paint(painter, option)
+    painter.end()
+    ptr = image.constBits()
+    ptr.setsize(image.byteCount())
+    return np.frombuffer(ptr, np.uint32).reshape(size[1], size[0]).copy()
+
+
+def test_object_boxes_drawn_at_any_zoom(window):
+    from PyQt5 import QtGui
+    rng = np.random.default_rng(0)
+    table = np.zeros(5000, dtype=[('x0', 'i4'), ('y0', 'i4'), ('x1', 'i4'), ('y1', 'i4')])
+    table['x0'], table['y0'] = rng.integers(0, 10000, (2, len(table)))
+    table['x1'], table['y1'] = table['x0'] + 20, table['y0'] + 20
+    # boxes of 20 pixels drawn as rectangles, and as single pixels once they are 0.6 pixels on screen
+    item = annotator.ObjectBoxesItem(QtGui.QColor(255, 0, 0))
+    table['x0'][0], table['y0'][0], table['x1'][0], table['y1'][0] = 10, 10, 30, 30
+    item.setTable(table)
+    assert (paint_boxes(item, 1)[10:31, 10:31] != 0).sum() == 80
+    # only the boxes painted so far got a QRectF
+    assert 0 < sum(rect is not None for rect in item.rects) < len(table)
+    # about 3300 boxes in view, far more than are painted at full size
+    assert (paint_boxes(item, 0.03) != 0).sum() > 2000
+    item.setTable(None)
+    assert (paint_boxes(item, 1) == 0).all()
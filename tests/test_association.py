@@ -0,0 +1,55 @@
+import numpy as np
+from synthetic_well import generate_well
+from utils import associate_objects, get_obj_channel_paths, label_image, read_gray, threshold_engine, \
+    well_nucleus_table, NucleusAssociation
+from image_cache import channel_cache
+
+
+def reference_pairs(shape, nucleus_components, components):
+    # every nucleus pixel looks up the channel's label image, the way the association used to be counted
+    flat_idx, starts = nucleus_components
+    nucleus = np.repeat(np.arange(1, len(starts) + 1), np.diff(starts, append=len(flat_idx)))
+    hit = label_image(shape, *components).ravel()[flat_idx]
+    inside = hit > 0
+    pairs, counts = np.unique(np.stack([nucleus[inside], hit[inside]], axis=1), axis=0, return_counts=True)
+    return [(int(n), int(o), int(c)) for (n, o), c in zip(pairs, counts)]
+
+
+def synthetic_components(tmp_path):
+    paths = get_obj_channel_paths(str(tmp_path))
+    thresholds = {name: 60 for name in paths}
+    components = {name: threshold_engine(path).components(60) for name, path in paths.items()}
+    return paths, thresholds, components
+
+
+def test_pairs_match_label_image_lookup(tmp_path):
+    generate_well(str(tmp_path), size=500, density=4e-4)
+    paths, _, components = synthetic_components(tmp_path)
+    shape = read_gray(paths['DAPI']).shape
+    nuclei = components.pop('DAPI')
+    table, pairs = associate_objects(shape, nuclei, components)
+    for name, channel in components.items():
+        assert [(int(p['nucleus']), int(p['object']), int(p['overlap'])) for p in pairs[name]] == \
+            reference_pairs(shape, nuclei, channel)
+        assert table['n_' + name].sum() == len(pairs[name])
+
+
+def test_nucleus_table_rematches_only_the_changed_channel(tmp_path):
+    channel_cache.clear()
+    generate_well(str(tmp_path), size=500, density=4e-4)
+    paths, thresholds, components = synthetic_components(tmp_path)
+    well_nucleus_table(str(tmp_path), thresholds)
+    association = channel_cache.get_derived(paths['DAPI'], 'association_none', lambda img: NucleusAssociation())
+    labels, before = association._nucleus[1], dict(association._pairs)
+    thresholds['488'] = 100
+    table = well_nucleus_table(str(tmp_path), thresholds)
+    assert association._nucleus[1] is labels
+    assert association._pairs['647'] is before['647']
+    assert association._pairs['488'] is not before['488']
+    # the same table as matching everything from scratch
+    images = {name: read_gray(path) for name, path in paths.items()}
+    components['488'] = threshold_engine(paths['488']).components(100)
+    expected, _ = associate_objects(images['DAPI'].shape, components.pop('DAPI'), components, images)
+    assert table.dtype == expected.dtype
+    for name in expected.dtype.names:
+        assert np.array_equal(table[name], expected[name])
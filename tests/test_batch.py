@@ -0,0 +1,23 @@
+import pytest
+from synthetic_well import generate_well
+from utils import get_obj_channels, get_obj_channel_paths, load_well_detections, main, threshold_engine
+
+
+def test_thresholds_left_out_use_the_preset(tmp_path):
+    generate_well(str(tmp_path), size=300)
+    _, thresholds = get_obj_channels(str(tmp_path), {'DAPI': 60}, as_table=True)
+    paths = get_obj_channel_paths(str(tmp_path))
+    assert thresholds['DAPI'] == 60
+    assert thresholds['488'] == threshold_engine(paths['488']).default_threshold()
+
+
+def test_batch_with_partial_thresholds(tmp_path):
+    generate_well(str(tmp_path / 'plate' / 'A1'), size=300)
+    main([str(tmp_path / 'plate'), '--workers', '1', '--thresholds', '{"DAPI": 60}'])
+    assert load_well_detections(str(tmp_path / 'plate' / 'A1'))[1]['DAPI'] == 60
+
+
+def test_verify_backends_without_wells(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        main([str(tmp_path), '--verify-backends'])
+    assert 'no well directories found' in capsys.readouterr().err
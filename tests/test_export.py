@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from export import export_crops
+from image_cache import read_image
+from synthetic_well import generate_well
+from utils import crop_into, get_all_paths_and_channels
+
+
+def test_exporting_no_wells_is_an_error(tmp_path):
+    with pytest.raises(ValueError):
+        export_crops([], str(tmp_path / 'dataset'))
+
+
+@pytest.mark.parametrize('crop_size', [48, None])
+def test_exported_crops_match_the_images(tmp_path, crop_size):
+    well = str(tmp_path / 'A1')
+    generate_well(well, size=300, density=1e-3, bit_depth=12)
+    dataset = export_crops([well], str(tmp_path / 'dataset'), crop_size, padding=5, workers=1, shard_size=16)
+    images = {name: read_image(path) for name, path in get_all_paths_and_channels(well).items()}
+    assert len(dataset) > 16 and dataset.index['shard'].max() > 0
+    # crops hanging over the edge of the image are there too
+    assert (dataset.index['x0'] < 0).any() or (dataset.index['y0'] < 0).any()
+    for i, row in enumerate(dataset.index):
+        crop = dataset.crop(i)
+        for c, name in enumerate(dataset.channels):
+            expected = np.zeros(crop.shape[:2], crop.dtype)
+            crop_into(expected, images[name], [row['x0'], row['y0'], row['x1'], row['y1']])
+            assert np.array_equal(crop[..., c], expected)
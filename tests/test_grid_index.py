@@ -0,0 +1,43 @@
+import numpy as np
+from utils import GridIndex
+
+
+def brute_nearest(boxes, alive, x, y):
+    distance = np.hypot((boxes[:, 0] + boxes[:, 2]) / 2 - x, (boxes[:, 1] + boxes[:, 3]) / 2 - y)
+    distance[~alive] = np.inf
+    return distance.min()
+
+
+def clustered_boxes(n=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    xy = rng.normal(50000, 300, (n, 2))
+    size = rng.uniform(5, 30, (n, 2))
+    return np.concatenate([xy, xy + size], axis=1)
+
+
+def distance_to(index, i, x, y):
+    b = index.boxes[i]
+    return np.hypot((b[0] + b[2]) / 2 - x, (b[1] + b[3]) / 2 - y)
+
+
+def test_nearest_far_from_clustered_boxes():
+    boxes = clustered_boxes()
+    index = GridIndex(boxes, cell_size=64)
+    for x, y in [(0, 0), (200000, 50000), (50000, -1e6), (49000, 51500)]:
+        i = index.nearest(x, y)
+        assert distance_to(index, i, x, y) == brute_nearest(boxes, index.alive, x, y)
+    assert index.nearest(0, 0, max_distance=1000) is None
+
+
+def test_nearest_matches_brute_force_with_added_and_removed_boxes():
+    rng = np.random.default_rng(1)
+    boxes = clustered_boxes(2000)
+    index = GridIndex(boxes[:1500], cell_size=64)
+    for box in boxes[1500:]:
+        index.add(box)
+    for i in rng.choice(len(boxes), 300, replace=False):
+        index.remove(i)
+    for x, y in rng.uniform(45000, 55000, (200, 2)):
+        i = index.nearest(x, y)
+        assert index.alive[i]
+        assert distance_to(index, i, x, y) == brute_nearest(index.boxes, index.alive, x, y)
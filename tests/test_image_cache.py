@@ -0,0 +1,44 @@
+import numpy as np
+from PIL import Image
+from image_cache import ChannelImageCache
+from utils import ThresholdEngine, ImagePyramid, to_gray
+
+
+def write_image(path, img):
+    Image.fromarray(img).save(str(path))
+    return str(path)
+
+
+def test_aliased_buffers_count_once(tmp_path):
+    img = (np.random.default_rng(0).random((300, 400)) * 255).astype(np.uint8)
+    path = write_image(tmp_path / 'a-DAPI.tif', img)
+    cache = ChannelImageCache(1024 ** 3)
+    array = cache.get(path)
+    # an 8 bit image is its own gray copy
+    assert cache.get_derived(path, 'gray', to_gray) is array
+    assert cache.nbytes == img.nbytes
+
+
+def test_engines_and_pyramids_are_measured_again_when_they_grow(tmp_path):
+    img = (np.random.default_rng(0).random((512, 512)) * 255).astype(np.uint8)
+    path = write_image(tmp_path / 'a-DAPI.tif', img)
+    cache = ChannelImageCache(1024 ** 3)
+    engine = cache.get_derived(path, 'engine', ThresholdEngine)
+    assert cache.nbytes == img.nbytes
+    engine.table(240)
+    assert engine.nbytes > img.nbytes
+    assert cache.nbytes == engine.nbytes
+    pyramid = cache.get_derived(path, 'pyramid', ImagePyramid)
+    before = cache.nbytes
+    pyramid.level(pyramid.n_levels - 1)
+    assert cache.nbytes == before + pyramid.nbytes - img.nbytes
+
+
+def test_budget_evicts_grown_entries(tmp_path):
+    img = (np.random.default_rng(0).random((512, 512)) * 255).astype(np.uint8)
+    path = write_image(tmp_path / 'a-DAPI.tif', img)
+    cache = ChannelImageCache(3 * img.nbytes)
+    engine = cache.get_derived(path, 'engine', ThresholdEngine)
+    engine.table(100)
+    assert cache.nbytes <= cache.max_bytes
+    assert not cache.contains(path, 'engine')
@@ -0,0 +1,29 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+from conftest import ROOT
+from synthetic_well import generate_well
+
+
+def load_trace(path):
+    # the closing bracket is only written when the file is rotated
+    with open(path) as f:
+        text = f.read().rstrip()
+    return json.loads(text if text.endswith(']') else text + ']')
+
+
+def test_batch_workers_write_their_own_traces(tmp_path):
+    plate = tmp_path / 'plate'
+    for i, well in enumerate(['A1', 'A2']):
+        generate_well(str(plate / well), size=400, seed=i, name=well + '__202103011200')
+    env = dict(os.environ, LCL_TRACE=str(tmp_path / 'trace_{pid}.json'))
+    subprocess.run([sys.executable, os.path.join(ROOT, 'utils.py'), str(plate), '--workers', '2'], env=env,
+                   check=True, cwd=str(tmp_path), capture_output=True)
+    traces = {path: load_trace(path) for path in glob.glob(str(tmp_path / 'trace_*.json'))}
+    wells = [event for events in traces.values() for event in events if event['name'] == 'detect_well']
+    assert len(wells) == 2
+    # each process writes its own file, named after itself
+    for path, events in traces.items():
+        assert {str(event['pid']) for event in events} == {os.path.basename(path)[len('trace_'):-len('.json')]}
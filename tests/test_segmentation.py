@@ -0,0 +1,105 @@
+import cv2
+import numpy as np
+from utils import get_objs_tiled, segment_skimage, segment_objects, verify_backends, SEGMENTATION_BACKENDS, \
+    get_objs_coarse_to_fine, coarse_objects, table_boxes
+
+TILE = 64
+
+
+def assert_same_table(table, reference):
+    assert table.dtype == reference.dtype
+    for name in reference.dtype.names:
+        assert np.array_equal(table[name], reference[name]), name
+
+
+def synthetic_image(size=300, seed=0, dtype=np.uint8):
+    '''
+    noise with random discs, plus objects placed across the TILE borders: straddling an edge, covering a corner where
+    four tiles meet, touching a corner only diagonally, snaking through several tiles, and on the image's own edges
+    '''
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 40, (size, size)).astype(dtype)
+    for (y, x), r in zip(rng.integers(0, size, (40, 2)).tolist(), rng.integers(2, 9, 40).tolist()):
+        cv2.circle(img, (x, y), r, int(rng.integers(100, 250)), -1)
+    img[TILE - 3:TILE + 3, 20:30] = 200
+    img[2 * TILE - 4:2 * TILE + 4, 2 * TILE - 4:2 * TILE + 4] = 180
+    # two pixels 8-connected only across the corner of four tiles
+    img[TILE - 1, 3 * TILE - 1] = 220
+    img[TILE, 3 * TILE] = 220
+    img[3 * TILE - 2:3 * TILE + 2, 10:4 * TILE + 10] = 150
+    img[3 * TILE:4 * TILE, 4 * TILE + 8:4 * TILE + 10] = 150
+    img[0:5, size - 5:size] = 240
+    img[size - 3:size, 0:size] = 130
+    return img
+
+
+def intensity_images(img):
+    return {'a': img, 'b': img[::-1].copy()}
+
+
+def test_tiled_matches_whole_image():
+    img = synthetic_image()
+    for thresh_val in [60, 140, 210]:
+        reference = segment_skimage(img, thresh_val, intensity_images(img))
+        for workers in [1, 3]:
+            assert_same_table(get_objs_tiled(img, thresh_val, TILE, workers, intensity_images(img)), reference)
+
+
+def test_tiled_with_tiles_not_dividing_the_image():
+    img = synthetic_image(size=257, seed=1, dtype=np.uint16)
+    assert_same_table(get_objs_tiled(img, 100, TILE), segment_skimage(img, 100))
+
+
+def test_every_backend_matches_skimage():
+    for dtype in [np.uint8, np.uint16]:
+        img = synthetic_image(dtype=dtype)
+        for thresh_val in [0, 60, 140, 239]:
+            reference = segment_skimage(img, thresh_val, intensity_images(img))
+            for backend in SEGMENTATION_BACKENDS:
+                assert_same_table(segment_objects(img, thresh_val, intensity_images(img), backend), reference)
+
+
+def test_verify_backends_reports_them_the_same():
+    img = synthetic_image()
+    assert all(same for same, _ in verify_backends(img, 100).values())
+
+
+def test_backends_on_an_image_without_objects():
+    img = np.zeros((100, 100), np.uint8)
+    for backend in SEGMENTATION_BACKENDS:
+        assert len(segment_objects(img, 10, backend=backend)) == 0
+
+
+def test_coarse_to_fine_matches_whole_image():
+    for dtype in [np.uint8, np.uint16]:
+        img = synthetic_image(dtype=dtype)
+        for thresh_val in [0, 45, 100, 180, 239]:
+            reference = segment_skimage(img, thresh_val, intensity_images(img))
+            for factor, tile_size in [(4, 64), (3, 50), (8, 512)]:
+                assert_same_table(get_objs_coarse_to_fine(img, thresh_val, factor, tile_size, intensity_images(img)),
+                                  reference)
+
+
+def test_every_object_is_inside_a_coarse_box():
+    img = synthetic_image(size=257)
+    for thresh_val in [45, 100, 180]:
+        coarse = table_boxes(coarse_objects(img, thresh_val))
+        for x0, y0, x1, y1 in table_boxes(segment_skimage(img, thresh_val)):
+            assert ((coarse[:, 0] <= x0) & (coarse[:, 1] <= y0) & (x1 <= coarse[:, 2]) & (y1 <= coarse[:, 3])).any()
+
+
+def test_engine_on_a_dense_image_labels_without_building_a_base(monkeypatch):
+    from utils import ThresholdEngine
+    img = synthetic_image()
+    engine = ThresholdEngine(img)
+    engine.components(200)
+    base = engine._base
+    builds = []
+    monkeypatch.setattr(engine, '_build_base', lambda thresh_val: builds.append(thresh_val))
+    # most of the image is above these, so they are labelled directly every time
+    for thresh_val in [20, 10, 15, 5, 0]:
+        assert_same_table(engine.table(thresh_val), segment_skimage(img, thresh_val))
+    assert builds == []
+    # and the base built for the bright objects is still there for them
+    assert engine._base is base
+    assert_same_table(engine.table(230), segment_skimage(img, 230))
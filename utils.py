@@ -1,50 +1,907 @@
 import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from sys import getsizeof
 import cv2, os
+import threading
+import time
+from collections import OrderedDict
 import scipy
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.stats
+import scipy.ndimage
 from skimage import measure
 import numpy as np
 import argparse
 from skimage.util import img_as_ubyte
+from image_cache import channel_cache
+from instrumentation import span, traced, tracer
+from manifest import well_manifest, ExperimentIndex, INDEX_DIRECTORY, INDEX_FILE
 
 
 def get_unique_names(directory):
-    files = os.listdir(directory)
-    fl = []
-    for f in files:
-        if '.tif' in f and os.path.isfile(os.path.join(directory, f)):
-            fl.append(f.rpartition('-')[0])
-    return set(fl), files
+    manifest = well_manifest(directory)
+    fl = [channel['file'].rpartition('-')[0] for channel in manifest['channels'].values()]
+    return set(fl), list(manifest['files'])
 
 
 def get_all_paths_and_channels(directory):
-    paths, channels = [], []
-    for f in os.listdir(directory):
-        if '.tif' in f and os.path.isfile(os.path.join(directory, f)):
-            paths.append(os.path.join(directory, f))
-            # channels.append(f.rpartition('-')[2].rpartition('.tif')[0])
-            channels.append(f.rpartition('__')[2][13:].rpartition('.tif')[0])
-    return dict(zip(channels, paths))
+    # channel names are parsed the same way everywhere, see manifest.channel_name
+    return {name: os.path.join(directory, channel['file'])
+            for name, channel in well_manifest(directory)['channels'].items()}
 
 
-def main():
-    unique_names, fl = get_unique_names()
-    s = '\n'.join(unique_names)
-    selection = input(f'Please type the file set to annotate from:\n{s}\n')
-    channels = get_all_paths_and_channels(selection, fl)
-    print(channels)
+def main(args=None):
+    '''
+    headless batch auto find over every well directory below a plate or experiment root
+    '''
+    parser = argparse.ArgumentParser(description='Annotator for the LCL mk 2 system. Runs auto find on every well '
+                                                 'directory below the given directory and stores the detections.')
+    parser.add_argument('directory', help='Plate or experiment directory containing the well directories.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of wells processed at once.')
+    parser.add_argument('--thresholds', default=None,
+                        help='JSON of per channel thresholds in the channel\'s native pixel values, e.g. '
+                             '\'{"DAPI": 60}\'. Channels left out use the preset.')
+    parser.add_argument('--overwrite', action='store_true', help='Re-run wells whose detections are up to date.')
+    parser.add_argument('--tile-size', type=int, default=None,
+                        help='Segment in tiles of this size to bound memory on very large (stitched) wells.')
+    parser.add_argument('--backend', choices=list(SEGMENTATION_BACKENDS), default=None,
+                        help=f'Segmentation backend, defaults to {DEFAULT_BACKEND}.')
+    parser.add_argument('--preprocess', choices=list(PREPROCESSING), default=None,
+                        help=f'Preprocessing applied before thresholding, defaults to {DEFAULT_PREPROCESS}.')
+    parser.add_argument('--verify-backends', action='store_true',
+                        help='Check that every backend finds the same objects in the first well and time them.')
+    parser.add_argument('--index', action='store_true',
+                        help=f'Keep an index of the directory\'s wells in {INDEX_DIRECTORY}, so later runs only list '
+                             f'the directories that changed. Used automatically once it exists.')
+    args = parser.parse_args(args)
+    channelThreshValues = json.loads(args.thresholds) if args.thresholds else None
+    if args.verify_backends:
+        wells = find_well_directories(args.directory, args.index or None)
+        if not wells:
+            parser.error(f'no well directories found in {args.directory}')
+        d = wells[0]
+        for name, path in get_obj_channel_paths(d).items():
+            engine = threshold_engine(path, args.preprocess)
+            thresh_val = (channelThreshValues or {}).get(name)
+            if thresh_val is None:
+                thresh_val = engine.default_threshold()
+            for backend, (same, seconds) in verify_backends(engine.img, thresh_val).items():
+                print(f'{d} {name}: {backend} {"same" if same else "DIFFERENT"} {seconds:.3f}s')
+        return
+    batch_auto_find(args.directory, args.workers, channelThreshValues, args.overwrite, args.tile_size, args.backend,
+                    args.preprocess, args.index or None)
 
 
-def get_objs(img, thresh_val):
+def get_objs(img, thresh_val, as_table=False, intensity_images=None, backend=None, preprocess=None):
     '''
-    takes a dapi image and returns list of slices with objects above the thresh_val
+    takes a dapi image and returns list of slices with objects above the thresh_val, or an object table (see
+    object_table) when as_table is set. see segment_objects for the backends and preprocessing
     '''
-    # clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    # img = clahe.apply(img)
+    table = segment_objects(img, thresh_val, intensity_images, backend, preprocess)
+    if as_table:
+        return table
+    return table_slices(table)
+
+
+def segment_skimage(img, thresh_val, intensity_images=None):
     _, thresh1 = cv2.threshold(img, thresh_val, 255, cv2.THRESH_BINARY)
     blobs_labels = measure.label(thresh1.astype(np.uint8), background=0)
-    objs = scipy.ndimage.find_objects(blobs_labels)
-    return objs
+    return object_table(img.shape, *label_components(blobs_labels), intensity_images)
+
+
+def segment_ndimage(img, thresh_val, intensity_images=None):
+    labels, n = scipy.ndimage.label(img > thresh_val, structure=np.ones((3, 3)))
+    return label_image_table(labels, n, intensity_images)
+
+
+def segment_opencv(img, thresh_val, intensity_images=None):
+    n, labels, stats, _ = cv2.connectedComponentsWithStats((img > thresh_val).view(np.uint8), connectivity=8,
+                                                           ltype=cv2.CV_32S)
+    x0, y0 = stats[1:, cv2.CC_STAT_LEFT], stats[1:, cv2.CC_STAT_TOP]
+    boxes = (y0, x0, y0 + stats[1:, cv2.CC_STAT_HEIGHT], x0 + stats[1:, cv2.CC_STAT_WIDTH])
+    return label_image_table(labels, n - 1, intensity_images, boxes)
+
+
+def segment_engine(img, thresh_val, intensity_images=None):
+    return ThresholdEngine(img).table(thresh_val, intensity_images)
+
+
+def segment_coarse(img, thresh_val, intensity_images=None):
+    return get_objs_coarse_to_fine(img, thresh_val, intensity_images=intensity_images)
+
+
+# every backend returns the same object table, verify_backends checks that they do
+SEGMENTATION_BACKENDS = {'engine': segment_engine, 'skimage': segment_skimage, 'ndimage': segment_ndimage,
+                         'opencv': segment_opencv, 'coarse': segment_coarse}
+# the fastest one on our wells, it can be changed with LCL_SEGMENTATION_BACKEND
+DEFAULT_BACKEND = os.environ.get('LCL_SEGMENTATION_BACKEND', 'engine')
+
+PREPROCESSING = {'none': lambda img: img,
+                 'clahe': lambda img: cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(img)}
+# applied to every channel before it is thresholded, it can be changed with LCL_PREPROCESS
+DEFAULT_PREPROCESS = os.environ.get('LCL_PREPROCESS', 'none')
+# the downsampling of the coarse auto find pass (see coarse_objects)
+COARSE_FACTOR = 4
+
+
+def preprocess_image(img, preprocess=None):
+    return PREPROCESSING[preprocess or DEFAULT_PREPROCESS](img)
+
+
+def segment_objects(img, thresh_val, intensity_images=None, backend=None, preprocess=None):
+    '''
+    thresholds img, optionally preprocessed first, and returns the object table of the 8-connected objects above
+    thresh_val, computed by one of SEGMENTATION_BACKENDS (DEFAULT_BACKEND if backend is None)
+    '''
+    return SEGMENTATION_BACKENDS[backend or DEFAULT_BACKEND](preprocess_image(img, preprocess), thresh_val,
+                                                             intensity_images)
+
+
+def verify_backends(img, thresh_val, intensity_images=None, backends=None):
+    '''
+    runs every backend on img and returns {backend: (same table as the skimage one, seconds taken)}
+    '''
+    reference = segment_skimage(img, thresh_val, intensity_images)
+    results = {}
+    for name in backends or SEGMENTATION_BACKENDS:
+        start = time.perf_counter()
+        table = SEGMENTATION_BACKENDS[name](img, thresh_val, intensity_images)
+        seconds = time.perf_counter() - start
+        same = table.dtype == reference.dtype and all(np.array_equal(table[f], reference[f])
+                                                      for f in reference.dtype.names)
+        results[name] = (same, seconds)
+    return results
+
+
+def _segment_tile(img, thresh_val, y, x, width, intensity_images):
+    '''
+    labels one tile of get_objs_tiled and returns the sums and extents of every object piece in it, in image
+    coordinates, and the labels along its top, bottom, left and right edges
+    '''
+    labels = measure.label(img > thresh_val, background=0, connectivity=2)
+    edges = (labels[0].copy(), labels[-1].copy(), labels[:, 0].copy(), labels[:, -1].copy())
+    flat_idx, starts = label_components(labels)
+    del labels
+    if len(starts) == 0:
+        return {}, edges
+    rows, cols = np.divmod(flat_idx, img.shape[1])
+    area = np.diff(starts, append=len(flat_idx))
+    pieces = {'first': (rows[starts] + y) * width + cols[starts] + x,
+              'y0': rows[starts] + y,
+              'y1': rows[np.append(starts[1:], len(flat_idx)) - 1] + y + 1,
+              'x0': np.minimum.reduceat(cols, starts) + x,
+              'x1': np.maximum.reduceat(cols, starts) + x + 1,
+              'area': area,
+              'sum_y': np.add.reduceat(rows, starts, dtype=np.int64) + y * area,
+              'sum_x': np.add.reduceat(cols, starts, dtype=np.int64) + x * area}
+    for name, intensity in intensity_images.items():
+        pieces['sum_' + name] = np.add.reduceat(intensity.ravel()[flat_idx], starts, dtype=np.int64)
+    return pieces, edges
+
+
+def get_objs_tiled(img, thresh_val, tile_size=2048, workers=1, intensity_images=None, occupied=None):
+    '''
+    segments img the way get_objs(img, thresh_val, as_table=True) does, one tile_size square at a time so only a
+    tile's mask and labels are ever in memory (img can be a memory map). objects cut by tile borders are merged back
+    together from the labels along the borders, the table is the same as the whole image one. tiles are labelled
+    concurrently with workers > 1. occupied, if given, is the set of (y, x) origins of the only tiles with pixels
+    above thresh_val, the others are not looked at
+    '''
+    intensity_images = intensity_images or {}
+    h, w = img.shape
+    ys, xs = list(range(0, h, tile_size)), list(range(0, w, tile_size))
+
+    def run(tile):
+        y, x = tile
+        window = (slice(y, y + tile_size), slice(x, x + tile_size))
+        if occupied is not None and tile not in occupied:
+            th, tw = min(tile_size, h - y), min(tile_size, w - x)
+            return {}, (np.zeros(tw, np.int32), np.zeros(tw, np.int32), np.zeros(th, np.int32), np.zeros(th, np.int32))
+        return _segment_tile(img[window], thresh_val, y, x, w,
+                             {name: intensity[window] for name, intensity in intensity_images.items()})
+
+    tiles = [(y, x) for y in ys for x in xs]
+    if workers > 1 and len(tiles) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run, tiles))
+    else:
+        results = [run(tile) for tile in tiles]
+    offsets = np.cumsum([0] + [len(pieces.get('area', ())) for pieces, _ in results])
+
+    def edge(ty, tx, side):
+        # labels along one side of a tile as piece ids, -1 for background
+        i = ty * len(xs) + tx
+        labels = results[i][1][side]
+        return np.where(labels > 0, labels.astype(np.int64) - 1 + offsets[i], -1)
+
+    links_a, links_b = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+
+    def link(u, v):
+        # pieces on either side of a border touch if they are 8-connected across it
+        for d in (-1, 0, 1):
+            uu = u[max(-d, 0):len(u) - max(d, 0)]
+            vv = v[max(d, 0):len(v) - max(-d, 0)]
+            hit = (uu >= 0) & (vv >= 0)
+            links_a.append(uu[hit])
+            links_b.append(vv[hit])
+
+    top, bottom, left, right = range(4)
+    for ty in range(1, len(ys)):
+        link(np.concatenate([edge(ty - 1, tx, bottom) for tx in range(len(xs))]),
+             np.concatenate([edge(ty, tx, top) for tx in range(len(xs))]))
+    for tx in range(1, len(xs)):
+        link(np.concatenate([edge(ty, tx - 1, right) for ty in range(len(ys))]),
+             np.concatenate([edge(ty, tx, left) for ty in range(len(ys))]))
+
+    table = np.zeros(0, dtype=object_dtype(list(intensity_images.keys())))
+    n = offsets[-1]
+    if n == 0:
+        return table
+    links_a, links_b = np.concatenate(links_a), np.concatenate(links_b)
+    graph = scipy.sparse.coo_matrix((np.ones(len(links_a), dtype=np.int8), (links_a, links_b)), shape=(n, n))
+    n_objects, comp = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    pieces = [p for p, _ in results if p]
+    pieces = {k: np.concatenate([p[k] for p in pieces]) for k in pieces[0]}
+    # number the merged objects by their first pixel in raster order, like measure.label
+    first = np.full(n_objects, np.iinfo(np.int64).max)
+    np.minimum.at(first, comp, pieces['first'])
+    rank = np.empty(n_objects, dtype=np.intp)
+    rank[np.argsort(first)] = np.arange(n_objects)
+    comp = rank[comp]
+    order = np.argsort(comp, kind='stable')
+    starts = np.flatnonzero(np.diff(comp[order], prepend=-1))
+    pieces = {k: v[order] for k, v in pieces.items()}
+    table = np.zeros(n_objects, dtype=table.dtype)
+    table['label'] = np.arange(1, n_objects + 1)
+    table['y0'] = np.minimum.reduceat(pieces['y0'], starts)
+    table['y1'] = np.maximum.reduceat(pieces['y1'], starts)
+    table['x0'] = np.minimum.reduceat(pieces['x0'], starts)
+    table['x1'] = np.maximum.reduceat(pieces['x1'], starts)
+    area = np.add.reduceat(pieces['area'], starts)
+    table['area'] = area
+    table['bbox_area'] = (table['y1'] - table['y0']).astype(np.int64) * (table['x1'] - table['x0'])
+    table['cy'] = np.add.reduceat(pieces['sum_y'], starts) / area
+    table['cx'] = np.add.reduceat(pieces['sum_x'], starts) / area
+    for name in intensity_images:
+        table['mean_' + name] = np.add.reduceat(pieces['sum_' + name], starts) / area
+    return table
+
+
+def max_pool(img, factor):
+    '''
+    downsamples img by factor, every pixel of the result being the brightest pixel of its factor x factor block. the
+    blocks along the bottom and right edges may be smaller
+    '''
+    if img.dtype in (np.uint8, np.uint16, np.float32):
+        # the brightest pixel of the block starting at each pixel, then every factor-th one
+        return cv2.dilate(img, np.ones((factor, factor), np.uint8), anchor=(0, 0))[::factor, ::factor]
+    rows = np.maximum.reduceat(img, np.arange(0, img.shape[0], factor), axis=0)
+    return np.maximum.reduceat(rows, np.arange(0, img.shape[1], factor), axis=1)
+
+
+def coarse_objects(img, thresh_val, factor=COARSE_FACTOR):
+    '''
+    thresholds and labels img max pooled by factor, and returns the coarse objects as an object table in full
+    resolution coordinates. every object get_objs finds at thresh_val lies inside at least one of their boxes, as
+    8-connected pixels fall into the same or 8-connected blocks. boxes can overlap or nest, and a box can hold several
+    objects. area is the number of pixels in the object's blocks, an upper bound of its pixels above the threshold
+    '''
+    h, w = img.shape
+    coarse = max_pool(img, factor) > thresh_val
+    n, labels, stats, _ = cv2.connectedComponentsWithStats(coarse.view(np.uint8), connectivity=8, ltype=cv2.CV_32S)
+    x0, y0 = stats[1:, cv2.CC_STAT_LEFT], stats[1:, cv2.CC_STAT_TOP]
+    boxes = (y0, x0, y0 + stats[1:, cv2.CC_STAT_HEIGHT], x0 + stats[1:, cv2.CC_STAT_WIDTH])
+    table = label_image_table(labels, n - 1, boxes=boxes)
+    table['y0'] *= factor
+    table['x0'] *= factor
+    table['y1'] = np.minimum(table['y1'] * factor, h)
+    table['x1'] = np.minimum(table['x1'] * factor, w)
+    table['area'] *= factor ** 2
+    table['bbox_area'] = (table['y1'] - table['y0']).astype(np.int64) * (table['x1'] - table['x0'])
+    table['cy'] = (table['cy'] + 0.5) * factor
+    table['cx'] = (table['cx'] + 0.5) * factor
+    return table
+
+
+def get_objs_coarse_to_fine(img, thresh_val, factor=COARSE_FACTOR, tile_size=512, intensity_images=None):
+    '''
+    segments img the way get_objs(img, thresh_val, as_table=True) does, but only labels it at full resolution in the
+    tile_size squares where the image max pooled by factor has pixels above thresh_val (see get_objs_tiled). no object
+    can be in the other tiles, so the table is exactly the whole image one, labels included
+    '''
+    coarse = max_pool(img, factor) > thresh_val
+    # whole blocks to a tile, so every block is in exactly one tile
+    blocks = -(-tile_size // factor)
+    by, bx = np.nonzero(coarse)
+    tiles = np.unique((by // blocks).astype(np.int64) * (coarse.shape[1] // blocks + 1) + bx // blocks)
+    ty, tx = np.divmod(tiles, coarse.shape[1] // blocks + 1)
+    occupied = set(zip((ty * blocks * factor).tolist(), (tx * blocks * factor).tolist()))
+    return get_objs_tiled(img, thresh_val, blocks * factor, 1, intensity_images, occupied)
+
+
+def label_image_table(labels, n, intensity_images=None, boxes=None):
+    '''
+    builds the object table of a label image with labels 1 to n, from counts over its labelled pixels rather than by
+    grouping the pixels by label (see object_table). boxes are the y0, x0, y1, x1 columns if the labelling already
+    found them. the objects are numbered by their first pixel in raster order, like measure.label, whatever order the
+    labels were in
+    '''
+    intensity_images = intensity_images or {}
+    table = np.zeros(n, dtype=object_dtype(list(intensity_images.keys())))
+    if n == 0:
+        return table
+    flat = labels.ravel()
+    idx = np.flatnonzero(flat)
+    lab = flat[idx]
+    rows, cols = np.divmod(idx, labels.shape[1])
+    if boxes is None:
+        boxes = np.array([(s[0].start, s[1].start, s[0].stop, s[1].stop)
+                          for s in scipy.ndimage.find_objects(labels, n)]).T
+    y0, x0, y1, x1 = boxes
+    # the first pixel of an object is the leftmost one in its top row
+    top = rows == y0[lab - 1]
+    first_col = np.full(n, labels.shape[1])
+    np.minimum.at(first_col, lab[top] - 1, cols[top])
+    order = np.argsort(y0.astype(np.int64) * labels.shape[1] + first_col, kind='stable')
+    area = np.bincount(lab, minlength=n + 1)[1:]
+    table['y0'], table['x0'], table['y1'], table['x1'] = y0, x0, y1, x1
+    table['area'] = area
+    table['bbox_area'] = (table['y1'] - table['y0']).astype(np.int64) * (table['x1'] - table['x0'])
+    table['cy'] = np.bincount(lab, weights=rows, minlength=n + 1)[1:] / area
+    table['cx'] = np.bincount(lab, weights=cols, minlength=n + 1)[1:] / area
+    for name, img in intensity_images.items():
+        table['mean_' + name] = np.bincount(lab, weights=img.ravel()[idx], minlength=n + 1)[1:] / area
+    table = table[order]
+    table['label'] = np.arange(1, n + 1)
+    return table
+
+
+def label_components(labels):
+    '''
+    takes a label image and returns the flat indices of its labelled pixels grouped by label (raster order within a
+    label) and the start of each label's group
+    '''
+    flat = labels.ravel()
+    idx = np.flatnonzero(flat)
+    order = np.argsort(flat[idx], kind='stable')
+    starts = np.flatnonzero(np.diff(flat[idx][order], prepend=0))
+    return idx[order], starts
+
+
+def object_dtype(channels=()):
+    return np.dtype([('label', np.int32), ('y0', np.int32), ('x0', np.int32), ('y1', np.int32), ('x1', np.int32),
+                     ('area', np.int64), ('bbox_area', np.int64), ('cy', np.float32), ('cx', np.float32)] +
+                    [('mean_' + c, np.float32) for c in channels])
+
+
+def object_table(shape, flat_idx, starts, intensity_images=None):
+    '''
+    builds the structured object table of one channel from its grouped object pixels (see label_components): label
+    id, bounding box (y1 and x1 exclusive, like the slices), pixel area, bounding box area, centroid and the mean of
+    every image in intensity_images over the object, in columns named mean_<channel>
+    '''
+    intensity_images = intensity_images or {}
+    table = np.zeros(len(starts), dtype=object_dtype(list(intensity_images.keys())))
+    if len(starts) == 0:
+        return table
+    rows, cols = np.divmod(flat_idx, shape[1])
+    area = np.diff(starts, append=len(flat_idx))
+    table['label'] = np.arange(1, len(starts) + 1)
+    # pixels are in raster order within each object, so the first and last rows are the first and last pixels
+    table['y0'] = rows[starts]
+    table['y1'] = rows[np.append(starts[1:], len(flat_idx)) - 1] + 1
+    table['x0'] = np.minimum.reduceat(cols, starts)
+    table['x1'] = np.maximum.reduceat(cols, starts) + 1
+    table['area'] = area
+    table['bbox_area'] = (table['y1'] - table['y0']).astype(np.int64) * (table['x1'] - table['x0'])
+    table['cy'] = np.add.reduceat(rows, starts) / area
+    table['cx'] = np.add.reduceat(cols, starts) / area
+    for name, img in intensity_images.items():
+        table['mean_' + name] = np.add.reduceat(img.ravel()[flat_idx], starts, dtype=np.int64) / area
+    return table
+
+
+def table_slices(table):
+    '''
+    converts an object table back to the list of (row slice, column slice) tuples find_objects returns
+    '''
+    return [(slice(y0, y1), slice(x0, x1)) for y0, y1, x0, x1 in zip(table['y0'].tolist(), table['y1'].tolist(),
+                                                                   table['x0'].tolist(), table['x1'].tolist())]
+
+
+def table_centers(table):
+    '''
+    returns the integer bounding box centres of the objects in a table as (x, y) columns
+    '''
+    x = (table['x0'] + (table['x1'] - table['x0']) / 2).astype(int)
+    y = (table['y0'] + (table['y1'] - table['y0']) / 2).astype(int)
+    return x, y
+
+
+def table_boxes(table):
+    '''
+    returns the bounding boxes of an object table as an (n, 4) array of x0, y0, x1, y1
+    '''
+    return np.stack([table['x0'], table['y0'], table['x1'], table['y1']], axis=1)
+
+
+def label_image(shape, flat_idx, starts):
+    '''
+    builds the label image of grouped object pixels (see label_components), the same one measure.label returns
+    '''
+    labels = np.zeros(shape, dtype=np.int32)
+    area = np.diff(starts, append=len(flat_idx))
+    labels.ravel()[flat_idx] = np.repeat(np.arange(1, len(starts) + 1, dtype=np.int32), area)
+    return labels
+
+
+def association_dtype(channels, intensity_channels=()):
+    return np.dtype([('label', np.int32), ('area', np.int64)] +
+                    [(f + c, t) for c in channels for f, t in [('n_', np.int32), ('object_', np.int32),
+                                                               ('overlap_', np.float32), ('positive_', np.bool_)]] +
+                    [('mean_' + c, np.float32) for c in intensity_channels])
+
+
+def match_channel(labels, components):
+    '''
+    matches the objects of one channel, given as grouped pixels (see label_components), to the nuclei of a nuclear label
+    image: every object pixel looks up the nucleus label under it. returns the overlapping (nucleus, object, overlap in
+    pixels) pairs sorted by nucleus and object
+    '''
+    flat_idx, starts = components
+    m = len(starts)
+    obj = np.repeat(np.arange(1, m + 1, dtype=np.int64), np.diff(starts, append=len(flat_idx)))
+    hit = labels.ravel()[flat_idx]
+    inside = hit > 0
+    keys, overlap = np.unique(hit[inside].astype(np.int64) * (m + 1) + obj[inside], return_counts=True)
+    pair_nucleus, pair_object = np.divmod(keys, m + 1)
+    return np.rec.fromarrays([pair_nucleus.astype(np.int32), pair_object.astype(np.int32), overlap],
+                             names=['nucleus', 'object', 'overlap'])
+
+
+def nucleus_means(nucleus_components, intensity_images):
+    flat_idx, starts = nucleus_components
+    if len(starts) == 0:
+        return {name: np.zeros(0) for name in intensity_images}
+    area = np.diff(starts, append=len(flat_idx))
+    return {name: np.add.reduceat(img.ravel()[flat_idx], starts, dtype=np.int64) / area
+            for name, img in intensity_images.items()}
+
+
+def association_table(area, pairs, means, min_overlap=0.0):
+    '''
+    builds the per nucleus table (see associate_objects) from the nuclei's areas, the pairs of every channel (see
+    match_channel) and the nuclei's mean intensities
+    '''
+    n = len(area)
+    table = np.zeros(n, dtype=association_dtype(list(pairs.keys()), list(means.keys())))
+    table['label'] = np.arange(1, n + 1)
+    table['area'] = area
+    for name, p in pairs.items():
+        pair_nucleus, pair_object, overlap = p['nucleus'], p['object'], p['overlap']
+        # every object pixel is in one object, so the overlaps of a nucleus add up to the pixels of it covered
+        covered = np.bincount(pair_nucleus, weights=overlap, minlength=n + 1)[1:]
+        table['n_' + name] = np.bincount(pair_nucleus, minlength=n + 1)[1:]
+        table['overlap_' + name] = covered / np.maximum(area, 1)
+        table['positive_' + name] = table['overlap_' + name] > min_overlap
+        # pairs are sorted by nucleus, the largest overlap of each nucleus comes first once sorted by -overlap too
+        order = np.lexsort((-overlap, pair_nucleus))
+        best = order[np.flatnonzero(np.diff(pair_nucleus[order], prepend=-1))]
+        table['object_' + name][pair_nucleus[best] - 1] = pair_object[best]
+    for name, mean in means.items():
+        table['mean_' + name] = mean
+    return table
+
+
+def associate_objects(shape, nucleus_components, channel_components, intensity_images=None, min_overlap=0.0):
+    '''
+    matches every nucleus to the objects of the other channels it overlaps, from the grouped object pixels of the
+    nuclei and of each channel (see label_components). the nuclear label image is built once and every channel's
+    object pixels look up their nucleus in it (see match_channel), the overlaps are counted per (nucleus, object)
+    pair, so there are no pairwise box comparisons.
+    returns the per nucleus table, one row per nucleus in label order with for every channel: the number of objects
+    it overlaps (n_), the label of the one it overlaps most (object_, 0 for none), the fraction of the nucleus they
+    cover (overlap_), whether that is more than min_overlap (positive_) and the nucleus' mean intensity in each of
+    intensity_images. also returns the overlapping (nucleus, object, overlap in pixels) pairs of every channel
+    '''
+    labels = label_image(shape, *nucleus_components)
+    pairs = {name: match_channel(labels, components) for name, components in channel_components.items()}
+    area = np.diff(nucleus_components[1], append=len(nucleus_components[0]))
+    table = association_table(area, pairs, nucleus_means(nucleus_components, intensity_images or {}), min_overlap)
+    return table, pairs
+
+
+class NucleusAssociation:
+    '''
+    the per nucleus table of a well (see associate_objects) kept between thresholds: the nuclear label image and
+    intensities are only built again when the nuclear threshold changes, and a channel is only matched again when its
+    own threshold does, so moving one slider redoes one channel's pairing
+    '''
+
+    def __init__(self):
+        self._nucleus = None
+        self._pairs = {}
+        self._lock = threading.Lock()
+        # called whenever the association's memory changes, set by the channel cache holding it
+        self.cache_listener = None
+
+    def table(self, paths, nucleus, channelThreshValues, min_overlap=0.0, preprocess=None):
+        with self._lock:
+            thresh_val = channelThreshValues[nucleus]
+            if self._nucleus is None or self._nucleus[0] != thresh_val:
+                engine = threshold_engine(paths[nucleus], preprocess)
+                components = engine.components(thresh_val)
+                images = {name: read_gray(path) for name, path in paths.items()}
+                area = np.diff(components[1], append=len(components[0]))
+                self._nucleus = (thresh_val, label_image(engine.img.shape, *components), area,
+                                 nucleus_means(components, images))
+                self._pairs = {}
+            _, labels, area, means = self._nucleus
+            pairs = {}
+            for name, path in paths.items():
+                if name == nucleus:
+                    continue
+                cached = self._pairs.get(name)
+                if cached is None or cached[0] != channelThreshValues[name]:
+                    components = threshold_engine(path, preprocess).components(channelThreshValues[name])
+                    cached = (channelThreshValues[name], match_channel(labels, components))
+                pairs[name] = cached[1]
+                self._pairs[name] = cached
+        if self.cache_listener is not None:
+            self.cache_listener()
+        return association_table(area, pairs, means, min_overlap)
+
+    def buffers(self):
+        if self._nucleus is None:
+            return []
+        return [self._nucleus[1], self._nucleus[2]] + list(self._nucleus[3].values()) + \
+            [pairs for _, pairs in self._pairs.values()]
+
+    @property
+    def nbytes(self):
+        return sum(b.nbytes for b in self.buffers())
+
+
+class GridIndex:
+    '''
+    uniform grid spatial index over (x0, y0, x1, y1) boxes (x1 and y1 exclusive). boxes given up front are bucketed
+    with numpy, later ones can be added and removed one at a time. ids are the positions boxes were added in
+    '''
+
+    def __init__(self, boxes=None, cell_size=256):
+        self.cell_size = cell_size
+        self.boxes = np.zeros((0, 4)) if boxes is None else np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.alive = np.ones(len(self.boxes), dtype=bool)
+        self._extra = {}
+        # every (cell, box) pair, sorted by cell
+        cx0, cy0, cx1, cy1 = self._cell_ranges(self.boxes)
+        nx, ny = cx1 - cx0 + 1, cy1 - cy0 + 1
+        counts = nx * ny
+        ids = np.repeat(np.arange(len(self.boxes)), counts)
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        keys = self._key(np.repeat(cx0, counts) + within % np.repeat(nx, counts),
+                         np.repeat(cy0, counts) + within // np.repeat(nx, counts))
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self._ids = ids[order]
+        self._extent = (cx0.min(), cy0.min(), cx1.max(), cy1.max()) if len(self.boxes) else None
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    @staticmethod
+    def _key(cx, cy):
+        return (np.asarray(cy, dtype=np.int64) << 32) + cx
+
+    def _cell_ranges(self, boxes):
+        c = self.cell_size
+        return (np.floor_divide(boxes[:, 0], c).astype(np.int64), np.floor_divide(boxes[:, 1], c).astype(np.int64),
+                np.floor_divide(np.maximum(boxes[:, 2], boxes[:, 0]), c).astype(np.int64),
+                np.floor_divide(np.maximum(boxes[:, 3], boxes[:, 1]), c).astype(np.int64))
+
+    def add(self, box):
+        i = len(self.boxes)
+        self.boxes = np.vstack([self.boxes, np.asarray(box, dtype=np.float64).reshape(1, 4)])
+        self.alive = np.append(self.alive, True)
+        cx0, cy0, cx1, cy1 = [int(v[0]) for v in self._cell_ranges(self.boxes[i:])]
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                self._extra.setdefault(int(self._key(cx, cy)), []).append(i)
+        if self._extent is None:
+            self._extent = (cx0, cy0, cx1, cy1)
+        else:
+            self._extent = (min(self._extent[0], cx0), min(self._extent[1], cy0),
+                            max(self._extent[2], cx1), max(self._extent[3], cy1))
+        return i
+
+    def remove(self, i):
+        self.alive[i] = False
+
+    def _cell_ids(self, cx0, cy0, cx1, cy1):
+        if self._extent is None:
+            return np.zeros(0, dtype=np.intp)
+        # cells outside the occupied ones hold nothing
+        cx0, cy0 = max(cx0, self._extent[0]), max(cy0, self._extent[1])
+        cx1, cy1 = min(cx1, self._extent[2]), min(cy1, self._extent[3])
+        found = []
+        for cy in range(cy0, cy1 + 1):
+            # the keys of one row of cells are contiguous
+            lo = np.searchsorted(self._keys, self._key(cx0, cy), side='left')
+            hi = np.searchsorted(self._keys, self._key(cx1, cy), side='right')
+            found.append(self._ids[lo:hi])
+            if not self._extra:
+                continue
+            for cx in range(cx0, cx1 + 1):
+                extra = self._extra.get(int(self._key(cx, cy)))
+                if extra:
+                    found.append(np.asarray(extra))
+        if not found:
+            return np.zeros(0, dtype=np.intp)
+        ids = np.unique(np.concatenate(found).astype(np.intp))
+        return ids[self.alive[ids]]
+
+    def _ring_ids(self, cx, cy, ring):
+        # the cells exactly ring cells away from (cx, cy): a row above and below, a column left and right
+        if ring == 0:
+            return self._cell_ids(cx, cy, cx, cy)
+        return np.concatenate([self._cell_ids(cx - ring, cy - ring, cx + ring, cy - ring),
+                               self._cell_ids(cx - ring, cy + ring, cx + ring, cy + ring),
+                               self._cell_ids(cx - ring, cy - ring + 1, cx - ring, cy + ring - 1),
+                               self._cell_ids(cx + ring, cy - ring + 1, cx + ring, cy + ring - 1)])
+
+    def query_point(self, x, y):
+        '''
+        returns the ids of the boxes containing the point
+        '''
+        cx, cy = int(x // self.cell_size), int(y // self.cell_size)
+        ids = self._cell_ids(cx, cy, cx, cy)
+        b = self.boxes[ids]
+        return ids[(b[:, 0] <= x) & (x < b[:, 2]) & (b[:, 1] <= y) & (y < b[:, 3])]
+
+    def query_rect(self, x0, y0, x1, y1):
+        '''
+        returns the ids of the boxes intersecting the rectangle
+        '''
+        cx0, cy0, cx1, cy1 = [int(v[0]) for v in self._cell_ranges(np.array([[x0, y0, x1, y1]], dtype=np.float64))]
+        ids = self._cell_ids(cx0, cy0, cx1, cy1)
+        b = self.boxes[ids]
+        return ids[(b[:, 0] < x1) & (x0 < b[:, 2]) & (b[:, 1] < y1) & (y0 < b[:, 3])]
+
+    def nearest(self, x, y, max_distance=None):
+        '''
+        returns the id of the box whose centre is closest to the point, or None. the cells are searched in rings around
+        the point, from the first ring that reaches the occupied cells, until nothing closer can be left. once the rings
+        have visited more cells than there are boxes, the rest is a scan over every box
+        '''
+        if not self.alive.any():
+            return None
+        c = self.cell_size
+        cx, cy = int(x // c), int(y // c)
+        ex0, ey0, ex1, ey1 = [int(v) for v in self._extent]
+        first_ring = max(ex0 - cx, cx - ex1, ey0 - cy, cy - ey1, 0)
+        max_ring = max(abs(cx - ex0), abs(ex1 - cx), abs(cy - ey0), abs(ey1 - cy))
+        best, best_distance = None, np.inf
+        visited, scan = 0, False
+        for ring in range(first_ring, max_ring + 1):
+            if max_distance is not None and (ring - 1) * c > max_distance:
+                break
+            scan = visited > len(self.boxes)
+            if scan:
+                ids = np.flatnonzero(self.alive)
+            else:
+                ids = self._ring_ids(cx, cy, ring)
+                visited += max(8 * ring, 1)
+            if len(ids):
+                b = self.boxes[ids]
+                distance = np.hypot((b[:, 0] + b[:, 2]) / 2 - x, (b[:, 1] + b[:, 3]) / 2 - y)
+                i = np.argmin(distance)
+                if distance[i] < best_distance:
+                    best, best_distance = int(ids[i]), distance[i]
+            # anything not seen yet has its centre at least this far away, and after a scan nothing is left
+            if best_distance <= ring * c or scan:
+                break
+        if max_distance is not None and best_distance > max_distance:
+            return None
+        return best
+
+    def best_match(self, x0, y0, x1, y1):
+        '''
+        returns the id of the box overlapping the rectangle the most, or the nearest one if none overlap
+        '''
+        ids = self.query_rect(x0, y0, x1, y1)
+        if len(ids) == 0:
+            return self.nearest((x0 + x1) / 2, (y0 + y1) / 2)
+        b = self.boxes[ids]
+        overlap = (np.minimum(b[:, 2], x1) - np.maximum(b[:, 0], x0)) * \
+                  (np.minimum(b[:, 3], y1) - np.maximum(b[:, 1], y0))
+        return int(ids[np.argmax(overlap)])
+
+
+def _percentile_from_cdf(cdf, q):
+    # same linear interpolation np.percentile does on the sorted pixel values
+    pos = (cdf[-1] - 1) * q / 100
+    lo = int(np.floor(pos))
+    v_lo, v_hi = np.searchsorted(cdf, [lo, min(lo + 1, cdf[-1] - 1)], side='right')
+    return v_lo + (v_hi - v_lo) * (pos - lo)
+
+
+class ThresholdEngine:
+    '''
+    segments one integer channel image at any threshold. the pixels above a base threshold and the 8-connected edges
+    between them (weighted by the dimmer of the two pixels) are found once, so any threshold at or above the base only
+    runs connected components over those pixels instead of relabelling the whole image. the objects are the same, and
+    in the same order, as get_objs returns
+    '''
+    # past this foreground fraction the pixel graph would be bigger than just labelling the image
+    max_graph_fraction = 0.25
+
+    def __init__(self, img, max_results=64):
+        self.img = img
+        self.max_results = max_results
+        self._cdf = None
+        self._base = None
+        self._results = OrderedDict()
+        self._last_components = None
+        self._lock = threading.RLock()
+        # called whenever the engine's memory changes, set by the channel cache holding it
+        self.cache_listener = None
+
+    def _grew(self):
+        if self.cache_listener is not None:
+            self.cache_listener()
+
+    def histogram(self):
+        if self._cdf is None:
+            self._cdf = np.cumsum(np.bincount(self.img.ravel()))
+            self._grew()
+        return np.diff(self._cdf, prepend=0)
+
+    def percentile(self, q):
+        self.histogram()
+        return _percentile_from_cdf(self._cdf, q)
+
+    def default_threshold(self):
+        # np.median(img) + 3 * scipy.stats.iqr(img), from the histogram rather than two full sorts
+        return self.percentile(50) + 3 * (self.percentile(75) - self.percentile(25))
+
+    def base_floor(self, thresh_val=None):
+        '''
+        the threshold the base is built at up front: halfway between the median and the preset, or thresh_val if that
+        is lower, but not so low that the foreground is more than max_graph_fraction of the image
+        '''
+        self.histogram()
+        floor = (self.percentile(50) + self.default_threshold()) / 2
+        if thresh_val is not None:
+            floor = min(floor, thresh_val)
+        # the foreground above v is cdf[-1] - cdf[v] pixels
+        lowest = int(np.searchsorted(self._cdf, self._cdf[-1] * (1 - self.max_graph_fraction)))
+        return max(floor, lowest)
+
+    def prepare(self, thresh_val=None):
+        '''
+        builds the base at base_floor now, so a slider dragged below the threshold the objects were found at still only
+        runs connected components over the base instead of building it again
+        '''
+        with self._lock:
+            floor = self.base_floor(thresh_val)
+            if (self._base is None or floor < self._base[0]) and self._fits_graph(floor):
+                self._build_base(floor)
+                self._grew()
+
+    def objects(self, thresh_val):
+        return table_slices(self.table(thresh_val))
+
+    def table(self, thresh_val, intensity_images=None):
+        '''
+        returns the object table at thresh_val, with mean intensity columns for intensity_images if given
+        '''
+        with self._lock:
+            table = self._results.get(thresh_val)
+            if table is None:
+                table = object_table(self.img.shape, *self.components(thresh_val))
+                self._results[thresh_val] = table
+                if len(self._results) > self.max_results:
+                    self._results.popitem(last=False)
+                self._grew()
+            else:
+                self._results.move_to_end(thresh_val)
+            if not intensity_images:
+                return table
+            full = np.zeros(len(table), dtype=object_dtype(list(intensity_images.keys())))
+            for name in table.dtype.names:
+                full[name] = table[name]
+            if len(table) == 0:
+                return full
+            flat_idx, starts = self.components(thresh_val)
+            for name, img in intensity_images.items():
+                full['mean_' + name] = np.add.reduceat(img.ravel()[flat_idx], starts, dtype=np.int64) / table['area']
+            return full
+
+    def components(self, thresh_val):
+        '''
+        returns the grouped object pixels at thresh_val, as label_components does
+        '''
+        with self._lock:
+            if self._last_components is not None and self._last_components[0] == thresh_val:
+                return self._last_components[1]
+            # a base that would be too big is never built, and one built higher up is kept for later thresholds
+            if (self._base is None or thresh_val < self._base[0]) and self._fits_graph(thresh_val):
+                self._build_base(thresh_val)
+            if self._base is None or thresh_val < self._base[0]:
+                _, thresh1 = cv2.threshold(self.img, thresh_val, 255, cv2.THRESH_BINARY)
+                components = label_components(measure.label(thresh1.astype(np.uint8), background=0))
+            else:
+                components = self._graph_components(thresh_val)
+            self._last_components = (thresh_val, components)
+            self._grew()
+            return components
+
+    def buffers(self):
+        '''
+        the arrays the engine holds: the image, its histogram, the base pixel graph and the cached results
+        '''
+        buffers = [self.img] + list(self._results.values())
+        if self._cdf is not None:
+            buffers.append(self._cdf)
+        if self._base is not None:
+            buffers += list(self._base[1:])
+        if self._last_components is not None:
+            buffers += list(self._last_components[1])
+        return buffers
+
+    @property
+    def nbytes(self):
+        return sum({id(b): b.nbytes for b in self.buffers()}.values())
+
+    def _fits_graph(self, thresh_val):
+        # whether the pixels above thresh_val are few enough for a base, counted from the histogram
+        self.histogram()
+        v = int(np.floor(thresh_val))
+        foreground = self._cdf[-1] - (self._cdf[min(v, len(self._cdf) - 1)] if v >= 0 else 0)
+        return foreground <= self.max_graph_fraction * self.img.size
+
+    def _build_base(self, thresh_val):
+        h, w = self.img.shape
+        flat = self.img.ravel()
+        idx = np.flatnonzero(flat > thresh_val)
+        vals = flat[idx]
+        cols = idx % w
+        edges_a, edges_b = [], []
+        # forward neighbours: right, down-left, down, down-right
+        for offset, valid in ((1, cols < w - 1), (w - 1, cols > 0), (w, None), (w + 1, cols < w - 1)):
+            pos = np.searchsorted(idx, idx + offset)
+            pos[pos == len(idx)] = 0
+            hit = idx[pos] == idx + offset
+            if valid is not None:
+                hit &= valid
+            edges_a.append(np.flatnonzero(hit))
+            edges_b.append(pos[hit])
+        edges_a = np.concatenate(edges_a)
+        edges_b = np.concatenate(edges_b)
+        weights = np.minimum(vals[edges_a], vals[edges_b])
+        self._base = (thresh_val, idx, vals, edges_a, edges_b, weights)
+
+    def _graph_components(self, thresh_val):
+        _, idx, vals, edges_a, edges_b, weights = self._base
+        keep = vals > thresh_val
+        kept_edges = weights > thresh_val
+        n = len(idx)
+        graph = scipy.sparse.coo_matrix((np.ones(kept_edges.sum(), dtype=np.int8),
+                                         (edges_a[kept_edges], edges_b[kept_edges])), shape=(n, n))
+        _, comp = scipy.sparse.csgraph.connected_components(graph, directed=False)
+        comp = comp[keep]
+        if len(comp) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+        # pixels are in raster order, so numbering components by first appearance matches measure.label
+        _, first, comp = np.unique(comp, return_index=True, return_inverse=True)
+        rank = np.empty(len(first), dtype=np.intp)
+        rank[np.argsort(first)] = np.arange(len(first))
+        comp = rank[comp.ravel()]
+        order = np.argsort(comp, kind='stable')
+        starts = np.flatnonzero(np.diff(comp[order], prepend=-1))
+        return idx[keep][order], starts
 
 
 def draw_objects(img, objs, color):
@@ -56,40 +913,328 @@ def draw_objects(img, objs, color):
     return img
 
 
-def get_obj_channels(d, channelThreshValues=None):
+def to_gray8(img):
+    '''
+    converts a decoded image to single channel 8 bit the same way cv2.imread(path, 0) does
+    '''
+    if img.ndim == 3:
+        img = cv2.cvtColor(img[..., :3], cv2.COLOR_RGB2GRAY)
+    if img.dtype == np.uint8:
+        return img
+    if img.dtype == np.uint16:
+        return cv2.convertScaleAbs(img, alpha=1 / 256)
+    return cv2.convertScaleAbs(img)
+
+
+def to_gray(img):
+    '''
+    converts a decoded image to single channel, keeping 8 and 16 bit images in their native dtype
+    '''
+    if img.ndim == 3:
+        img = cv2.cvtColor(img[..., :3], cv2.COLOR_RGB2GRAY)
+    if img.dtype in (np.uint8, np.uint16):
+        return img
+    return to_gray8(img)
+
+
+def to_display8(img):
+    '''
+    converts a decoded image to 8 bit grayscale or RGB for display
+    '''
+    if img.ndim == 3:
+        img = img[..., :3]
+        if img.dtype != np.uint8:
+            img = cv2.convertScaleAbs(img, alpha=1 / 256 if img.dtype == np.uint16 else 1)
+        return np.ascontiguousarray(img)
+    return to_gray8(img)
+
+
+class ImagePyramid:
+    '''
+    an 8 bit image and its power of two downsampled levels, level 0 being the full resolution image. levels are only
+    computed the first time they are asked for
+    '''
+
+    def __init__(self, img, min_size=256):
+        self.levels = [img]
+        self.shape = img.shape[:2]
+        self.n_levels = 1
+        while max(self.shape) / 2 ** self.n_levels >= min_size:
+            self.n_levels += 1
+        # called whenever a level is added, set by the channel cache holding it
+        self.cache_listener = None
+
+    def level(self, i):
+        i = min(i, self.n_levels - 1)
+        if len(self.levels) <= i:
+            while len(self.levels) <= i:
+                prev = self.levels[-1]
+                size = ((prev.shape[1] + 1) // 2, (prev.shape[0] + 1) // 2)
+                self.levels.append(cv2.resize(prev, size, interpolation=cv2.INTER_AREA))
+            if self.cache_listener is not None:
+                self.cache_listener()
+        return self.levels[i]
+
+    def buffers(self):
+        return list(self.levels)
+
+    def level_shape(self, i):
+        return self.level(i).shape[:2]
+
+    def region(self, i, y0, y1, x0, x1):
+        return self.level(i)[y0:y1, x0:x1]
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+
+def stretch_to_display8(img, low=0.5, high=99.8):
+    '''
+    converts a decoded image to 8 bit grayscale for display, stretching its low to high percentile pixel values over
+    the full 0-255 range. 8 and 16 bit images are mapped through a lookup table built from their histogram
+    '''
+    gray = to_gray(img)
+    cdf = np.cumsum(np.bincount(gray.ravel(), minlength=256))
+    lo, hi = _percentile_from_cdf(cdf, low), _percentile_from_cdf(cdf, high)
+    lut = np.clip((np.arange(len(cdf)) - lo) * 255 / max(hi - lo, 1), 0, 255).round().astype(np.uint8)
+    if gray.dtype == np.uint8:
+        return cv2.LUT(gray, lut)
+    return lut[gray]
+
+
+def channel_lut(color, brightness=0, contrast=1.0):
+    '''
+    returns the (256, 3) lookup table that shows an 8 bit display channel in an (r, g, b) color, after a contrast gain
+    around mid grey and a brightness offset
+    '''
+    values = np.clip((np.arange(256) - 127.5) * contrast + 127.5 + brightness, 0, 255)
+    return np.round(values[:, None] * np.asarray(color, dtype=float)[None] / 255).astype(np.uint8)
+
+
+class CompositePyramid:
+    '''
+    the channel pyramids of a well blended into one RGB image, each channel through its own lookup table (see
+    channel_lut) and added with saturation. it only blends the regions it is asked for, so changing a lookup table
+    costs nothing until the view is drawn again. it has the shape of an ImagePyramid, so TiledImageItem can draw it
+    '''
+
+    def __init__(self, pyramids, luts):
+        self.pyramids = pyramids
+        self.luts = luts
+        self.shape = pyramids[0].shape
+        self.n_levels = min(pyramid.n_levels for pyramid in pyramids)
+
+    def level_shape(self, i):
+        return self.pyramids[0].level_shape(i)
+
+    def region(self, i, y0, y1, x0, x1):
+        out = None
+        for pyramid, lut in zip(self.pyramids, self.luts):
+            if not lut.any():
+                # switched off
+                continue
+            part = lut[pyramid.region(i, y0, y1, x0, x1)]
+            out = part if out is None else cv2.add(out, part)
+        if out is None:
+            h, w = self.level_shape(i)
+            out = np.zeros((len(range(h)[y0:y1]), len(range(w)[x0:x1]), 3), dtype=np.uint8)
+        return out
+
+    def level(self, i):
+        return self.region(i, None, None, None, None)
+
+
+def read_gray(path):
+    return channel_cache.get_derived(path, 'gray', to_gray)
+
+
+def threshold_engine(path, preprocess=None):
+    '''
+    returns the cached ThresholdEngine of a channel image, so re-running auto find at new thresholds reuses it. it
+    segments the image in its native dtype, so thresholds are in native pixel values, after the preprocessing
+    '''
+    preprocess = preprocess or DEFAULT_PREPROCESS
+    return channel_cache.get_derived(path, 'engine_' + preprocess,
+                                     lambda img: ThresholdEngine(preprocess_image(to_gray(img), preprocess)))
+
+
+def get_obj_channel_paths(d):
+    '''
+    returns the paths of the fluorescence channels of a well directory, keyed by the channel names auto find uses
+    '''
+    return {name: os.path.join(d, channel['file']) for name, channel in well_manifest(d)['channels'].items()
+            if 'Default' not in channel['file']}
+
+
+def segment_channel(path, thresh_val=None, intensity_paths=None, tile_size=None, workers=1, backend=None,
+                    preprocess=None):
+    '''
+    reads one channel image and returns its objects and the threshold used, the preset one if thresh_val is None.
+    the objects are an object table with the mean intensity of every channel in intensity_paths if that is given.
+    with tile_size the image is segmented in tiles (see get_objs_tiled), workers of them at a time, otherwise by the
+    backend (see segment_objects). the intensities are measured on the images as they are, not preprocessed
+    '''
+    with span('segment_channel', channel=os.path.basename(path)):
+        with span('threshold engine'):
+            engine = threshold_engine(path, preprocess)
+        if thresh_val is None:
+            thresh_val = engine.default_threshold()
+        images = None
+        if intensity_paths is not None:
+            with span('intensity images'):
+                images = {name: read_gray(p) for name, p in intensity_paths.items()}
+        backend = backend or DEFAULT_BACKEND
+        with span('segment', backend=backend, tile_size=tile_size, threshold=thresh_val):
+            if tile_size is not None:
+                table = get_objs_tiled(engine.img, thresh_val, tile_size, workers, images)
+            elif backend == 'engine':
+                # the cached engine, so later thresholds of the same channel are quick
+                table = engine.table(thresh_val, images)
+            else:
+                table = SEGMENTATION_BACKENDS[backend](engine.img, thresh_val, images)
+        return (table if images is not None else table_slices(table)), thresh_val
+
+
+def filter_objects(table, min_area=100, max_area=1E6):
+    '''
+    drops the objects of a table whose bounding box is super small or super large
+    '''
+    return table[(table['bbox_area'] > min_area) & (table['bbox_area'] < max_area)]
+
+
+@traced()
+def get_obj_channels(d, channelThreshValues=None, workers=1, use_processes=False, as_table=False, tile_size=None,
+                     backend=None, preprocess=None):
     '''
-    takes a well image directory and returns the boxes for all of the fluorescence channels
+    takes a well image directory and returns the boxes for all of the fluorescence channels. with workers > 1 the
+    channels are segmented concurrently in a thread (or process) pool, the results are the same as the serial path.
+    with as_table each channel gets an object table, including the mean intensity of every channel, instead. with
+    tile_size the channels are segmented one after the other in tiles, workers tiles at a time, to bound memory.
+    backend and preprocess are passed on to segment_channel
     '''
+    channel_paths = get_obj_channel_paths(d)
+    intensity_paths = channel_paths if as_table else None
     obj_channels = {}
     tempDict = {}
     color_name = ['red', 'green', 'blue']
-    i = 0
-    for f in os.listdir(d):
-        if '.tif' in f and 'Default' not in f:
-            name = f.split('-')[-1].split('.tif')[0]
-            print('processing:', name, 'to be boxed in', color_name[i])
-            img = cv2.imread(os.path.join(d, f), 0)
-            if channelThreshValues != None:
-                # threshold on the values we have input
-                objs = get_objs(img, channelThreshValues[name])
-                tempDict[name] = channelThreshValues[name]
-            else:
-                # otherwise threshold on the preset, and return it
-                objs = get_objs(img, np.median(img) + 3 * scipy.stats.iqr(img))
-                tempDict[name] = np.median(img) + 3 * scipy.stats.iqr(img)
-            obj_channels[name] = objs
-            i += 1
+    jobs = []
+    for name, path in channel_paths.items():
+        print('processing:', name, 'to be boxed in', color_name[len(jobs) % len(color_name)])
+        if channelThreshValues != None:
+            # threshold on the values we have input, channels left out of them on the preset
+            jobs.append((name, path, channelThreshValues.get(name)))
+        else:
+            # otherwise threshold on the preset, and return it
+            jobs.append((name, path, None))
+    if tile_size is not None:
+        results = [segment_channel(path, thresh, intensity_paths, tile_size, workers, backend, preprocess)
+                   for _, path, thresh in jobs]
+    elif workers > 1 and len(jobs) > 1:
+        pool_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with pool_type(max_workers=min(workers, len(jobs))) as pool:
+            futures = [pool.submit(segment_channel, path, thresh, intensity_paths, None, 1, backend, preprocess)
+                       for _, path, thresh in jobs]
+            # collected in submission order so the dict keeps the directory order
+            results = [future.result() for future in futures]
+    else:
+        results = [segment_channel(path, thresh, intensity_paths, None, 1, backend, preprocess)
+                   for _, path, thresh in jobs]
+    for (name, _, _), (objs, thresh) in zip(jobs, results):
+        obj_channels[name] = objs
+        tempDict[name] = thresh
     return obj_channels, tempDict
 
 
+def nucleus_channel(names):
+    '''
+    returns which of the channel names is the nuclear stain, or None
+    '''
+    for name in ['DAPI', 'dapi']:
+        if name in names:
+            return name
+    return None
+
+
+@traced()
+def well_nucleus_table(d, channelThreshValues, min_overlap=0.0, preprocess=None):
+    '''
+    segments the channels of a well at the given thresholds and returns the per nucleus table of the nuclear channel's
+    objects (see associate_objects) with the mean intensity of every channel, or None if the well has no nuclear
+    channel. the segmentations come from the cached ThresholdEngines, so after auto find this only does the matching,
+    and only for the channels whose thresholds changed since the last call (see NucleusAssociation)
+    '''
+    paths = get_obj_channel_paths(d)
+    nucleus = nucleus_channel(paths)
+    if nucleus is None:
+        return None
+    association = channel_cache.get_derived(paths[nucleus], 'association_' + (preprocess or DEFAULT_PREPROCESS),
+                                            lambda img: NucleusAssociation())
+    return association.table(paths, nucleus, channelThreshValues, min_overlap, preprocess)
+
+
+def crop_into(dest, img, box):
+    '''
+    copies the (x0, y0, x1, y1) box of img into dest, an array of the box's shape. the parts of dest where the box hangs
+    over the edge of the image are left as they are
+    '''
+    x0, y0, x1, y1 = box
+    cy0, cx0 = max(y0, 0), max(x0, 0)
+    cy1, cx1 = min(y1, img.shape[0]), min(x1, img.shape[1])
+    if cy1 > cy0 and cx1 > cx0:
+        dest[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = img[cy0:cy1, cx0:cx1]
+
+
+def crops_into(dest, img, x0, y0, chunk=256):
+    '''
+    copies the squares of img whose top left corners are x0, y0 into dest, an (n, size, size) array. the squares
+    inside the image are copied chunk at a time as blocks of a sliding window view of img, the ones hanging over its
+    edge one at a time by crop_into, which leaves the parts outside the image as they are
+    '''
+    size = dest.shape[1]
+    x0, y0 = np.asarray(x0), np.asarray(y0)
+    inside = (x0 >= 0) & (y0 >= 0) & (x0 + size <= img.shape[1]) & (y0 + size <= img.shape[0])
+    rows = np.flatnonzero(inside)
+    if len(rows):
+        windows = np.lib.stride_tricks.sliding_window_view(img, (size, size))
+        for start in range(0, len(rows), chunk):
+            r = rows[start:start + chunk]
+            dest[r] = windows[y0[r], x0[r]]
+    for i in np.flatnonzero(~inside):
+        crop_into(dest[i], img, (x0[i], y0[i], x0[i] + size, y0[i] + size))
+
+
+@traced()
+def extract_crops(channel_paths, boxes, progress=None):
+    '''
+    decodes every channel image once and cuts all of the (x0, y0, x1, y1) boxes out of it in one pass, returning a
+    list with one (y, x, channels) array per box in the channels' native dtype. progress is called with (done, total)
+    after each channel
+    '''
+    crops = None
+    for i, path in enumerate(channel_paths):
+        img = channel_cache.get(path)
+        if crops is None:
+            crops = [np.zeros((y1 - y0, x1 - x0, len(channel_paths)), dtype=img.dtype) for x0, y0, x1, y1 in boxes]
+        elif crops and not np.can_cast(img.dtype, crops[0].dtype):
+            # an 8 bit channel next to 16 bit ones, the crops take the wider dtype
+            crops = [crop.astype(np.promote_types(crop.dtype, img.dtype)) for crop in crops]
+        for crop, box in zip(crops, boxes):
+            # the parts of a box hanging over the edge of the image (zoomed out meta annotations) stay zero
+            crop_into(crop[..., i], img, box)
+        if progress is not None:
+            progress(i + 1, len(channel_paths))
+    return crops if crops is not None else [np.zeros((y1 - y0, x1 - x0, 0)) for x0, y0, x1, y1 in boxes]
+
+
 def draw_all_channels(d):
     '''
     returns an image with all fluorescence channel boxes drawn on it
     '''
     obj_channels = get_obj_channels(d)
-    for f in os.listdir(d):
-        if '.tif' in f and 'Default' in f:
-            img = cv2.imread(os.path.join(d, f))
+    for channel in well_manifest(d)['channels'].values():
+        if 'Default' in channel['file']:
+            img = cv2.imread(os.path.join(d, channel['file']))
     for i, [k, v] in enumerate(obj_channels.items()):
         colors = [0, 0, 0]
         colors[i] = 255
@@ -99,7 +1244,7 @@ def draw_all_channels(d):
 
 def validateDirectoryFormat(dir):
     count = 0
-    for f in os.listdir(dir):
+    for f in well_manifest(dir)['files']:
         if '.yml' in f:
             count += 1
         elif '.tif' in f:
@@ -109,8 +1254,133 @@ def validateDirectoryFormat(dir):
     return False
 
 
+DETECTIONS_FILE = 'lcl_objects.npz'
+THRESHOLDS_FILE = 'lcl_thresholds.json'
+# the per nucleus table is stored in the detections file next to the channels' object tables
+NUCLEI_KEY = '_nuclei'
+
+
+def find_well_directories(root, index=None):
+    '''
+    returns every directory below root (root included) that looks like a well record with fluorescence channels. with
+    index the directory manifests are kept in a persistent index at root (see manifest.ExperimentIndex) and only the
+    directories that changed since are listed again, by default that is done if root already has an index
+    '''
+    if index is None:
+        index = os.path.exists(os.path.join(root, INDEX_DIRECTORY, INDEX_FILE))
+    return ExperimentIndex(root).refresh(save=index).wells()
+
+
+def _source_stamps(d):
+    stamps = {}
+    for name, path in get_obj_channel_paths(d).items():
+        st = os.stat(path)
+        stamps[name] = [st.st_mtime_ns, st.st_size]
+    return stamps
+
+
+def save_well_detections(d, obj_channels, channelThreshValues, nuclei=None, preprocess=None):
+    '''
+    stores the object tables of a well, its per nucleus table and the thresholds and preprocessing they were found
+    with next to its images
+    '''
+    arrays = dict(obj_channels)
+    if nuclei is not None:
+        arrays[NUCLEI_KEY] = nuclei
+    np.savez(os.path.join(d, DETECTIONS_FILE), **arrays)
+    with open(os.path.join(d, THRESHOLDS_FILE), 'w') as f:
+        json.dump({'thresholds': {k: float(v) for k, v in channelThreshValues.items()},
+                   'sources': _source_stamps(d), 'units': 'native', 'preprocess': preprocess or DEFAULT_PREPROCESS},
+                  f, indent=1)
+
+
+def load_well_detections(d, channelThreshValues=None, preprocess=None):
+    '''
+    returns the stored (object tables, thresholds) of a well, or None if there are none, the images changed since or
+    they were found with other thresholds than channelThreshValues or another preprocessing
+    '''
+    meta = _load_detections_meta(d, channelThreshValues, preprocess)
+    if meta is None:
+        return None
+    try:
+        with np.load(os.path.join(d, DETECTIONS_FILE)) as data:
+            obj_channels = {k: data[k] for k in meta['thresholds']}
+    except (OSError, KeyError, ValueError):
+        return None
+    return obj_channels, meta['thresholds']
+
+
+def load_well_nuclei(d, channelThreshValues=None, preprocess=None):
+    '''
+    returns the stored per nucleus table of a well, or None if there is none or it is out of date, like
+    load_well_detections
+    '''
+    if _load_detections_meta(d, channelThreshValues, preprocess) is None:
+        return None
+    try:
+        with np.load(os.path.join(d, DETECTIONS_FILE)) as data:
+            return data[NUCLEI_KEY]
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _load_detections_meta(d, channelThreshValues, preprocess=None):
+    try:
+        with open(os.path.join(d, THRESHOLDS_FILE)) as f:
+            meta = json.load(f)
+        # thresholds used to be on 8 bit copies of the images
+        if meta['sources'] != _source_stamps(d) or meta.get('units') != 'native':
+            return None
+        if meta.get('preprocess', 'none') != (preprocess or DEFAULT_PREPROCESS):
+            return None
+        if channelThreshValues is not None and \
+                any(float(channelThreshValues[k]) != v for k, v in meta['thresholds'].items()):
+            return None
+    except (OSError, KeyError, ValueError):
+        return None
+    return meta
+
+
+@traced()
+def detect_well(d, channelThreshValues=None, overwrite=False, tile_size=None, backend=None, preprocess=None):
+    '''
+    runs auto find on one well and stores the results, unless up to date ones are already stored
+    '''
+    if not overwrite and load_well_detections(d, channelThreshValues, preprocess) is not None:
+        return d, None
+    obj_channels, thresholds = get_obj_channels(d, channelThreshValues, as_table=True, tile_size=tile_size,
+                                                backend=backend, preprocess=preprocess)
+    save_well_detections(d, obj_channels, thresholds, well_nucleus_table(d, thresholds, preprocess=preprocess),
+                         preprocess)
+    # a worker goes through many wells, only keep one well's images around at a time
+    channel_cache.clear()
+    return d, {k: len(v) for k, v in obj_channels.items()}
+
+
+def _detect_well_task(*args):
+    # pool workers exit without running atexit, so the spans of each well are written as soon as it is done
+    try:
+        return detect_well(*args)
+    finally:
+        tracer.flush()
+
+
+def batch_auto_find(root, workers=None, channelThreshValues=None, overwrite=False, tile_size=None, backend=None,
+                    preprocess=None, index=None):
+    '''
+    runs auto find on every well below root in a process pool. index is passed on to find_well_directories
+    '''
+    wells = find_well_directories(root, index)
+    print(f'found {len(wells)} wells in {root}')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_detect_well_task, d, channelThreshValues, overwrite, tile_size, backend, preprocess)
+                   for d in wells]
+        for future in as_completed(futures):
+            d, counts = future.result()
+            print('up to date:' if counts is None else 'done:', d, '' if counts is None else counts)
+    # the detection files changed the well directories, so the next run does not have to list them again
+    find_well_directories(root, index)
+
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Annotator for the LCL mk 2 system.')
-    parser.add_argument('directory', help='Directory where the files to be annotated are stored.')
-    args = parser.parse_args()
     main()